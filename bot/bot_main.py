@@ -13,6 +13,11 @@ from bot.handlers import start, channels, subscription, scenarios, admin, suppor
 from bot.utils.scheduler import setup_scheduler
 from bot.middlewares.throttling import ThrottlingMiddleware
 from bot.utils.telegram_logger import TelegramLogsHandler
+from bot.utils.notifier import flush_all_digests
+from bot.utils.accounting import configure_accounting, close_accounting
+from bot.utils.extraction_pool import shutdown_extraction_pool
+from bot.utils.content_dedup import reindex_content_fingerprints
+from bot.utils.http_client import make_bot_session, warm_up_http, close_http_sessions
 
 def setup_logging():
     """Настраивает систему логирования для записи в файлы и отправки в Telegram."""
@@ -89,6 +94,12 @@ async def on_startup(pool: asyncpg.Pool):
                 added_date TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
             );
         """)
+        # Предрассчитанные оценки токенов паспорта стиля и описания — чтобы не считать их при каждой генерации
+        await connection.execute("""
+            ALTER TABLE channels
+                ADD COLUMN IF NOT EXISTS style_passport_tokens INTEGER,
+                ADD COLUMN IF NOT EXISTS activity_description_tokens INTEGER;
+        """)
         await connection.execute("""
             CREATE TABLE IF NOT EXISTS subscriptions (
                 user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
@@ -123,6 +134,49 @@ async def on_startup(pool: asyncpg.Pool):
                 UNIQUE(channel_id, source_url_hash)
             );
         """)
+        # Текст опубликованного поста — для автообновления паспорта стиля канала
+        await connection.execute("ALTER TABLE published_posts ADD COLUMN IF NOT EXISTS post_text TEXT;")
+        # Хеш нормализованного URL и simhash-отпечаток текста статьи: повторы одной новости по разным ссылкам
+        await connection.execute("ALTER TABLE published_posts ADD COLUMN IF NOT EXISTS normalized_url_hash VARCHAR(64);")
+        await connection.execute("ALTER TABLE published_posts ADD COLUMN IF NOT EXISTS content_fingerprint BIGINT;")
+        await connection.execute("CREATE INDEX IF NOT EXISTS idx_published_posts_normalized_url ON published_posts (channel_id, normalized_url_hash);")
+        # Полосы отпечатков опубликованных статей: поиск похожих по совпадению хотя бы одной полосы
+        await connection.execute("""
+            CREATE TABLE IF NOT EXISTS published_post_fingerprints (
+                channel_id BIGINT NOT NULL,
+                band SMALLINT NOT NULL,
+                band_value INTEGER NOT NULL,
+                fingerprint BIGINT NOT NULL,
+                published_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        await connection.execute("CREATE INDEX IF NOT EXISTS idx_published_post_fingerprints_band ON published_post_fingerprints (channel_id, band, band_value);")
+        # Число полос зависит от CONTENT_DEDUP_MAX_DISTANCE; прежние строки построены на 4 полосах
+        await connection.execute("ALTER TABLE published_post_fingerprints ADD COLUMN IF NOT EXISTS bands SMALLINT NOT NULL DEFAULT 4;")
+        await reindex_content_fingerprints(connection)
+        # file_id уже отправленных картинок: повторная отправка без скачивания Telegram'ом
+        await connection.execute("""
+            CREATE TABLE IF NOT EXISTS telegram_file_ids (
+                url_hash VARCHAR(64) PRIMARY KEY,
+                image_url TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                file_unique_id TEXT,
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                last_used_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        await connection.execute("""
+            CREATE TABLE IF NOT EXISTS scenario_post_buffer (
+                id SERIAL PRIMARY KEY,
+                scenario_id INTEGER NOT NULL REFERENCES posting_scenarios(id) ON DELETE CASCADE,
+                channel_id BIGINT NOT NULL,
+                source_url_hash VARCHAR(64) NOT NULL,
+                post_data JSONB NOT NULL, -- Готовый пост: title, body, image_query, source_url
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+                UNIQUE(scenario_id, source_url_hash)
+            );
+        """)
         await connection.execute("""
             CREATE TABLE IF NOT EXISTS promo_codes (
                 id SERIAL PRIMARY KEY,
@@ -183,22 +237,30 @@ async def on_startup(pool: asyncpg.Pool):
                 created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
             );
         """)
+        await connection.execute("ALTER TABLE pending_moderation_posts ADD COLUMN IF NOT EXISTS content_fingerprint BIGINT;")
     logging.info("Database tables are ready.")
 
 async def on_shutdown(pool: asyncpg.Pool, scheduler):
     logging.info("Shutting down scheduler...")
     scheduler.shutdown()
+    logging.info("Flushing pending notification digests...")
+    await flush_all_digests()
+    logging.info("Flushing accounting buffer...")
+    await close_accounting()
     logging.info("Closing database connection pool...")
     await pool.close()
     logging.info("Database connection pool closed.")
+    await close_http_sessions()
+    logging.info("HTTP sessions closed.")
+    shutdown_extraction_pool()
 
 async def main():
     """Основная функция для запуска бота."""
     setup_logging()
 
-    storage = RedisStorage.from_url('redis://redis:6379/0')
+    storage = RedisStorage.from_url(config.REDIS_URL)
 
-    bot = Bot(token=config.BOT_TOKEN, parse_mode="HTML")
+    bot = Bot(token=config.BOT_TOKEN, parse_mode="HTML", session=make_bot_session())
     
     dp = Dispatcher(storage=storage, parse_mode="HTML")
     dp.update.middleware(ThrottlingMiddleware())
@@ -221,6 +283,8 @@ async def main():
 
     db_pool = await create_db_connection_pool()
     await on_startup(db_pool)
+    configure_accounting(db_pool)
+    await warm_up_http()
 
     dp['db_pool'] = db_pool
     scheduler = await setup_scheduler(dp['db_pool'])
@@ -31,6 +31,31 @@ OPENROUTER_API_KEY = get_secret("openrouter_api_key")
 OPENROUTER_API_BASE = "https://openrouter.ai/api/v1"
 OPENROUTER_MODEL = "meta-llama/llama-3.2-3b-instruct"
 OPENROUTER_SONAR_MODEL = os.getenv("OPENROUTER_SONAR_MODEL", "perplexity/sonar")
+# Потоковый режим (SSE): ответ разбирается по мере поступления, поиск картинки стартует раньше
+OPENROUTER_STREAMING = os.getenv("OPENROUTER_STREAMING", "0") == "1"
+
+def get_list(env_name: str, default: str) -> list[str]:
+    """Читает из окружения список значений через запятую."""
+    return [item.strip() for item in os.getenv(env_name, default).split(',') if item.strip()]
+
+# Модели, которым можно передавать response_format с JSON-схемой (структурированный вывод)
+OPENROUTER_STRUCTURED_OUTPUT_MODELS = get_list("OPENROUTER_STRUCTURED_OUTPUT_MODELS", OPENROUTER_SONAR_MODEL)
+
+# Упорядоченные списки моделей по задачам: первая — основная, остальные — резервные.
+# Хедж-запрос уходит к следующей модели списка; к той же модели — только при OPENROUTER_HEDGE_SAME_MODEL=1.
+OPENROUTER_MODEL_ROUTES = {
+    "discovery": get_list("OPENROUTER_ROUTE_DISCOVERY", OPENROUTER_SONAR_MODEL),
+    "styling": get_list("OPENROUTER_ROUTE_STYLING", f"{OPENROUTER_MODEL},meta-llama/llama-3.1-8b-instruct"),
+    "style_passport": get_list("OPENROUTER_ROUTE_STYLE_PASSPORT", f"{OPENROUTER_MODEL},meta-llama/llama-3.1-8b-instruct"),
+    "article_selection": get_list("OPENROUTER_ROUTE_ARTICLE_SELECTION", f"{OPENROUTER_MODEL},meta-llama/llama-3.1-8b-instruct"),
+}
+# Хедж-запрос отправляется, если модель не ответила за этот перцентиль своих последних задержек (0 — выключить)
+OPENROUTER_HEDGE_PERCENTILE = float(os.getenv("OPENROUTER_HEDGE_PERCENTILE", "0.9"))
+# Пока замеров меньше, чем нужно, используется фиксированная задержка хеджа
+OPENROUTER_HEDGE_MIN_SAMPLES = int(os.getenv("OPENROUTER_HEDGE_MIN_SAMPLES", "20"))
+OPENROUTER_HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("OPENROUTER_HEDGE_DEFAULT_DELAY_SECONDS", "25"))
+# Хеджировать повтором к той же модели (каждый хедж к Sonar — еще один платный запрос)
+OPENROUTER_HEDGE_SAME_MODEL = os.getenv("OPENROUTER_HEDGE_SAME_MODEL", "0") == "1"
 
 DB_USER = get_secret("db_user")
 DB_PASSWORD = get_secret("db_password")
@@ -39,6 +64,8 @@ DB_NAME = get_secret("db_name")
 # или оставить в .env. Для продакшена с Docker это всегда имя сервиса.
 DB_HOST = os.getenv("DB_HOST", "db")
 
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+
 # --- Преобразуем список админов в нужный формат ---
 ADMINS = [int(admin_id.strip()) for admin_id in ADMIN_USER_IDS.split(',') if admin_id.strip()]
 
@@ -53,7 +80,49 @@ SONAR_REQUEST_COST_RUB = float(os.getenv("SONAR_REQUEST_COST_RUB", "0.5"))
 # 1 000 000 токенов = 120 рублей => 0.12 руб за 1000 токенов
 AI_TOKEN_COST_PER_1M_RUB = float(os.getenv("AI_TOKEN_COST_PER_1M_RUB", "120"))
 AI_TOKEN_COST_PER_1000 = AI_TOKEN_COST_PER_1M_RUB / 1000.0
+# Дневные лимиты расходов по моделям в рублях, формат "model:limit,model:limit".
+# Модель сверх лимита пропускается маршрутизатором до конца суток.
+MODEL_DAILY_COST_CAPS_RUB = {
+    model.strip(): float(cap)
+    for model, _, cap in (item.rpartition(':') for item in get_list("MODEL_DAILY_COST_CAPS_RUB", ""))
+    if model.strip()
+}
 MAX_CHARS_FOR_PASSPORT = 3000 # Максимальное количество символов для "Паспорта стиля" AI
+# Лимиты токенов промпта по задачам, формат "task:tokens,task:tokens".
+# Промпт сверх лимита отклоняется до отправки запроса, без расходов.
+PROMPT_TOKEN_BUDGETS = {
+    task.strip(): int(limit)
+    for task, _, limit in (item.rpartition(':') for item in get_list(
+        "PROMPT_TOKEN_BUDGETS", "discovery:2500,styling:3000,style_passport:2500,article_selection:3000"
+    ))
+    if task.strip()
+}
+# Лимиты токенов отдельных разделов промптов: длинные разделы обрезаются до отправки
+STYLE_PASSPORT_TOKEN_BUDGET = int(os.getenv("STYLE_PASSPORT_TOKEN_BUDGET", "700"))
+ACTIVITY_DESCRIPTION_TOKEN_BUDGET = int(os.getenv("ACTIVITY_DESCRIPTION_TOKEN_BUDGET", "200"))
+PASSPORT_POSTS_TOKEN_BUDGET = int(os.getenv("PASSPORT_POSTS_TOKEN_BUDGET", "1500"))
+ARTICLE_LIST_TOKEN_BUDGET = int(os.getenv("ARTICLE_LIST_TOKEN_BUDGET", "2200"))
+
+# --- Локальное ранжирование статей (BM25) ---
+# Относительная разница оценок на границе тройки, при которой выбор отдается ИИ
+RANKING_TIE_MARGIN = float(os.getenv("RANKING_TIE_MARGIN", "0.1"))
+# Период полураспада веса статьи по свежести в часах (0 — не учитывать дату)
+RANKING_RECENCY_HALF_LIFE_HOURS = float(os.getenv("RANKING_RECENCY_HALF_LIFE_HOURS", "12"))
+# Если Sonar не дал поста: поиск XMLRiver, выбор статей BM25 и пост по тексту статьи (1 — включено)
+SEARCH_FALLBACK = os.getenv("SEARCH_FALLBACK", "1") == "1"
+
+# --- Инкрементальное обновление паспорта стиля ---
+# Лимиты токенов: текущий паспорт, новые посты и ответ модели
+PASSPORT_REFINE_PASSPORT_TOKEN_BUDGET = int(os.getenv("PASSPORT_REFINE_PASSPORT_TOKEN_BUDGET", "1000"))
+PASSPORT_REFINE_POSTS_TOKEN_BUDGET = int(os.getenv("PASSPORT_REFINE_POSTS_TOKEN_BUDGET", "600"))
+PASSPORT_REFINE_MAX_TOKENS = int(os.getenv("PASSPORT_REFINE_MAX_TOKENS", "700"))
+# Автообновление паспортов по опубликованным постам канала: раз в сколько часов запускается,
+# сколько свежих постов нужно, не чаще чем раз в сколько дней для канала и сколько каналов за запуск
+PASSPORT_AUTO_REFRESH_INTERVAL_HOURS = int(os.getenv("PASSPORT_AUTO_REFRESH_INTERVAL_HOURS", "24"))
+PASSPORT_AUTO_REFRESH_MIN_POSTS = int(os.getenv("PASSPORT_AUTO_REFRESH_MIN_POSTS", "3"))
+PASSPORT_AUTO_REFRESH_MIN_AGE_DAYS = int(os.getenv("PASSPORT_AUTO_REFRESH_MIN_AGE_DAYS", "7"))
+PASSPORT_AUTO_REFRESH_BATCH = int(os.getenv("PASSPORT_AUTO_REFRESH_BATCH", "20"))
+PASSPORT_AUTO_REFRESH_MAX_POSTS = 5
 MAX_TITLE_CHARS = int(os.getenv("MAX_TITLE_CHARS", "120"))
 MAX_BODY_CHARS = int(os.getenv("MAX_BODY_CHARS", "2000"))
 MAX_IMAGE_QUERY_CHARS = int(os.getenv("MAX_IMAGE_QUERY_CHARS", "120"))
@@ -61,14 +130,114 @@ MAX_STYLE_PASSPORT_CHARS = int(os.getenv("MAX_STYLE_PASSPORT_CHARS", "2000"))
 MAX_ACTIVITY_DESCRIPTION_CHARS = int(os.getenv("MAX_ACTIVITY_DESCRIPTION_CHARS", "500"))
 MAX_GENERATION_LANGUAGE_CHARS = int(os.getenv("MAX_GENERATION_LANGUAGE_CHARS", "50"))
 
+# Сколько разных новостей просить у Sonar за один запрос. Лишние кандидаты
+# складываются в буфер готовых постов сценария и расходуются следующими запусками.
+SONAR_CANDIDATES_PER_REQUEST = int(os.getenv("SONAR_CANDIDATES_PER_REQUEST", "3"))
+# Сколько часов готовый пост может лежать в буфере, прежде чем станет несвежим
+POST_BUFFER_TTL_HOURS = int(os.getenv("POST_BUFFER_TTL_HOURS", "6"))
+# Максимум готовых постов в буфере одного сценария
+POST_BUFFER_MAX_SIZE = int(os.getenv("POST_BUFFER_MAX_SIZE", "5"))
+
 # Минимальный интервал между запусками сценария в минутах
 MIN_SCENARIO_INTERVAL_MINUTES = int(os.getenv("MIN_SCENARIO_INTERVAL_MINUTES", "15"))
 
+# Окно (в секундах), за которое уведомления о неудачных запусках сценариев
+# собираются в одну сводку для пользователя. 0 — отправлять сразу, как раньше.
+NOTIFICATION_DIGEST_WINDOW_SECONDS = int(os.getenv("NOTIFICATION_DIGEST_WINDOW_SECONDS", "600"))
+
 XMLRIVER_API_KEY = get_secret("xmlriver_api_key")
 XMLRIVER_NEWS_URL = "http://xmlriver.com/search/xml"
+# Время жизни ответов XMLRiver в кэше Redis по типу поиска (setab); 0 — не кэшировать
+XMLRIVER_CACHE_TTL_SECONDS = {
+    "news": int(os.getenv("XMLRIVER_NEWS_CACHE_TTL_SECONDS", "900")),
+    "images": int(os.getenv("XMLRIVER_IMAGES_CACHE_TTL_SECONDS", "86400")),
+}
+
+# --- Проверка картинок перед отправкой: Range-запрос первых байт и разбор заголовка ---
+IMAGE_PROBE_TOP_K = int(os.getenv("IMAGE_PROBE_TOP_K", "5"))
+IMAGE_PROBE_BUDGET_SECONDS = float(os.getenv("IMAGE_PROBE_BUDGET_SECONDS", "3"))
+IMAGE_PROBE_BYTES = int(os.getenv("IMAGE_PROBE_BYTES", "65536"))
+IMAGE_PROBE_CACHE_SECONDS = int(os.getenv("IMAGE_PROBE_CACHE_SECONDS", "3600"))
+# Telegram скачивает фото по ссылке, только если оно не больше 5 МБ
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(5 * 1024 * 1024)))
+IMAGE_MIN_SIDE = int(os.getenv("IMAGE_MIN_SIDE", "300"))
+# Упреждающий поиск картинки по теме сценария параллельно с генерацией (платный запрос XMLRiver)
+SPECULATIVE_IMAGE_SEARCH = os.getenv("SPECULATIVE_IMAGE_SEARCH", "0") == "1"
+# Минимальная доля общих термов с запросом изображения от ИИ, чтобы взять упреждающую картинку
+SPECULATIVE_IMAGE_MIN_RELEVANCE = float(os.getenv("SPECULATIVE_IMAGE_MIN_RELEVANCE", "0.5"))
+
+# --- Предохранители (circuit breaker) для внешних провайдеров ---
+# Окно, по которому считается доля ошибок и медленных ответов
+CIRCUIT_BREAKER_WINDOW_SECONDS = int(os.getenv("CIRCUIT_BREAKER_WINDOW_SECONDS", "300"))
+# Минимум запросов в окне, прежде чем цепь может разомкнуться
+CIRCUIT_BREAKER_MIN_CALLS = int(os.getenv("CIRCUIT_BREAKER_MIN_CALLS", "5"))
+CIRCUIT_BREAKER_ERROR_RATE = float(os.getenv("CIRCUIT_BREAKER_ERROR_RATE", "0.5"))
+CIRCUIT_BREAKER_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_BREAKER_SLOW_CALL_SECONDS", "45"))
+CIRCUIT_BREAKER_SLOW_CALL_RATE = float(os.getenv("CIRCUIT_BREAKER_SLOW_CALL_RATE", "0.8"))
+# На сколько размыкается цепь; после неудачной пробы срок удваивается до максимума
+CIRCUIT_BREAKER_OPEN_SECONDS = int(os.getenv("CIRCUIT_BREAKER_OPEN_SECONDS", "120"))
+CIRCUIT_BREAKER_MAX_OPEN_SECONDS = int(os.getenv("CIRCUIT_BREAKER_MAX_OPEN_SECONDS", "1800"))
+# Сколько сценарий может подождать восстановления провайдера, прежде чем пропустить запуск
+SCENARIO_MAX_DEFER_SECONDS = int(os.getenv("SCENARIO_MAX_DEFER_SECONDS", "300"))
+
+# --- Кэш ответов ИИ (Redis) для повторяющихся промптов: выключен по умолчанию ---
+COMPLETION_CACHE_ENABLED = os.getenv("COMPLETION_CACHE_ENABLED", "0") == "1"
+COMPLETION_CACHE_TTL_SECONDS = int(os.getenv("COMPLETION_CACHE_TTL_SECONDS", "86400"))
+COMPLETION_CACHE_MAX_ENTRIES = int(os.getenv("COMPLETION_CACHE_MAX_ENTRIES", "5000"))
+COMPLETION_CACHE_MAX_TEMPERATURE = float(os.getenv("COMPLETION_CACHE_MAX_TEMPERATURE", "0.3"))
+
+# --- Общие HTTP-сессии: пул соединений для всех внешних запросов ---
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "10"))
+HTTP_DNS_CACHE_SECONDS = int(os.getenv("HTTP_DNS_CACHE_SECONDS", "300"))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "60"))
+
+# --- Извлечение текста статей (readability + BeautifulSoup) вне цикла событий ---
+# process — пул процессов, thread — пул потоков (запасной вариант)
+EXTRACTION_EXECUTOR = os.getenv("EXTRACTION_EXECUTOR", "process")
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", "2"))
+EXTRACTION_TASK_TIMEOUT_SECONDS = float(os.getenv("EXTRACTION_TASK_TIMEOUT_SECONDS", "10"))
+EXTRACTION_MAX_TASKS_PER_CHILD = int(os.getenv("EXTRACTION_MAX_TASKS_PER_CHILD", "50"))
+
+# --- Дисковый кэш загруженных страниц статей (сжатый HTML + извлеченный текст) ---
+FETCH_CACHE_DIR = os.getenv("FETCH_CACHE_DIR", "cache/articles")
+FETCH_CACHE_MAX_BYTES = int(os.getenv("FETCH_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+FETCH_CACHE_FRESH_SECONDS = int(os.getenv("FETCH_CACHE_FRESH_SECONDS", "600"))
+# Сколько байт страницы статьи читать (остаток не загружается)
+ARTICLE_MAX_BYTES = int(os.getenv("ARTICLE_MAX_BYTES", str(2 * 1024 * 1024)))
+
+# --- Параллельная загрузка статей-кандидатов: первые успешные побеждают ---
+ARTICLE_FETCH_DEADLINE_SECONDS = float(os.getenv("ARTICLE_FETCH_DEADLINE_SECONDS", "12"))
+# Домен с долей успешных извлечений ниже порога (после минимума попыток) пробуется в последнюю очередь
+ARTICLE_DOMAIN_MIN_ATTEMPTS = int(os.getenv("ARTICLE_DOMAIN_MIN_ATTEMPTS", "5"))
+ARTICLE_DOMAIN_MIN_SUCCESS_RATE = float(os.getenv("ARTICLE_DOMAIN_MIN_SUCCESS_RATE", "0.2"))
+# Раз в столько секунд такой домен все равно пробуется, чтобы его доля успехов могла восстановиться
+ARTICLE_DOMAIN_RETRY_SECONDS = int(os.getenv("ARTICLE_DOMAIN_RETRY_SECONDS", "1800"))
+# Проверять, что источник из ответа Sonar открывается и содержит статью (1 — включено)
+VERIFY_SONAR_SOURCES = os.getenv("VERIFY_SONAR_SOURCES", "0") == "1"
+
+# --- Повторы по содержимому: одна и та же новость по разным ссылкам (simhash текста статьи) ---
+CONTENT_DEDUP = os.getenv("CONTENT_DEDUP", "1") == "1"
+CONTENT_DEDUP_DAYS = int(os.getenv("CONTENT_DEDUP_DAYS", "7"))
+# Допустимое расстояние между отпечатками в битах (из 64); от него зависит число полос индекса
+CONTENT_DEDUP_MAX_DISTANCE = int(os.getenv("CONTENT_DEDUP_MAX_DISTANCE", "3"))
+
+# --- Кассеты внешних запросов (воспроизводимое профилирование) ---
+# off — обычная работа, record — запись запросов/ответов, replay — ответы только из кассеты
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "off")
+CASSETTE_PATH = os.getenv("CASSETTE_PATH", "cassettes/session.jsonl.gz")
+# При воспроизведении выдерживать записанные задержки ответов
+CASSETTE_REPLAY_LATENCY = os.getenv("CASSETTE_REPLAY_LATENCY", "0") == "1"
+
+# --- Буфер учета (usage_ledger, ai_usage): запись в БД пачками ---
+# Выгрузка при накоплении стольких записей или через столько секунд после первой отложенной
+ACCOUNTING_FLUSH_RECORDS = int(os.getenv("ACCOUNTING_FLUSH_RECORDS", "50"))
+ACCOUNTING_FLUSH_SECONDS = float(os.getenv("ACCOUNTING_FLUSH_SECONDS", "10"))
 
 # --- Проверка наличия ключевых токенов ---
 if not BOT_TOKEN:
     raise ValueError("Необходимо указать BOT_TOKEN в секретах или .env")
+if not 0 <= CONTENT_DEDUP_MAX_DISTANCE <= 31:
+    raise ValueError("CONTENT_DEDUP_MAX_DISTANCE должен быть от 0 до 31")
 if not ADMINS:
     print("ВНИМАНИЕ: Не указаны ADMIN_USER_IDS. Функции админки и поддержки работать не будут.")
\ No newline at end of file
@@ -15,6 +15,12 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from bot.utils.states import BroadcastState, DirectMessage, PromoCodeCreation
 from bot.utils.localization import get_text
 from bot import config
+from bot.utils.circuit_breaker import breaker_states
+from bot.utils.json_extract import extraction_stats
+from bot.utils.completion_cache import completion_cache_stats
+from bot.utils.xmlriver import xmlriver_cache_stats
+from bot.utils.image_handler import speculative_image_stats
+from bot.utils.fetch_coordinator import domain_stats
 from datetime import datetime, timezone
 
 # Фильтр для проверки, является ли пользователь администратором
@@ -474,7 +480,50 @@ async def health_check_handler(message: Message, db_pool: asyncpg.Pool, schedule
     except Exception:
         pass
 
-    # 5) Формирование отчета
+    # 5) Предохранители внешних провайдеров (заполняются по мере запросов)
+    state_icons = {"closed": "✅", "half_open": "⚠️", "open": "❌"}
+    breakers_lines = []
+    for b in breaker_states():
+        line = f"{state_icons.get(b['state'], '❔')} {b['name']}: {b['state']} | здоровье {b['health']:.0%} | запросов {b['calls']} | ср. {b['avg_latency']:.1f} сек."
+        if b['retry_after']:
+            line += f" | проба через {b['retry_after']:.0f} сек."
+        breakers_lines.append(line)
+    breakers_str = "\n".join(breakers_lines) if breakers_lines else "—"
+    cache = await completion_cache_stats()
+    if not config.COMPLETION_CACHE_ENABLED:
+        cache_str = "выключен"
+    elif cache:
+        cache_str = (
+            f"Попаданий: <b>{cache['hits']}</b> из <b>{cache['hits'] + cache['misses']}</b> ({cache['hit_ratio']:.0%}) | "
+            f"Сэкономлено токенов: <b>{cache['tokens_saved']}</b> | Записей: <b>{cache['size']}</b>"
+        )
+    else:
+        cache_str = "❌ Redis недоступен"
+    xmlriver = await xmlriver_cache_stats()
+    if xmlriver:
+        xmlriver_str = (
+            f"Из кэша: <b>{xmlriver['hits']}</b> | Объединено: <b>{xmlriver['coalesced']}</b> | "
+            f"Платных: <b>{xmlriver['misses']}</b> | Сэкономлено: <b>{xmlriver['saved_ratio']:.0%}</b>"
+        )
+    else:
+        xmlriver_str = "❌ Redis недоступен"
+    speculative = speculative_image_stats()
+    if config.SPECULATIVE_IMAGE_SEARCH:
+        speculative_str = (
+            f"Использовано: <b>{speculative['hit']}</b> | Не по теме: <b>{speculative['irrelevant']}</b> | "
+            f"Пусто: <b>{speculative['empty']}</b> | Доля попаданий: <b>{speculative['hit_rate']:.0%}</b>"
+        )
+    else:
+        speculative_str = "выключен"
+    weak_domains = domain_stats()
+    domains_str = ", ".join(f"{domain} {rate:.0%} ({attempts})" for domain, rate, attempts in weak_domains) or "нет данных"
+    json_stats = extraction_stats()
+    json_str = (
+        f"Сразу валидных: <b>{json_stats['direct']}</b> | Спасено: <b>{json_stats['fenced'] + json_stats['embedded'] + json_stats['repaired']}</b> "
+        f"(обрезанных {json_stats['repaired']}) | Потеряно: <b>{json_stats['failed']}</b> | Доля спасенных: <b>{json_stats['salvage_rate']:.0%}</b>"
+    )
+
+    # 6) Формирование отчета
     health_report = (
         "<b>🩺 Отчет о состоянии бота</b>\n\n"
         f"<b>База данных:</b> {db_status}\n"
@@ -484,6 +533,12 @@ async def health_check_handler(message: Message, db_pool: asyncpg.Pool, schedule
         f"Ближайшие запуски:\n{next_runs_str}\n\n"
         f"<b>Ключи/интеграции:</b> OpenRouter: {'✅' if has_or else '❌'} | XMLRiver: {'✅' if has_xr else '❌'}\n"
         f"<b>Стоимости:</b> {costs}\n\n"
+        f"<b>Провайдеры:</b>\n{breakers_str}\n\n"
+        f"<b>Ответы ИИ (JSON):</b> {json_str}\n"
+        f"<b>Кэш ответов ИИ:</b> {cache_str}\n"
+        f"<b>Кэш XMLRiver:</b> {xmlriver_str}\n"
+        f"<b>Упреждающий поиск картинок:</b> {speculative_str}\n"
+        f"<b>Хуже всего отдают статьи:</b> {domains_str}\n\n"
         f"<b>Последние 24ч:</b> {usage_24h}"
     )
     if db_error:
@@ -8,6 +8,7 @@ from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, CallbackQuery, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from bot.utils.states import FolderCreation, ChannelStylePassportCreation, ChannelDescription, ChannelLanguage, AddChannel, Onboarding
 from bot.utils.localization import get_text
@@ -18,8 +19,10 @@ from bot.keyboards.inline import (
     get_onboarding_after_channel_keyboard, get_cancel_add_channel_keyboard,
     get_onboarding_final_keyboard
 )
-from bot.utils.ai_generator import generate_style_passport_from_text
-from bot import config
+from bot.utils.ai_generator import invalidate_channel_prompt
+from bot.utils.token_budget import estimate_tokens
+from bot.utils.style_passport_jobs import submit_style_passport_job
+from bot.utils.post_buffer import clear_channel_post_buffer
 
 router = Router()
 
@@ -27,7 +30,8 @@ router = Router()
 MAX_POSTS_FOR_PASSPORT = 10
 MAX_CHARS_FOR_PASSPORT = 3000
 MAX_CHARS_FOR_DESCRIPTION = 2000
-PASSPORT_UPDATE_COOLDOWN = datetime.timedelta(days=1)
+# Обновление существующего паспорта инкрементальное (текущий паспорт + новые посты) и стоит недорого
+PASSPORT_UPDATE_COOLDOWN = datetime.timedelta(hours=1)
 
 async def get_user_language(user_id: int, db_pool: asyncpg.Pool) -> str:
     if db_pool:
@@ -311,6 +315,7 @@ async def channel_delete_confirm_handler(callback: CallbackQuery, db_pool: async
     
     async with db_pool.acquire() as conn:
         channel_name = await conn.fetchval("DELETE FROM channels WHERE channel_id = $1 RETURNING channel_name", channel_id)
+    invalidate_channel_prompt(channel_id)
         
     await callback.answer(get_text(lang_code, 'channel_deleted_success', channel_name=channel_name), show_alert=True)
     await show_channels_menu(callback, db_pool)
@@ -427,7 +432,7 @@ async def collect_post_for_passport(message: Message, state: FSMContext, bot: Bo
             pass
 
 @router.callback_query(ChannelStylePassportCreation.collecting_posts, F.data == "style_passport_done")
-async def process_style_passport(callback: CallbackQuery, state: FSMContext, db_pool: asyncpg.Pool):
+async def process_style_passport(callback: CallbackQuery, state: FSMContext, db_pool: asyncpg.Pool, scheduler: AsyncIOScheduler):
     lang_code = await get_user_language(callback.from_user.id, db_pool)
     data = await state.get_data()
     channel_id = data.get('channel_id')
@@ -440,48 +445,28 @@ async def process_style_passport(callback: CallbackQuery, state: FSMContext, db_
         await manage_channel_by_id(callback.message, db_pool, channel_id)
         return
 
+    # Если паспорт уже есть, обновляем его по новым постам, а не генерируем с нуля
+    has_passport = await db_pool.fetchval(
+        "SELECT style_passport IS NOT NULL FROM channels WHERE channel_id = $1", channel_id
+    )
+    # Генерация идет в фоне: сообщение о прогрессе будет отредактировано, когда паспорт будет готов
+    submitted = submit_style_passport_job(
+        scheduler, channel_id, callback.from_user.id, lang_code, posts_text,
+        chat_id=callback.message.chat.id, message_id=callback.message.message_id,
+        onboarding=bool(data.get('onboarding_flow')), refine=bool(has_passport)
+    )
+    if not submitted:
+        await callback.answer(get_text(lang_code, 'style_passport_already_generating'), show_alert=True)
+        return
+
     await callback.message.edit_text(get_text(lang_code, 'style_passport_generating'))
     await callback.answer()
-
-    success, passport_text, token_count = await generate_style_passport_from_text(posts_text, lang_code)
-
-    if success:
-        cost = (token_count / 1000) * config.AI_TOKEN_COST_PER_1000
-        logging.info(f"Сгенерирован паспорт стиля для канала {channel_id}. Токены: {token_count}, Стоимость: {cost:.2f} руб.")
-        
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                "UPDATE channels SET style_passport = $1, style_passport_updated_at = NOW() WHERE channel_id = $2",
-                passport_text, channel_id
-            )
-            # Логируем в usage_ledger как расход на паспорт стиля (is_free=true — это наша внутренняя операция)
-            try:
-                cost_per_token = config.AI_TOKEN_COST_PER_1M_RUB / 1_000_000
-                cost_tokens_rub = token_count * cost_per_token
-                await conn.execute(
-                    """
-                    INSERT INTO usage_ledger (user_id, scenario_id, kind, is_free, tokens_used, sonar_requests, image_requests, cost_tokens, cost_requests, revenue)
-                    VALUES ($1, $2, $3, $4, $5, 0, 0, $6, 0, 0)
-                    """,
-                    callback.from_user.id, None, 'style_passport', True, token_count, cost_tokens_rub
-                )
-            except Exception as e:
-                logging.error(f"Не удалось записать usage_ledger для паспорта стиля: {e}", exc_info=True)
-        await callback.message.edit_text(
-            get_text(lang_code, 'style_passport_created_success', passport_text=passport_text)
-        )
-    else:
-        await callback.message.edit_text(f"Произошла ошибка при создании паспорта: {passport_text}")
-        await state.clear()
-        await manage_channel_by_id(callback.message, db_pool, channel_id)
-        return
     
     if data.get('onboarding_flow'):
         await state.set_state(Onboarding.waiting_for_description)
         await callback.message.answer(get_text(lang_code, 'onboarding_step3_description'))
     else:
         await state.clear()
-        await manage_channel_by_id(callback.message, db_pool, channel_id)
 
 @router.callback_query(ChannelStylePassportCreation.collecting_posts, F.data == "style_passport_cancel")
 async def cancel_style_passport_creation(callback: CallbackQuery, state: FSMContext, db_pool: asyncpg.Pool):
@@ -556,9 +541,11 @@ async def process_activity_description(message: Message, state: FSMContext, db_p
 
     async with db_pool.acquire() as conn:
         await conn.execute(
-            "UPDATE channels SET activity_description = $1 WHERE channel_id = $2",
-            description_text, channel_id
+            "UPDATE channels SET activity_description = $1, activity_description_tokens = $2 WHERE channel_id = $3",
+            description_text, estimate_tokens(description_text), channel_id
         )
+        await clear_channel_post_buffer(conn, channel_id)
+        invalidate_channel_prompt(channel_id)
     
     await message.reply(get_text(lang_code, 'activity_description_saved'))
     
@@ -621,6 +608,8 @@ async def set_generation_language(message: Message, state: FSMContext, db_pool:
             "UPDATE channels SET generation_language = $1 WHERE channel_id = $2",
             new_lang, channel_id
         )
+        await clear_channel_post_buffer(conn, channel_id)
+        invalidate_channel_prompt(channel_id)
     
     await message.reply(get_text(lang_code, 'generation_language_updated', new_lang=new_lang))
     
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 import datetime
 import asyncpg
-import hashlib
 import pytz
 import logging
 from aiogram import Router, F, Bot
@@ -24,6 +23,7 @@ from bot.keyboards.inline import (
     get_scenario_edit_keyboard
 )
 from bot.utils.scheduler import add_job_to_scheduler, remove_job_from_scheduler, process_scenario_job
+from bot.utils.post_buffer import record_published_post, clear_scenario_post_buffer
 
 router = Router()
 
@@ -353,7 +353,9 @@ async def process_new_scenario_theme(message: Message, state: FSMContext, db_poo
     data = await state.get_data(); scenario_id = data.get('scenario_id')
     lang_code = await get_user_language(message.from_user.id, db_pool)
     new_theme = sanitize_text(message.text)
-    await db_pool.execute("UPDATE posting_scenarios SET theme = $1 WHERE id = $2", new_theme, scenario_id)
+    async with db_pool.acquire() as conn:
+        await conn.execute("UPDATE posting_scenarios SET theme = $1 WHERE id = $2", new_theme, scenario_id)
+        await clear_scenario_post_buffer(conn, scenario_id)
     await message.answer(get_text(lang_code, 'scenario_theme_updated', escape_html_chars=True))
     await _show_manage_scenario_menu(message, db_pool, state, bot)
 
@@ -391,7 +393,9 @@ async def process_keywords_edit_done(callback: CallbackQuery, state: FSMContext,
     lang_code = await get_user_language(callback.from_user.id, db_pool); data = await state.get_data(); scenario_id = data['scenario_id']
     if not data.get('keywords'): 
         await callback.answer(get_text(lang_code, 'keywords_empty_error', escape_html_chars=True), show_alert=True); return
-    await db_pool.execute("UPDATE posting_scenarios SET keywords = $1 WHERE id = $2", ",".join(data['keywords']), scenario_id)
+    async with db_pool.acquire() as conn:
+        await conn.execute("UPDATE posting_scenarios SET keywords = $1 WHERE id = $2", ",".join(data['keywords']), scenario_id)
+        await clear_scenario_post_buffer(conn, scenario_id)
     await callback.message.delete()
     await callback.answer(get_text(lang_code, 'scenario_keywords_updated', escape_html_chars=True), show_alert=True)
     await _show_manage_scenario_menu(callback, db_pool, state, bot)
@@ -490,7 +494,7 @@ async def moderation_publish_handler(callback: CallbackQuery, bot: Bot, db_pool:
     lang_code = await get_user_language(callback.from_user.id, db_pool)
 
     async with db_pool.acquire() as conn:
-        moderation_data = await conn.fetchrow("SELECT channel_id, article_url FROM pending_moderation_posts WHERE moderation_id = $1", moderation_id)
+        moderation_data = await conn.fetchrow("SELECT channel_id, article_url, content_fingerprint FROM pending_moderation_posts WHERE moderation_id = $1", moderation_id)
         if not moderation_data:
             await callback.answer(escape_html("Ошибка: данные для модерации не найдены."), show_alert=True)
             await callback.message.delete() # Удалить сообщение с нерабочими кнопками
@@ -506,8 +510,10 @@ async def moderation_publish_handler(callback: CallbackQuery, bot: Bot, db_pool:
                 await bot.send_message(chat_id=channel_id, text=callback.message.text)
             
             # Сохраняем хеш опубликованной статьи
-            link_hash = hashlib.sha256(article_url.encode()).hexdigest()
-            await conn.execute("INSERT INTO published_posts (channel_id, source_url_hash) VALUES ($1, $2) ON CONFLICT DO NOTHING", channel_id, link_hash)
+            await record_published_post(
+                conn, channel_id, article_url, callback.message.caption or callback.message.text,
+                moderation_data['content_fingerprint']
+            )
             
             # Удаляем запись из pending_moderation_posts
             await conn.execute("DELETE FROM pending_moderation_posts WHERE moderation_id = $1", moderation_id)
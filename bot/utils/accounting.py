@@ -0,0 +1,194 @@
+# bot/utils/accounting.py
+
+import json
+import asyncio
+import logging
+import datetime
+from decimal import Decimal
+import asyncpg
+from redis import asyncio as aioredis
+
+from bot import config
+
+ACCOUNTING_FLUSH_RECORDS = config.ACCOUNTING_FLUSH_RECORDS
+ACCOUNTING_FLUSH_SECONDS = config.ACCOUNTING_FLUSH_SECONDS
+
+# Колонки таблиц учета в порядке, в котором записи лежат в буфере
+TABLE_COLUMNS = {
+    "usage_ledger": [
+        "user_id", "scenario_id", "kind", "is_free", "tokens_used", "sonar_requests", "image_requests",
+        "cost_tokens", "cost_requests", "revenue", "created_at",
+    ],
+    "ai_usage": ["scenario_id", "tokens_used", "cost", "used_at"],
+}
+# Колонки с типом NUMERIC и TIMESTAMP: при выгрузке в Redis сериализуются строками
+_NUMERIC_COLUMNS = {"cost_tokens", "cost_requests", "revenue", "cost"}
+_TIMESTAMP_COLUMNS = {"created_at", "used_at"}
+
+SPILL_KEY = "accounting:spill:{table}"
+
+_db_pool: asyncpg.Pool | None = None
+_redis = None
+_buffers: dict[str, list[tuple]] = {table: [] for table in TABLE_COLUMNS}
+_flush_task: asyncio.Task | None = None
+# Ссылки на запущенные выгрузки, чтобы задачи не собрал сборщик мусора
+_running_flushes: set[asyncio.Task] = set()
+_flush_lock = asyncio.Lock()
+
+
+def configure_accounting(db_pool: asyncpg.Pool):
+    """Передает буферу пул основного процесса бота, через который записи пишутся в БД."""
+    global _db_pool
+    _db_pool = db_pool
+
+
+def _client():
+    global _redis
+    if _redis is None:
+        _redis = aioredis.from_url(config.REDIS_URL, decode_responses=True)
+    return _redis
+
+
+def _money(value) -> Decimal:
+    return value if isinstance(value, Decimal) else Decimal(str(value or 0))
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _enqueue(table: str, record: tuple):
+    global _flush_task
+    _buffers[table].append(record)
+    pending = sum(len(b) for b in _buffers.values())
+    if pending >= ACCOUNTING_FLUSH_RECORDS or ACCOUNTING_FLUSH_SECONDS <= 0:
+        task = asyncio.create_task(flush_accounting())
+        _running_flushes.add(task)
+        task.add_done_callback(_running_flushes.discard)
+    elif _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.create_task(_flush_later())
+
+
+async def _flush_later():
+    await asyncio.sleep(ACCOUNTING_FLUSH_SECONDS)
+    await flush_accounting()
+
+
+def record_usage(user_id: int, scenario_id: int | None, kind: str, is_free: bool, tokens_used: int = 0,
+                 sonar_requests: int = 0, image_requests: int = 0, cost_tokens=0, cost_requests=0, revenue=0):
+    """
+    Ставит запись usage_ledger в буфер. В БД записи уходят пачкой (COPY) каждые
+    ACCOUNTING_FLUSH_RECORDS записей или ACCOUNTING_FLUSH_SECONDS секунд.
+    """
+    _enqueue("usage_ledger", (
+        user_id, scenario_id, kind, is_free, tokens_used, sonar_requests, image_requests,
+        _money(cost_tokens), _money(cost_requests), _money(revenue), _now(),
+    ))
+
+
+def record_ai_usage(scenario_id: int | None, tokens_used: int, cost=0):
+    """Ставит запись ai_usage в буфер (см. record_usage)."""
+    _enqueue("ai_usage", (scenario_id, tokens_used, _money(cost), _now()))
+
+
+def _to_json(table: str, record: tuple) -> str:
+    row = {}
+    for column, value in zip(TABLE_COLUMNS[table], record):
+        row[column] = value.isoformat() if column in _TIMESTAMP_COLUMNS else str(value) if column in _NUMERIC_COLUMNS else value
+    return json.dumps(row)
+
+
+def _from_json(table: str, raw: str) -> tuple:
+    row = json.loads(raw)
+    values = []
+    for column in TABLE_COLUMNS[table]:
+        value = row.get(column)
+        if column in _TIMESTAMP_COLUMNS:
+            value = datetime.datetime.fromisoformat(value)
+        elif column in _NUMERIC_COLUMNS:
+            value = Decimal(value)
+        values.append(value)
+    return tuple(values)
+
+
+async def _spill(table: str, records: list[tuple]):
+    """Postgres недоступен: сохраняем записи в Redis, чтобы дописать их при следующей выгрузке."""
+    try:
+        await _client().rpush(SPILL_KEY.format(table=table), *[_to_json(table, r) for r in records])
+        logging.warning(f"Учет: {len(records)} записей {table} временно сохранены в Redis.")
+    except Exception as e:
+        logging.critical(f"Учет: не удалось сохранить {len(records)} записей {table} ни в БД, ни в Redis: {e}", exc_info=True)
+
+
+async def _take_spilled(table: str) -> list[tuple]:
+    try:
+        redis = _client()
+        key = SPILL_KEY.format(table=table)
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            raw_records, _ = await pipe.execute()
+        return [_from_json(table, raw) for raw in raw_records]
+    except Exception as e:
+        logging.warning(f"Учет: не удалось прочитать отложенные записи {table} из Redis: {e}")
+        return []
+
+
+async def _insert_orphaned(conn: asyncpg.Connection, table: str, columns: list[str], records: list[tuple]) -> list[tuple]:
+    """
+    Дописывает пачку, в которой есть ссылки на удаленные записи: scenario_id удаленных сценариев
+    обнуляется (как ON DELETE SET NULL), затем записи вставляются по одной; записи удаленных
+    пользователей отбрасываются (как ON DELETE CASCADE). Возвращает записанные записи.
+    """
+    scenario_index = columns.index("scenario_id")
+    scenario_ids = list({r[scenario_index] for r in records if r[scenario_index] is not None})
+    alive = {row['id'] for row in await conn.fetch("SELECT id FROM posting_scenarios WHERE id = ANY($1::int[])", scenario_ids)}
+    records = [
+        r if r[scenario_index] is None or r[scenario_index] in alive else r[:scenario_index] + (None,) + r[scenario_index + 1:]
+        for r in records
+    ]
+    query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(f'${i}' for i in range(1, len(columns) + 1))})"
+    written = []
+    for record in records:
+        try:
+            await conn.execute(query, *record)
+            written.append(record)
+        except asyncpg.ForeignKeyViolationError as e:
+            logging.warning(f"Учет: запись {table} ссылается на удаленные данные и отброшена: {e}")
+    return written
+
+
+async def flush_accounting():
+    """Выгружает буферы учета в БД через COPY; при ошибке БД — в Redis."""
+    async with _flush_lock:
+        for table, columns in TABLE_COLUMNS.items():
+            records = _buffers[table]
+            _buffers[table] = []
+            if _db_pool is None:
+                if records:
+                    await _spill(table, records)
+                continue
+            records = await _take_spilled(table) + records
+            if not records:
+                continue
+            try:
+                async with _db_pool.acquire() as conn:
+                    try:
+                        await conn.copy_records_to_table(table, records=records, columns=columns)
+                    except asyncpg.ForeignKeyViolationError:
+                        # Сценарий или пользователь удален, пока записи ждали в буфере: такая пачка
+                        # не запишется никогда, поэтому в Redis ее не возвращаем
+                        records = await _insert_orphaned(conn, table, columns, records)
+                logging.debug(f"Учет: в {table} записано {len(records)} записей.")
+            except Exception as e:
+                logging.error(f"Учет: не удалось записать {len(records)} записей в {table}: {e}")
+                await _spill(table, records)
+
+
+async def close_accounting():
+    """Финальная выгрузка при остановке бота (вызывать до закрытия пула БД)."""
+    if _running_flushes:
+        await asyncio.gather(*_running_flushes, return_exceptions=True)
+    await flush_accounting()
+    if _redis is not None:
+        await _redis.aclose()
@@ -1,10 +1,22 @@
 # bot/utils/ai_generator.py
 
 import json
+import time
+import hashlib
+import asyncio
+import datetime
 import aiohttp
 import logging
+from collections import deque
+from typing import Callable
 from bot import config
 from bot.utils.localization import get_text # Импортируем здесь, чтобы избежать циклической зависимости
+from bot.utils.circuit_breaker import get_breaker
+from bot.utils.http_client import http_session
+from bot.utils.json_extract import extract_json, matches_schema
+from bot.utils.ranking import RankingQuery, rank_articles
+from bot.utils.completion_cache import is_cacheable, get_cached_completion, store_completion
+from bot.utils.token_budget import estimate_tokens, estimate_messages_tokens, calibrate, trim_to_token_budget, prompt_budget
 
 # OpenRouter API settings
 OPENROUTER_API_KEY = config.OPENROUTER_API_KEY
@@ -18,16 +30,165 @@ MAX_IMAGE_QUERY_CHARS = config.MAX_IMAGE_QUERY_CHARS
 MAX_STYLE_PASSPORT_CHARS = config.MAX_STYLE_PASSPORT_CHARS
 MAX_ACTIVITY_DESCRIPTION_CHARS = config.MAX_ACTIVITY_DESCRIPTION_CHARS
 MAX_GENERATION_LANGUAGE_CHARS = config.MAX_GENERATION_LANGUAGE_CHARS
+SONAR_CANDIDATES_PER_REQUEST = config.SONAR_CANDIDATES_PER_REQUEST
+OPENROUTER_STREAMING = config.OPENROUTER_STREAMING
+OPENROUTER_MODEL_ROUTES = config.OPENROUTER_MODEL_ROUTES
+OPENROUTER_HEDGE_PERCENTILE = config.OPENROUTER_HEDGE_PERCENTILE
+OPENROUTER_HEDGE_MIN_SAMPLES = config.OPENROUTER_HEDGE_MIN_SAMPLES
+OPENROUTER_HEDGE_DEFAULT_DELAY_SECONDS = config.OPENROUTER_HEDGE_DEFAULT_DELAY_SECONDS
+OPENROUTER_HEDGE_SAME_MODEL = config.OPENROUTER_HEDGE_SAME_MODEL
+MODEL_DAILY_COST_CAPS_RUB = config.MODEL_DAILY_COST_CAPS_RUB
+AI_TOKEN_COST_PER_1000 = config.AI_TOKEN_COST_PER_1000
+SONAR_REQUEST_COST_RUB = config.SONAR_REQUEST_COST_RUB
+STYLE_PASSPORT_TOKEN_BUDGET = config.STYLE_PASSPORT_TOKEN_BUDGET
+ACTIVITY_DESCRIPTION_TOKEN_BUDGET = config.ACTIVITY_DESCRIPTION_TOKEN_BUDGET
+PASSPORT_POSTS_TOKEN_BUDGET = config.PASSPORT_POSTS_TOKEN_BUDGET
+ARTICLE_LIST_TOKEN_BUDGET = config.ARTICLE_LIST_TOKEN_BUDGET
+PASSPORT_REFINE_PASSPORT_TOKEN_BUDGET = config.PASSPORT_REFINE_PASSPORT_TOKEN_BUDGET
+PASSPORT_REFINE_POSTS_TOKEN_BUDGET = config.PASSPORT_REFINE_POSTS_TOKEN_BUDGET
+PASSPORT_REFINE_MAX_TOKENS = config.PASSPORT_REFINE_MAX_TOKENS
+OPENROUTER_STRUCTURED_OUTPUT_MODELS = config.OPENROUTER_STRUCTURED_OUTPUT_MODELS
+RANKING_TIE_MARGIN = config.RANKING_TIE_MARGIN
 
-async def generate_content_robust(prompt: str) -> tuple[bool, str, int]:
+# Если за столько символов ответа не встретилось ни '{', ни '[', ответ считаем не-JSON и обрываем поток
+STREAM_MALFORMED_PREFIX_CHARS = 400
+
+
+class StreamAborted(Exception):
+    """Поток ответа оборван досрочно: ответ явно некорректен или превышает лимиты."""
+
+    # Текст, полученный до обрыва: за него и за промпт провайдер все равно берет плату
+    streamed_text = ""
+
+
+class _IncrementalJsonFieldParser:
     """
-    Универсальная функция для генерации контента с обработкой ошибок через OpenRouter.
-    Возвращает статус успеха, сгенерированный текст и количество токенов.
+    Инкрементальный разбор JSON-ответа модели по мере поступления фрагментов.
+    Не строит дерево целиком: отслеживает строки и пары "ключ": "значение",
+    вызывает on_field(key, value) для каждого полностью полученного строкового поля
+    и обрывает разбор, если ответ явно не JSON или строка поля body превышает лимит.
+    """
+
+    def __init__(self, on_field: Callable[[str, str], None] | None = None, max_body_chars: int | None = None):
+        self.on_field = on_field
+        self.max_body_chars = max_body_chars
+        self.text = ""
+        self._pos = 0
+        self._seen_container = False
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._pending_key = None  # Последняя закрытая строка, которая может оказаться ключом
+        self._current_key = None  # Ключ, значение которого ожидаем/читаем
+
+    def feed(self, chunk: str):
+        self.text += chunk
+        text = self.text
+        while self._pos < len(text):
+            ch = text[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._close_string(text[self._string_start:self._pos])
+            elif ch == '"':
+                self._in_string = True
+                self._string_start = self._pos + 1
+            elif ch in "{[":
+                self._seen_container = True
+                self._pending_key = None
+                self._current_key = None
+            elif ch == ":":
+                self._current_key = self._pending_key
+                self._pending_key = None
+            elif ch in ",}]":
+                self._pending_key = None
+                self._current_key = None
+            self._pos += 1
+
+        if not self._seen_container and len(self.text) >= STREAM_MALFORMED_PREFIX_CHARS:
+            raise StreamAborted(f"Нет JSON в первых {STREAM_MALFORMED_PREFIX_CHARS} символах ответа")
+        if self._in_string and self._current_key == "body" and self.max_body_chars:
+            # Экранирование и HTML-теги раздувают сырую строку, поэтому оставляем запас в 2 раза
+            if self._pos - self._string_start > self.max_body_chars * 2:
+                raise StreamAborted(f"Поле body превышает лимит {self.max_body_chars} символов")
+
+    def _close_string(self, raw: str):
+        if self._current_key is None:
+            self._pending_key = raw
+            return
+        key, self._current_key = self._current_key, None
+        if self.on_field:
+            try:
+                value = json.loads(f'"{raw}"')
+            except json.JSONDecodeError:
+                value = raw
+            self.on_field(key, value)
+
+
+async def _read_chat_completion_stream(response: aiohttp.ClientResponse, started_at: float,
+                                       parser: _IncrementalJsonFieldParser | None = None) -> tuple[str, dict]:
+    """
+    Читает ответ OpenRouter в формате server-sent events (stream=True).
+    Возвращает собранный текст и usage (из финального чанка).
+    Время до первого полезного фрагмента пишется в лог.
+    """
+    content_parts = []
+    usage = {}
+    first_useful_at = None
+
+    async for raw_line in response.content:
+        line = raw_line.decode("utf-8", "replace").strip()
+        # Пустые строки разделяют события, строки с ':' — комментарии (keep-alive OpenRouter)
+        if not line or line.startswith(":") or not line.startswith("data:"):
+            continue
+        data_str = line[len("data:"):].strip()
+        if data_str == "[DONE]":
+            break
+        try:
+            chunk = json.loads(data_str)
+        except json.JSONDecodeError:
+            logging.warning(f"OpenRouter: не удалось разобрать SSE-чанк: {data_str[:200]}")
+            continue
+
+        if chunk.get("error"):
+            aborted = StreamAborted(f"Ошибка в потоке OpenRouter: {chunk['error']}")
+            aborted.streamed_text = "".join(content_parts)
+            raise aborted
+        if chunk.get("usage"):
+            usage = chunk["usage"]
+
+        choices = chunk.get("choices") or [{}]
+        delta = (choices[0].get("delta") or {}).get("content") or ""
+        if not delta:
+            continue
+        if first_useful_at is None:
+            first_useful_at = time.monotonic()
+            logging.info(f"OpenRouter stream: первый полезный фрагмент через {first_useful_at - started_at:.2f} сек.")
+        content_parts.append(delta)
+        if parser:
+            try:
+                parser.feed(delta)
+            except StreamAborted as e:
+                e.streamed_text = "".join(content_parts)
+                raise
+
+    logging.info(f"OpenRouter stream: ответ получен полностью за {time.monotonic() - started_at:.2f} сек.")
+    return "".join(content_parts), usage
+
+
+async def _post_chat_completion(model: str, messages: list[dict], temperature: float, max_tokens: int,
+                                parser: _IncrementalJsonFieldParser | None = None,
+                                response_schema: dict | None = None) -> tuple[bool, str, int]:
+    """
+    Один запрос к OpenRouter Chat Completions к конкретной модели.
+    Если передана response_schema и модель поддерживает структурированный вывод
+    (OPENROUTER_STRUCTURED_OUTPUT_MODELS), ответ запрашивается строго по JSON-схеме.
+    Возвращает статус успеха, текст ответа (или текст ошибки) и количество токенов.
     """
-    if not OPENROUTER_API_KEY:
-        logging.critical("КРИТИЧЕСКАЯ ОШИБКА: OPENROUTER_API_KEY не найден. Генерация ИИ невозможна.")
-        return False, "API ключ OpenRouter не найден.", 0
-    
     headers = {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
         "Content-Type": "application/json",
@@ -36,43 +197,273 @@ async def generate_content_robust(prompt: str) -> tuple[bool, str, int]:
 
     # OpenRouter использует формат OpenAI Chat Completions
     payload = {
-        "model": OPENROUTER_MODEL,
-        "messages": [
-            {"role": "user", "content": prompt}
-        ],
-        "temperature": 0.7, # можно настроить
-        "max_tokens": 800
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens
     }
+    if response_schema and model in OPENROUTER_STRUCTURED_OUTPUT_MODELS:
+        payload["response_format"] = {"type": "json_schema", "json_schema": {"name": "response", "schema": response_schema}}
+    if OPENROUTER_STREAMING:
+        payload["stream"] = True
 
-    logging.info(f"Отправка запроса к OpenRouter API. Модель: {OPENROUTER_MODEL}")
+    breaker = get_breaker("openrouter", model)
+    ticket = breaker.allow_request()
+    if not ticket:
+        logging.warning(f"OpenRouter ({model}) временно недоступен, запрос не отправлен (повтор через {breaker.retry_after():.0f} сек.).")
+        return False, f"Провайдер OpenRouter ({model}) временно недоступен.", 0
 
+    logging.info(f"Отправка запроса к OpenRouter API. Модель: {model}")
+
+    started_at = time.monotonic()
     try:
-        async with aiohttp.ClientSession() as session:
+        async with http_session() as session:
             async with session.post(f"{OPENROUTER_API_BASE}/chat/completions", headers=headers, json=payload, timeout=60) as response:
-                if response.status == 200:
+                if response.status == 200 and OPENROUTER_STREAMING:
+                    generated_text, usage = await _read_chat_completion_stream(response, started_at, parser)
+                elif response.status == 200:
                     data = await response.json()
-                    # Проверяем наличие текста в ответе
-                    if not data.get("choices") or not data["choices"][0].get("message") or not data["choices"][0]["message"].get("content"):
-                        logging.error(f"OpenRouter вернул пустой или некорректный ответ: {data}")
-                        return False, "OpenRouter вернул пустой или некорректный ответ.", 0
-                    
-                    generated_text = data["choices"][0]["message"]["content"]
-                    token_count = data.get("usage", {}).get("total_tokens", 0)
-                    logging.info(f"Успешная генерация контента от OpenRouter. Токенов использовано: {token_count}")
-                    return True, generated_text, token_count
+                    generated_text = ((data.get("choices") or [{}])[0].get("message") or {}).get("content") or ""
+                    usage = data.get("usage") or {}
                 else:
                     error_text = await response.text()
-                    logging.error(f"Ошибка OpenRouter API: Статус {response.status}, Тело ответа: {error_text}")
+                    # 5xx и 429 говорят о проблемах провайдера; остальные 4xx — о проблеме нашего запроса
+                    if response.status >= 500 or response.status == 429:
+                        breaker.record_failure(time.monotonic() - started_at)
+                    else:
+                        breaker.record_success(time.monotonic() - started_at)
+                    logging.error(f"Ошибка OpenRouter API ({model}): Статус {response.status}, Тело ответа: {error_text}")
                     return False, f"Ошибка OpenRouter API: {error_text}", 0
-    except aiohttp.ClientError as e:
-        error_message = f"Ошибка сетевого запроса к OpenRouter: {e}"
-        logging.critical(error_message, exc_info=True)
+
+                breaker.record_success(time.monotonic() - started_at)
+                token_count = usage.get("total_tokens", 0)
+                # Уточняем локальную оценку токенов по фактическому размеру промпта
+                calibrate(model, messages, usage.get("prompt_tokens", 0))
+
+                # Проверяем наличие текста в ответе
+                if not generated_text:
+                    logging.error(f"OpenRouter ({model}) вернул пустой или некорректный ответ.")
+                    return False, "OpenRouter вернул пустой или некорректный ответ.", token_count
+                logging.info(f"Успешная генерация контента от OpenRouter ({model}). Токенов использовано: {token_count}")
+                return True, generated_text, token_count
+    except StreamAborted as e:
+        # Провайдер ответил, но содержимое негодное — это не сбой провайдера
+        breaker.record_success(time.monotonic() - started_at)
+        # Промпт и уже полученная часть ответа оплачены — учитываем их в расходе и лимитах
+        token_count = estimate_messages_tokens(messages, model) + estimate_tokens(e.streamed_text, model)
+        logging.error(f"Потоковый ответ OpenRouter ({model}) прерван: {e}. Учтено токенов (оценка): {token_count}")
+        return False, str(e), token_count
+    except asyncio.CancelledError:
+        # Запрос отменен (например, проигравший хедж-запрос) — исхода для предохранителя нет
+        breaker.release(ticket)
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        breaker.record_failure(time.monotonic() - started_at)
+        error_message = f"Ошибка сетевого запроса к OpenRouter ({model}): {e!r}"
+        logging.error(error_message)
         return False, error_message, 0
     except Exception as e:
-        error_message = f"Произошла непредвиденная ошибка при генерации контента через OpenRouter: {e}"
+        breaker.record_failure(time.monotonic() - started_at)
+        error_message = f"Произошла непредвиденная ошибка при генерации контента через OpenRouter ({model}): {e}"
         logging.critical(error_message, exc_info=True)
         return False, error_message, 0
 
+
+# --- Маршрутизация по моделям: резервные модели, хедж-запросы, лимиты расходов ---
+
+# Последние длительности успешных запросов по моделям (сек.) — для расчета задержки хедж-запроса
+_model_latencies: dict[str, deque] = {}
+# Расходы по моделям за текущие сутки (руб.): model -> (дата, сумма)
+_model_spend_today: dict[str, tuple[datetime.date, float]] = {}
+
+
+def _model_request_cost(model: str, token_count: int) -> float:
+    """Оценка стоимости запроса в рублях по тем же константам, что и в usage_ledger."""
+    cost = (token_count / 1000) * AI_TOKEN_COST_PER_1000
+    if "sonar" in model:
+        cost += SONAR_REQUEST_COST_RUB
+    return cost
+
+
+def _spent_today(model: str) -> float:
+    day, spent = _model_spend_today.get(model, (None, 0.0))
+    return spent if day == datetime.date.today() else 0.0
+
+
+def _add_spend(model: str, cost: float):
+    _model_spend_today[model] = (datetime.date.today(), _spent_today(model) + cost)
+
+
+def _within_cost_cap(model: str) -> bool:
+    cap = MODEL_DAILY_COST_CAPS_RUB.get(model)
+    return cap is None or _spent_today(model) < cap
+
+
+def _hedge_delay(model: str) -> float | None:
+    """
+    Через сколько секунд отправлять хедж-запрос: перцентиль OPENROUTER_HEDGE_PERCENTILE
+    по последним успешным запросам модели. None — хеджирование выключено.
+    """
+    if OPENROUTER_HEDGE_PERCENTILE <= 0:
+        return None
+    latencies = _model_latencies.get(model)
+    if not latencies or len(latencies) < OPENROUTER_HEDGE_MIN_SAMPLES:
+        return OPENROUTER_HEDGE_DEFAULT_DELAY_SECONDS
+    ordered = sorted(latencies)
+    index = min(len(ordered) - 1, int(len(ordered) * OPENROUTER_HEDGE_PERCENTILE))
+    return ordered[index]
+
+
+async def _timed_chat_completion(model: str, messages: list[dict], temperature: float, max_tokens: int,
+                                 parser_factory: Callable[[], _IncrementalJsonFieldParser] | None,
+                                 response_schema: dict | None = None) -> tuple[str, bool, str, int]:
+    started_at = time.monotonic()
+    parser = parser_factory() if parser_factory else None
+    success, content, token_count = await _post_chat_completion(model, messages, temperature, max_tokens, parser, response_schema)
+    _add_spend(model, _model_request_cost(model, token_count))
+    if success:
+        _model_latencies.setdefault(model, deque(maxlen=100)).append(time.monotonic() - started_at)
+    return model, success, content, token_count
+
+
+async def _hedged_chat_completion(primary: str, hedge: str, messages: list[dict], temperature: float, max_tokens: int,
+                                  parser_factory: Callable[[], _IncrementalJsonFieldParser] | None,
+                                  response_schema: dict | None = None) -> tuple[str, bool, str, int, list[str]]:
+    """
+    Отправляет запрос к primary; если он не ответил за перцентиль своей задержки,
+    параллельно отправляет такой же запрос к hedge. Побеждает первый успешный ответ, проигравший отменяется.
+    Хедж к той же модели отправляется только при OPENROUTER_HEDGE_SAME_MODEL.
+    Возвращает (модель, успех, текст, токены, модели всех отправленных запросов); токены и расходы
+    включают оценку оплаченной части отмененного запроса.
+    """
+    primary_task = asyncio.create_task(_timed_chat_completion(primary, messages, temperature, max_tokens, parser_factory, response_schema))
+    delay = _hedge_delay(primary)
+    if delay is None or not _within_cost_cap(hedge) or (hedge == primary and not OPENROUTER_HEDGE_SAME_MODEL):
+        return *await primary_task, [primary]
+
+    done, _ = await asyncio.wait({primary_task}, timeout=delay)
+    if done:
+        return *primary_task.result(), [primary]
+
+    logging.info(f"OpenRouter: {primary} не ответила за {delay:.1f} сек., отправляем хедж-запрос к {hedge}")
+    hedge_task = asyncio.create_task(_timed_chat_completion(hedge, messages, temperature, max_tokens, parser_factory, response_schema))
+    task_models = {primary_task: primary, hedge_task: hedge}
+    pending = {primary_task, hedge_task}
+    finished = []
+    winner = None
+    cancelled_tokens = 0
+    while pending and winner is None:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finished.extend(task.result() for task in done)
+        winner = next((r for r in finished if r[1]), None)
+    for loser in pending:
+        loser.cancel()
+        # Провайдер уже выставил счет за промпт (и за Sonar-запрос): учитываем хотя бы оценку
+        loser_model = task_models[loser]
+        loser_tokens = estimate_messages_tokens(messages, loser_model)
+        _add_spend(loser_model, _model_request_cost(loser_model, loser_tokens))
+        cancelled_tokens += loser_tokens
+    await asyncio.gather(*pending, return_exceptions=True)
+    model, success, content, _ = winner or finished[-1]
+    return model, success, content, sum(r[3] for r in finished) + cancelled_tokens, [primary, hedge]
+
+
+async def _route_chat_completion(task: str, messages: list[dict], temperature: float, max_tokens: int,
+                                 parser_factory: Callable[[], _IncrementalJsonFieldParser] | None = None,
+                                 response_schema: dict | None = None,
+                                 usage: dict | None = None) -> tuple[bool, str, int]:
+    """
+    Выполняет запрос для задачи task ('discovery', 'styling', 'style_passport', 'article_selection')
+    по упорядоченному списку моделей OPENROUTER_MODEL_ROUTES: при ошибке переходит к следующей модели,
+    при медленном ответе отправляет хедж-запрос, модели сверх дневного лимита расходов пропускает.
+    Возвращает статус успеха, текст ответа (или ошибки) и суммарное количество токенов.
+    В usage (если передан) записываются requests и sonar_requests — сколько запросов реально отправлено.
+    """
+    if usage is not None:
+        usage.update(requests=0, sonar_requests=0)
+    if not OPENROUTER_API_KEY:
+        logging.critical("КРИТИЧЕСКАЯ ОШИБКА: OPENROUTER_API_KEY не найден. Генерация ИИ невозможна.")
+        return False, "API ключ OpenRouter не найден.", 0
+
+    # Промпт сверх лимита задачи не отправляем вовсе — за такой запрос пришлось бы заплатить
+    budget = prompt_budget(task)
+    route = OPENROUTER_MODEL_ROUTES.get(task, [OPENROUTER_MODEL])
+    if budget:
+        estimated = max(estimate_messages_tokens(messages, m) for m in route)
+        if estimated > budget:
+            logging.error(f"OpenRouter: промпт задачи '{task}' (~{estimated} токенов) превышает лимит {budget}, запрос не отправлен.")
+            return False, f"Промпт превышает лимит токенов ({estimated} > {budget}).", 0
+
+    models = [m for m in route if _within_cost_cap(m)]
+    if not models:
+        logging.error(f"OpenRouter: для задачи '{task}' все модели исчерпали дневной лимит расходов.")
+        return False, "Дневной лимит расходов на модели исчерпан.", 0
+    # Модели с разомкнутым предохранителем не пробуем, пока есть здоровые
+    healthy = [m for m in models if get_breaker("openrouter", m).retry_after() == 0]
+    if not healthy:
+        logging.warning(f"OpenRouter: для задачи '{task}' все модели временно недоступны.")
+        return False, "Провайдер OpenRouter временно недоступен.", 0
+    models = healthy
+
+    total_tokens = 0
+    last_error = ""
+    tried = set()
+    for i, model in enumerate(models):
+        if model in tried or not _within_cost_cap(model):
+            continue
+        # Хедж-запрос уходит к следующей модели маршрута, а если ее нет — к той же модели (см. OPENROUTER_HEDGE_SAME_MODEL)
+        hedge = next((m for m in models[i + 1:] if m not in tried), model)
+        used_model, success, content, token_count, sent_models = await _hedged_chat_completion(
+            model, hedge, messages, temperature, max_tokens, parser_factory, response_schema
+        )
+        if usage is not None:
+            usage["requests"] += len(sent_models)
+            usage["sonar_requests"] += sum(1 for m in sent_models if "sonar" in m)
+        # Обе модели хеджа уже оплачены: повторно их в этом запуске не пробуем
+        tried.update(sent_models)
+        total_tokens += token_count
+        if success:
+            if used_model != models[0]:
+                logging.warning(f"OpenRouter: задача '{task}' выполнена резервной моделью {used_model}.")
+            return True, content, total_tokens
+        last_error = content
+        logging.warning(f"OpenRouter: модель {used_model} не справилась с задачей '{task}', пробуем следующую.")
+    return False, last_error, total_tokens
+
+
+def route_retry_after(task: str) -> float:
+    """
+    Через сколько секунд у задачи task появится хотя бы одна доступная модель
+    (0 — доступна уже сейчас). Позволяет сценариям отложить запуск, не тратя время и деньги.
+    """
+    models = OPENROUTER_MODEL_ROUTES.get(task, [OPENROUTER_MODEL])
+    return min(get_breaker("openrouter", m).retry_after() for m in models)
+
+
+async def generate_content_robust(prompt: str, task: str = "styling", temperature: float = 0.7,
+                                  force_cache: bool = False) -> tuple[bool, str, int]:
+    """
+    Универсальная функция для генерации контента с обработкой ошибок через OpenRouter.
+    task определяет маршрут моделей (см. OPENROUTER_MODEL_ROUTES).
+    При включенном COMPLETION_CACHE_ENABLED одинаковые промпты отвечаются из кэша; ответы
+    при высокой температуре кэшируются только с force_cache=True.
+    Возвращает статус успеха, сгенерированный текст и количество токенов (0 при ответе из кэша).
+    """
+    use_cache = is_cacheable(temperature, force_cache)
+    # Ключ кэша — по основной модели маршрута задачи
+    model = OPENROUTER_MODEL_ROUTES.get(task, [OPENROUTER_MODEL])[0]
+    if use_cache:
+        cached = await get_cached_completion(model, prompt, temperature)
+        if cached:
+            return True, cached[0], 0
+
+    success, content, token_count = await _route_chat_completion(
+        task, [{"role": "user", "content": prompt}], temperature=temperature, max_tokens=800
+    )
+    if success and use_cache:
+        await store_completion(model, prompt, temperature, content, token_count)
+    return success, content, token_count
+
 def is_article_url(url: str) -> bool:
     """
     Проверяет, является ли URL ссылкой на конкретную статью (а не на главную страницу).
@@ -107,20 +498,43 @@ async def generate_style_passport_from_text(posts_text: str, lang_code: str) ->
     """
     from bot.config import MAX_CHARS_FOR_PASSPORT
 
+    model = OPENROUTER_MODEL_ROUTES["style_passport"][0]
+    posts_text = trim_to_token_budget(posts_text, PASSPORT_POSTS_TOKEN_BUDGET, model)
     prompt = get_text(lang_code, "style_passport_ai_prompt", 
                        MAX_CHARS_FOR_PASSPORT=MAX_CHARS_FOR_PASSPORT, 
                        posts_text=posts_text)
     
-    success, passport_text, token_count = await generate_content_robust(prompt)
+    # Повтор с теми же постами (после ошибки Telegram или из другого канала) не должен оплачиваться дважды
+    success, passport_text, token_count = await generate_content_robust(prompt, task="style_passport", force_cache=True)
     
     # Логирование в usage_ledger для учета стоимости паспорта стиля (дешевая модель)
     # Замечание: тут нет db_pool в контексте, поэтому логирование делается в местах вызова,
     # где db_pool доступен (например, в хендлерах). Эта функция возвращает токены.
     return success, passport_text, token_count
 
-async def select_best_articles_from_search_results(articles: list[dict], lang_code: str) -> tuple[bool, list[str], int]:
+async def refine_style_passport(style_passport: str, posts_text: str, lang_code: str) -> tuple[bool, str, int]:
+    """
+    Инкрементально обновляет "Паспорт стиля": отправляет текущий паспорт и только новые посты
+    и просит вернуть объединенную версию. Обходится в разы дешевле генерации с нуля.
+    """
+    model = OPENROUTER_MODEL_ROUTES["style_passport"][0]
+    prompt = get_text(lang_code, "style_passport_refine_ai_prompt",
+                      style_passport=trim_to_token_budget(style_passport, PASSPORT_REFINE_PASSPORT_TOKEN_BUDGET, model),
+                      posts_text=trim_to_token_budget(posts_text, PASSPORT_REFINE_POSTS_TOKEN_BUDGET, model))
+    return await _route_chat_completion(
+        "style_passport", [{"role": "user", "content": prompt}], temperature=0.5, max_tokens=PASSPORT_REFINE_MAX_TOKENS
+    )
+
+# Ответ выбора статей: список URL
+ARTICLE_SELECTION_SCHEMA = {"type": "array", "items": {"type": "string"}}
+
+async def select_best_articles_from_search_results(articles: list[dict], lang_code: str,
+                                                   query: RankingQuery | None = None) -> tuple[bool, list[str], int]:
     """
-    Использует ИИ для выбора 3 лучших статей из списка результатов поиска.
+    Выбирает 3 лучшие статьи из списка результатов поиска.
+    Если передан query (запрос сценария, см. ranking.get_scenario_query), статьи ранжируются
+    локально по BM25 без токенов, а ИИ решает только ничьи — когда оценки на границе тройки
+    отличаются меньше чем на RANKING_TIE_MARGIN. Без query выбор целиком делает ИИ.
     Возвращает статус успеха, список URL выбранных статей и количество токенов.
     """
     if not articles:
@@ -133,131 +547,370 @@ async def select_best_articles_from_search_results(articles: list[dict], lang_co
         logging.warning("После фильтрации корневых ссылок не осталось статей для выбора ИИ.")
         return True, [], 0
 
+    if query is None or not query.terms:
+        return await _select_articles_via_llm(filtered_input_articles, lang_code)
+
+    ranked = rank_articles(filtered_input_articles, query)
+    if not ranked or ranked[0][0] <= 0:
+        logging.info("Локальное ранжирование не нашло совпадений с запросом сценария, выбор статей передан ИИ.")
+        return await _select_articles_via_llm(filtered_input_articles, lang_code)
+    if len(ranked) <= 3:
+        return True, [article['url'] for _, article in ranked], 0
+
+    cutoff = ranked[2][0]
+    margin = cutoff * RANKING_TIE_MARGIN
+    sure = [article for score, article in ranked if score > cutoff + margin][:3]
+    tied = [article for score, article in ranked if abs(score - cutoff) <= margin and article not in sure]
+    needed = 3 - len(sure)
+    if len(tied) <= needed:
+        return True, [article['url'] for _, article in ranked[:3]], 0
+
+    # Ничья на границе тройки: ИИ выбирает только среди спорных статей
+    logging.info(f"Выбор статей: ничья между {len(tied)} статьями за {needed} мест, решает ИИ.")
+    success, llm_urls, token_count = await _select_articles_via_llm(tied, lang_code)
+    tied_urls = [article['url'] for article in tied]
+    chosen = [url for url in llm_urls if url in tied_urls][:needed] if success else []
+    # Если ИИ не справился или вернул меньше, добираем по локальному рейтингу
+    chosen += [url for url in tied_urls if url not in chosen][:needed - len(chosen)]
+    return True, [article['url'] for article in sure] + chosen, token_count
+
+
+async def _select_articles_via_llm(filtered_input_articles: list[dict], lang_code: str) -> tuple[bool, list[str], int]:
+    """Выбор до 3 статей моделью по URL, заголовкам и сниппетам."""
+    # Статьи идут в порядке выдачи поиска: хвост, не влезающий в лимит токенов, отбрасываем
+    model = OPENROUTER_MODEL_ROUTES["article_selection"][0]
     formatted_articles = []
+    used_tokens = 0
     for i, article in enumerate(filtered_input_articles):
-        formatted_articles.append(
+        formatted = (
             f"Article {i+1}:\n"
             f"URL: {article.get('url')}\n"
             f"Title: {article.get('title')}\n"
             f"Snippet: {article.get('passages')}\n"
         )
+        used_tokens += estimate_tokens(formatted, model)
+        if formatted_articles and used_tokens > ARTICLE_LIST_TOKEN_BUDGET:
+            logging.info(f"Выбор статей: в лимит токенов вошло {len(formatted_articles)} из {len(filtered_input_articles)} статей.")
+            break
+        formatted_articles.append(formatted)
     
     articles_list_str = "\n---\n".join(formatted_articles)
     
     prompt = get_text(lang_code, "article_selection_ai_prompt", articles_list=articles_list_str)
     
-    success, raw_response, token_count = await generate_content_robust(prompt)
+    success, raw_response, token_count = await generate_content_robust(prompt, task="article_selection", force_cache=True)
     
     if success:
-        try:
-            selected_urls = json.loads(raw_response)
-            # Убедимся, что это список строк и не более 3-х элементов
-            if isinstance(selected_urls, list) and all(isinstance(url, str) for url in selected_urls):
-                # Удаляем пост-фильтрацию, так как входные статьи уже отфильтрованы.
-                # filtered_urls = [url for url in selected_urls if is_article_url(url)]
-                return True, selected_urls[:3], token_count
-            else:
-                logging.error(f"ИИ вернул некорректный формат для выбора статей: {raw_response}")
-                return False, [], token_count
-        except json.JSONDecodeError as e:
-            logging.error(f"Ошибка парсинга JSON от ИИ при выборе статей: {e}. Ответ: {raw_response}")
-            return False, [], token_count
+        # Ожидаем список строк; ответ в ограждении ```json или с пояснениями тоже принимаем
+        selected_urls = extract_json(raw_response, ARTICLE_SELECTION_SCHEMA)
+        if selected_urls is not None:
+            # Удаляем пост-фильтрацию, так как входные статьи уже отфильтрованы.
+            # filtered_urls = [url for url in selected_urls if is_article_url(url)]
+            return True, selected_urls[:3], token_count
+        logging.error(f"ИИ вернул некорректный формат для выбора статей: {raw_response}")
+        return False, [], token_count
     else:
         return False, [], token_count
 
 
-async def generate_post_via_sonar(theme: str, keywords: list[str], lang_code: str,
-                                  style_passport: str = "",
-                                  activity_description: str = "",
-                                  generation_language: str = "") -> tuple[bool, dict, int]:
+# Ответ Sonar: {"posts": [...]}; схема передается провайдеру как response_format
+SONAR_RESPONSE_SCHEMA = {
+    "type": "object",
+    "required": ["posts"],
+    "properties": {
+        "posts": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["title", "body", "image_query", "source_url"],
+                "properties": {
+                    "title": {"type": "string"},
+                    "body": {"type": "string"},
+                    "image_query": {"type": "string"},
+                    "source_url": {"type": "string"},
+                },
+            },
+        },
+    },
+}
+# Минимум, без которого пост не годится для публикации (остальные поля дополняются при нормализации)
+SONAR_POST_SCHEMA = {
+    "type": "object",
+    "required": ["body", "source_url"],
+    "properties": {"body": {"type": "string"}, "source_url": {"type": "string"}},
+}
+# Что принимается из ответа Sonar: {"posts": [...]}, список постов или одиночный пост.
+# Без схемы extract_json вернул бы первую разбираемую скобку — например, сноску [1] в пояснении
+SONAR_PARSED_SCHEMA = {
+    "anyOf": [
+        {"type": "object", "required": ["posts"], "properties": {"posts": {"type": "array", "items": {"type": "object"}, "minItems": 1}}},
+        {"type": "array", "items": {"type": "object"}, "minItems": 1},
+        SONAR_POST_SCHEMA,
+    ],
+}
+# Пост по статье: источник известен заранее, от модели нужен хотя бы текст
+ARTICLE_POST_SCHEMA = {"type": "object", "required": ["body"], "properties": {"body": {"type": "string"}}}
+
+
+def _normalize_sonar_post(post: dict) -> dict:
+    """Принудительно режет поля поста Sonar по лимитам."""
+    return {
+        "title": (post.get("title") or "")[:MAX_TITLE_CHARS],
+        "body": (post.get("body") or "")[:MAX_BODY_CHARS],
+        "image_query": (post.get("image_query") or "")[:MAX_IMAGE_QUERY_CHARS],
+        "source_url": (post.get("source_url") or "").strip(),
+    }
+
+
+# Общие для всех каналов правила и формат ответа Sonar. Идут первыми в system-сообщении,
+# чтобы провайдер мог переиспользовать закэшированный префикс промпта между запусками.
+SONAR_SYSTEM_RULES = (
+    f"You are Perplexity Sonar web search assistant.\n"
+    f"Ты помощник-редактор. Ищешь в интернете актуальные новости (каждая из своего источника), "
+    f"опубликованные не ранее чем 12 часов назад, и пишешь по ним посты. Верни строго JSON без пояснений.\n\n"
+    f"Требования:\n"
+    f"- Источник должен быть текстовая статья, не видео.\n"
+    f"- Дата публикации должна быть в пределах последних 12 часов. Игнорируй результаты старше.\n"
+    f"- Проверь реальность источника (известные СМИ/блоги).\n"
+    f"- Для каждой новости сгенерируй структурированный пост. Используй только теги Telegram HTML: <b>, <i>, <u>, <s>, <a>, <code>, <pre>.\n"
+    f"- Упорядочи посты от самого интересного к менее интересному. Лучше меньше постов, чем несвежие.\n"
+    f"- Соблюдай лимиты символов.\n\n"
+    f"Формат JSON строго такой:\n"
+    f"{{\n"
+    f"  \"posts\": [\n"
+    f"    {{\n"
+    f"      \"title\": string (<= {MAX_TITLE_CHARS} chars),\n"
+    f"      \"body\": string (<= {MAX_BODY_CHARS} chars),\n"
+    f"      \"image_query\": string (<= {MAX_IMAGE_QUERY_CHARS} chars),\n"
+    f"      \"source_url\": string (valid URL to the article)\n"
+    f"    }}\n"
+    f"  ]\n"
+    f"}}\n\n"
+    f"Правила оформления:\n"
+    f"- title — короткий, цепляющий, без эмодзи.\n"
+    f"- body — информативно и лаконично, без воды и клише; допускаются только указанные теги Telegram HTML.\n"
+    f"- image_query — краткий запрос для поиска иллюстрации по теме новости.\n"
+    f"- Не выходи за лимиты символов. Если нужно — укорачивай.\n"
+    f"- Верни ТОЛЬКО JSON."
+)
+
+# Скомпилированные system-сообщения Sonar по каналам: channel_id -> (отпечаток настроек, текст)
+_channel_prompt_prefixes: dict[int, tuple[str, str]] = {}
+
+
+def _channel_prompt_fingerprint(*parts: str) -> str:
+    return hashlib.sha256("\x00".join(parts).encode()).hexdigest()
+
+
+def _build_sonar_system_prompt(lang_code: str, style_passport: str, activity_description: str, generation_language: str,
+                               style_passport_tokens: int | None, activity_description_tokens: int | None) -> str:
+    """Собирает статическую для канала часть промпта: общие правила, затем паспорт стиля, описание и язык."""
+    model = OPENROUTER_MODEL_ROUTES["discovery"][0]
+    safe_passport = trim_to_token_budget(
+        (style_passport or "").strip()[:MAX_STYLE_PASSPORT_CHARS], STYLE_PASSPORT_TOKEN_BUDGET, model,
+        known_tokens=style_passport_tokens if len(style_passport or "") <= MAX_STYLE_PASSPORT_CHARS else None
+    )
+    safe_activity = trim_to_token_budget(
+        (activity_description or "").strip()[:MAX_ACTIVITY_DESCRIPTION_CHARS], ACTIVITY_DESCRIPTION_TOKEN_BUDGET, model,
+        known_tokens=activity_description_tokens if len(activity_description or "") <= MAX_ACTIVITY_DESCRIPTION_CHARS else None
+    )
+    safe_generation_lang = (generation_language or lang_code or "ru").strip()[:MAX_GENERATION_LANGUAGE_CHARS]
+    locale = "ru" if (safe_generation_lang or "ru").startswith("ru") else "en"
+    return (
+        f"{SONAR_SYSTEM_RULES}\n\n"
+        f"Язык ответа: {locale}.\n"
+        f"Паспорт стиля: {safe_passport}\n"
+        f"Описание канала/деятельности: {safe_activity}\n"
+        f"Язык генерации: {safe_generation_lang}"
+    )
+
+
+def get_channel_prompt_prefix(channel_id: int | None, lang_code: str, style_passport: str = "",
+                              activity_description: str = "", generation_language: str = "",
+                              style_passport_tokens: int | None = None,
+                              activity_description_tokens: int | None = None) -> str:
     """
-    Использует Perplexity Sonar через OpenRouter для поиска свежей новости (<=12 часов)
-    по теме и тегам, и генерирует готовый пост. Возвращает (success, data, tokens),
-    где data = { title, body, image_query, source_url } с ограничениями по длине.
+    Возвращает system-сообщение Sonar для канала, собирая его только при первом обращении
+    или после изменения паспорта стиля, описания или языка генерации.
+    """
+    if channel_id is None:
+        return _build_sonar_system_prompt(lang_code, style_passport, activity_description, generation_language,
+                                          style_passport_tokens, activity_description_tokens)
+    fingerprint = _channel_prompt_fingerprint(lang_code or "", style_passport or "", activity_description or "", generation_language or "")
+    cached = _channel_prompt_prefixes.get(channel_id)
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+    prefix = _build_sonar_system_prompt(lang_code, style_passport, activity_description, generation_language,
+                                        style_passport_tokens, activity_description_tokens)
+    _channel_prompt_prefixes[channel_id] = (fingerprint, prefix)
+    logging.debug(f"Промпт Sonar для канала {channel_id} собран заново.")
+    return prefix
+
+
+def invalidate_channel_prompt(channel_id: int):
+    """Сбрасывает закэшированный промпт канала (после смены паспорта стиля, описания или языка)."""
+    _channel_prompt_prefixes.pop(channel_id, None)
+
+
+async def generate_posts_via_sonar(theme: str, keywords: list[str], lang_code: str,
+                                   style_passport: str = "",
+                                   activity_description: str = "",
+                                   generation_language: str = "",
+                                   max_candidates: int = SONAR_CANDIDATES_PER_REQUEST,
+                                   on_image_query: Callable[[str], None] | None = None,
+                                   style_passport_tokens: int | None = None,
+                                   activity_description_tokens: int | None = None,
+                                   channel_id: int | None = None) -> tuple[bool, dict, int]:
+    """
+    Использует Perplexity Sonar через OpenRouter для поиска до max_candidates свежих новостей
+    (<=12 часов) по теме и тегам и генерирует по каждой готовый пост. Возвращает (success, data, tokens),
+    где data = { "posts": [{ title, body, image_query, source_url }, ...] } с ограничениями по длине
+    (посты в порядке убывания релевантности) или { "error": ... } в случае ошибки.
+    data["sonar_requests"] — сколько платных Sonar-запросов реально отправлено (с учетом хеджа и резервных моделей).
+    В потоковом режиме (OPENROUTER_STREAMING) on_image_query вызывается с image_query первого поста,
+    как только он получен, чтобы поиск картинки стартовал до окончания генерации.
+    style_passport_tokens/activity_description_tokens — заранее посчитанные оценки токенов
+    из таблицы channels; если переданы, оценка для неизмененного текста не пересчитывается.
+    Если передан channel_id, статическая часть промпта берется из кэша канала.
     """
     if not OPENROUTER_API_KEY:
         logging.critical("КРИТИЧЕСКАЯ ОШИБКА: OPENROUTER_API_KEY не найден. Генерация ИИ невозможна.")
         return False, {"error": "API key missing"}, 0
 
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "http://localhost:3000",
-    }
+    max_candidates = max(1, max_candidates)
 
     # Ограничим длину входных данных на всякий случай
     safe_theme = (theme or "").strip()[:200]
     safe_keywords = [k.strip()[:100] for k in (keywords or [])][:10]
-    safe_passport = (style_passport or "").strip()[:MAX_STYLE_PASSPORT_CHARS]
-    safe_activity = (activity_description or "").strip()[:MAX_ACTIVITY_DESCRIPTION_CHARS]
-    safe_generation_lang = (generation_language or lang_code or "ru").strip()[:MAX_GENERATION_LANGUAGE_CHARS]
 
-    # Промпт с жесткими требованиями по свежести и формату
-    locale = "ru" if (safe_generation_lang or "ru").startswith("ru") else "en"
+    system_prompt = get_channel_prompt_prefix(
+        channel_id, lang_code, style_passport, activity_description, generation_language,
+        style_passport_tokens, activity_description_tokens
+    )
+    # Меняющаяся от запуска к запуску часть промпта — в самом конце
     instructions = (
-        f"Ты помощник-редактор. Найди в интернете ОДНУ актуальную новость, опубликованную не ранее чем 12 часов назад, "
-        f"по теме и ключевым словам. Верни строго JSON без пояснений. Язык ответа: {locale}.\n\n"
+        f"Найди до {max_candidates} РАЗНЫХ актуальных новостей по теме и ключевым словам.\n"
         f"Тема: {safe_theme}\n"
-        f"Ключевые слова: {', '.join(safe_keywords)}\n"
-        f"Паспорт стиля: {safe_passport}\n"
-        f"Описание канала/деятельности: {safe_activity}\n"
-        f"Язык генерации: {safe_generation_lang}\n\n"
-        f"Требования:\n"
-        f"- Источник должен быть текстовая статья, не видео.\n"
-        f"- Дата публикации должна быть в пределах последних 12 часов. Игнорируй результаты старше.\n"
-        f"- Проверь реальность источника (известные СМИ/блоги).\n"
-        f"- Сгенерируй структурированный пост. Используй только теги Telegram HTML: <b>, <i>, <u>, <s>, <a>, <code>, <pre>.\n"
-        f"- Соблюдай лимиты символов.\n\n"
-        f"Формат JSON строго такой:\n"
-        f"{{\n"
-        f"  \"title\": string (<= {MAX_TITLE_CHARS} chars),\n"
-        f"  \"body\": string (<= {MAX_BODY_CHARS} chars),\n"
-        f"  \"image_query\": string (<= {MAX_IMAGE_QUERY_CHARS} chars),\n"
-        f"  \"source_url\": string (valid URL to the article)\n"
-        f"}}\n\n"
-        f"Правила оформления:\n"
-        f"- title — короткий, цепляющий, без эмодзи.\n"
-        f"- body — информативно и лаконично, без воды и клише; допускаются только указанные теги Telegram HTML.\n"
-        f"- image_query — краткий запрос для поиска иллюстрации по теме новости.\n"
-        f"- Не выходи за лимиты символов. Если нужно — укорачивай.\n"
-        f"- Верни ТОЛЬКО JSON."
+        f"Ключевые слова: {', '.join(safe_keywords)}"
     )
 
-    payload = {
-        "model": OPENROUTER_SONAR_MODEL,
-        "messages": [
-            {"role": "system", "content": "You are Perplexity Sonar web search assistant."},
-            {"role": "user", "content": instructions}
-        ],
-        "temperature": 0.2,
-        "max_tokens": 800
-    }
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": instructions}
+    ]
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{OPENROUTER_API_BASE}/chat/completions", headers=headers, json=payload, timeout=60) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    content = data.get("choices", [{}])[0].get("message", {}).get("content", "")
-                    token_count = data.get("usage", {}).get("total_tokens", 0)
-                    # Попытка распарсить JSON из ответа
-                    try:
-                        parsed = json.loads(content)
-                        # Принудительно режем по лимитам
-                        parsed["title"] = (parsed.get("title") or "")[:MAX_TITLE_CHARS]
-                        parsed["body"] = (parsed.get("body") or "")[:MAX_BODY_CHARS]
-                        parsed["image_query"] = (parsed.get("image_query") or "")[:MAX_IMAGE_QUERY_CHARS]
-                        return True, parsed, token_count
-                    except Exception:
-                        logging.error(f"Sonar вернул не-JSON: {content}")
-                        return False, {"error": "Non-JSON from Sonar"}, token_count
-                else:
-                    error_text = await response.text()
-                    logging.error(f"Ошибка Sonar(OpenRouter) API: Статус {response.status}, Тело: {error_text}")
-                    return False, {"error": error_text}, 0
-    except aiohttp.ClientError as e:
-        logging.critical(f"Сетевая ошибка Sonar(OpenRouter): {e}", exc_info=True)
-        return False, {"error": str(e)}, 0
-    except Exception as e:
-        logging.critical(f"Исключение при генерации через Sonar: {e}", exc_info=True)
-        return False, {"error": str(e)}, 0
\ No newline at end of file
+    image_query_sent = False
+
+    def on_field(key: str, value: str):
+        nonlocal image_query_sent
+        if key == "image_query" and value and not image_query_sent and on_image_query:
+            image_query_sent = True
+            on_image_query(value[:MAX_IMAGE_QUERY_CHARS])
+
+    usage = {}
+    success, content, token_count = await _route_chat_completion(
+        "discovery", messages, temperature=0.2, max_tokens=800 * max_candidates,
+        parser_factory=lambda: _IncrementalJsonFieldParser(on_field=on_field, max_body_chars=MAX_BODY_CHARS),
+        response_schema=SONAR_RESPONSE_SCHEMA, usage=usage
+    )
+    sonar_requests = usage.get("sonar_requests", 0)
+    if not success:
+        logging.error(f"Ошибка генерации через Sonar: {content}")
+        return False, {"error": content, "sonar_requests": sonar_requests}, token_count
+
+    # Извлекаем JSON из ответа: ограждения, пояснения, сноски и обрыв на середине не мешают
+    parsed = extract_json(content, SONAR_PARSED_SCHEMA)
+    if parsed is None:
+        logging.error(f"Sonar вернул не-JSON: {content}")
+        return False, {"error": "Non-JSON from Sonar", "sonar_requests": sonar_requests}, token_count
+
+    # Допускаем и список постов, и одиночный объект поста
+    if isinstance(parsed, dict) and "posts" in parsed:
+        raw_posts = parsed["posts"]
+    elif isinstance(parsed, list):
+        raw_posts = parsed
+    else:
+        raw_posts = [parsed]
+    if not isinstance(raw_posts, list):
+        raw_posts = [raw_posts]
+    # Неполные посты (например, последний в оборванном ответе) отбрасываем
+    posts = [
+        _normalize_sonar_post(p) for p in raw_posts
+        if matches_schema(p, SONAR_POST_SCHEMA) and p["body"].strip() and p["source_url"].strip()
+    ][:max_candidates]
+    if not posts:
+        logging.error(f"Sonar вернул JSON без постов: {content}")
+        return False, {"error": "No posts from Sonar", "sonar_requests": sonar_requests}, token_count
+    return True, {"posts": posts, "sonar_requests": sonar_requests}, token_count
+
+
+async def generate_post_via_sonar(theme: str, keywords: list[str], lang_code: str,
+                                  style_passport: str = "",
+                                  activity_description: str = "",
+                                  generation_language: str = "") -> tuple[bool, dict, int]:
+    """
+    Использует Perplexity Sonar через OpenRouter для поиска свежей новости (<=12 часов)
+    по теме и тегам, и генерирует готовый пост. Возвращает (success, data, tokens),
+    где data = { title, body, image_query, source_url } с ограничениями по длине.
+    """
+    success, data, token_count = await generate_posts_via_sonar(
+        theme, keywords, lang_code,
+        style_passport=style_passport,
+        activity_description=activity_description,
+        generation_language=generation_language,
+        max_candidates=1
+    )
+    if not success:
+        return False, data, token_count
+    return True, data["posts"][0], token_count
+
+
+def _trim_to_remaining_budget(task: str, prompt_without_section: str, section: str) -> str:
+    """
+    Обрезает переменную часть промпта (например, текст статьи) до остатка лимита задачи task
+    после остального промпта — с запасом для самой требовательной модели маршрута.
+    """
+    budget = prompt_budget(task)
+    if not budget:
+        return section
+    route = OPENROUTER_MODEL_ROUTES.get(task, [OPENROUTER_MODEL])
+    # Пара токенов — на многоточие, которым trim_to_token_budget отмечает обрезку
+    remaining = budget - max(estimate_messages_tokens([{"role": "user", "content": prompt_without_section}], m) for m in route) - 2
+    if remaining <= 0:
+        return ""
+    for model in route:
+        section = trim_to_token_budget(section, remaining, model)
+    return section
+
+
+async def generate_post_from_article(article_url: str, article_text: str, theme: str, keywords: list[str], lang_code: str,
+                                     style_passport: str = "", activity_description: str = "") -> tuple[bool, dict, int]:
+    """
+    Пишет пост по уже загруженной статье (путь через поиск XMLRiver, без Sonar).
+    Возвращает (success, data, tokens), где data = { title, body, image_query, source_url } — как у generate_post_via_sonar.
+    """
+    model = OPENROUTER_MODEL_ROUTES["styling"][0]
+    sections = dict(
+        scenario_theme=(theme or "").strip()[:200],
+        scenario_keywords=", ".join(k.strip()[:100] for k in (keywords or [])[:10]),
+        activity_description=trim_to_token_budget(
+            (activity_description or "").strip()[:MAX_ACTIVITY_DESCRIPTION_CHARS], ACTIVITY_DESCRIPTION_TOKEN_BUDGET, model
+        ),
+        style_passport=trim_to_token_budget((style_passport or "").strip()[:MAX_STYLE_PASSPORT_CHARS], STYLE_PASSPORT_TOKEN_BUDGET, model),
+    )
+    # Статье достается остаток лимита задачи: иначе обычная статья не проходит проверку лимита промпта
+    article_text = _trim_to_remaining_budget(
+        "styling", get_text(lang_code, "post_generation_ai_prompt", article_text="", **sections), article_text
+    )
+    if not article_text:
+        logging.error(f"Промпт по статье {article_url} не умещается в лимит токенов задачи 'styling' даже без текста статьи.")
+        return False, {"error": "Prompt exceeds token budget"}, 0
+    prompt = get_text(lang_code, "post_generation_ai_prompt", article_text=article_text, **sections)
+    success, content, token_count = await generate_content_robust(prompt, task="styling")
+    if not success:
+        return False, {"error": content}, token_count
+    parsed = extract_json(content, ARTICLE_POST_SCHEMA)
+    if parsed is None or not parsed["body"].strip():
+        logging.error(f"ИИ вернул некорректный пост по статье {article_url}: {content}")
+        return False, {"error": "Invalid post JSON"}, token_count
+    return True, _normalize_sonar_post({**parsed, "source_url": article_url}), token_count
@@ -0,0 +1,62 @@
+# bot/utils/article_extract.py
+# Чистое (без сети и без конфигурации бота) извлечение текста статьи из HTML.
+# Модуль импортируется в рабочих процессах пула извлечения, поэтому держим его легким.
+
+import os
+import hashlib
+
+from readability import Document
+from bs4 import BeautifulSoup
+
+from bot.utils.tokens import tokenize
+
+# Слов в шингле: перестановка абзацев и правка пары слов почти не меняют набор шинглов
+SHINGLE_SIZE = 3
+FINGERPRINT_BITS = 64
+
+
+def extract_article(html: bytes, encoding: str | None = None) -> tuple[str, str]:
+    """
+    Извлекает заголовок и текст основной статьи из сырого HTML (readability + BeautifulSoup).
+    encoding — кодировка из заголовков или <meta>; без нее readability определяет ее сам.
+    Возвращает (заголовок, текст).
+    """
+    # 1. Обрабатываем HTML с помощью readability (байты декодируются здесь, в рабочем процессе)
+    doc = Document(html.decode(encoding, 'replace') if encoding else html)
+
+    # Получаем заголовок и очищенный HTML основной статьи
+    title = doc.title()
+    clean_html = doc.summary()
+
+    # 2. Извлекаем из чистого HTML только текст с помощью BeautifulSoup
+    soup = BeautifulSoup(clean_html, 'lxml')
+    # separator='\n' вставляет переносы строк между блоками для лучшей читаемости
+    text_content = soup.get_text(separator='\n', strip=True)
+    return title, text_content
+
+
+def simhash(text: str) -> int | None:
+    """64-битный simhash по шинглам из SHINGLE_SIZE слов; None — текста слишком мало."""
+    tokens = tokenize(text)
+    if len(tokens) < SHINGLE_SIZE:
+        return None
+    weights = [0] * FINGERPRINT_BITS
+    for i in range(len(tokens) - SHINGLE_SIZE + 1):
+        shingle = " ".join(tokens[i:i + SHINGLE_SIZE])
+        value = int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+        for bit in range(FINGERPRINT_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    fingerprint = sum(1 << bit for bit in range(FINGERPRINT_BITS) if weights[bit] > 0)
+    # BIGINT в Postgres знаковый
+    return fingerprint - (1 << FINGERPRINT_BITS) if fingerprint >= 1 << (FINGERPRINT_BITS - 1) else fingerprint
+
+
+def article_fingerprint(article: str) -> int | None:
+    """simhash текста статьи из fetch_article_text без строки заголовка."""
+    # У разных изданий заголовок перепечатки обычно свой, поэтому сравниваем только текст
+    return simhash(article.split("\n\n", 1)[-1])
+
+
+def report_worker_pid(pids):
+    """Инициализатор рабочего процесса пула: сообщает свой PID, чтобы зависший процесс можно было завершить."""
+    pids.put(os.getpid())
@@ -1,61 +1,143 @@
-import aiohttp
-from readability import Document
-from bs4 import BeautifulSoup
+import re
+import codecs
 import logging
 from tenacity import retry, wait_exponential, stop_after_attempt, before_sleep_log
 from aiohttp import ClientConnectorError
 import tenacity # Добавляем импорт tenacity
 
+from bot import config
+from bot.utils.http_client import http_session
+from bot.utils.extraction_pool import run_extraction
+from bot.utils.fetch_cache import get_cached_page, conditional_headers, load_cached_html, store_page
+
 logger = logging.getLogger(__name__)
 
-@retry(wait=wait_exponential(multiplier=1, min=4, max=10), stop=stop_after_attempt(5), before_sleep=before_sleep_log(logger, logging.WARNING), reraise=True, retry=(tenacity.retry_if_exception_type(ClientConnectorError)))
-async def get_article_text(url: str) -> str | None:
+# Минимальная длина текста статьи для считания ее валидной
+MIN_ARTICLE_LENGTH = 200
+# Сколько байт страницы читать: текст статьи почти всегда в начале, а многомегабайтные страницы — это мусор
+ARTICLE_MAX_BYTES = config.ARTICLE_MAX_BYTES
+HTML_CONTENT_TYPES = {"text/html", "application/xhtml+xml"}
+# <meta charset="..."> или <meta http-equiv="Content-Type" content="text/html; charset=...">
+_META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?\s*([A-Za-z0-9_.:-]+)""", re.IGNORECASE)
+
+
+def _valid_encoding(name: str | bytes | None) -> str | None:
+    if not name:
+        return None
+    if isinstance(name, bytes):
+        name = name.decode("ascii", "ignore")
+    try:
+        return codecs.lookup(name.strip()).name
+    except LookupError:
+        return None
+
+
+async def _read_html(response, url: str) -> tuple[bytes, str | None] | None:
+    """
+    Читает тело HTML-страницы кусками, не больше ARTICLE_MAX_BYTES; не-HTML (PDF, картинки, видео)
+    отбрасывается по Content-Type без чтения тела. Возвращает (байты, кодировка или None).
+    Кодировка берется из Content-Type, иначе из <meta> в начале страницы.
+    """
+    content_type = response.headers.get("Content-Type", "")
+    mime = content_type.split(";")[0].strip().lower()
+    if mime and mime not in HTML_CONTENT_TYPES:
+        logging.info(f"Страница {url} пропущена: тип содержимого {mime}, а не HTML.")
+        return None
+
+    chunks = []
+    received = 0
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        chunks.append(chunk)
+        received += len(chunk)
+        if received >= ARTICLE_MAX_BYTES:
+            logging.info(f"Страница {url} длиннее {ARTICLE_MAX_BYTES} байт, разбираем только начало.")
+            break
+    html = b"".join(chunks)[:ARTICLE_MAX_BYTES]
+
+    encoding = _valid_encoding(response.charset) if "charset=" in content_type.lower() else None
+    if encoding is None:
+        meta = _META_CHARSET_RE.search(html, 0, 4096)
+        encoding = _valid_encoding(meta.group(1)) if meta else None
+    return html, encoding
+
+
+def _format_article(url: str, title: str | None, text_content: str | None) -> str | None:
+    # Проверяем, достаточно ли текста было извлечено
+    if not text_content or len(text_content) < MIN_ARTICLE_LENGTH:
+        logging.warning(f"Сценарий: Извлеченный текст для {url} слишком короткий ({len(text_content or '')} символов), считаем это неудачным скрапингом.")
+        return None
+    # Соединяем заголовок и текст для полного контекста
+    full_article_text = f"Заголовок: {title}\n\n{text_content}"
+    # Обрезаем текст на всякий случай, чтобы не выйти за лимиты токенов модели
+    return full_article_text[:15000]
+
+
+async def fetch_article_text(url: str) -> str | None:
     """
     Получает чистый текст статьи по URL с помощью локальной библиотеки readability.
+    Страницы и извлеченный текст кэшируются на диске по нормализованному URL: свежая запись
+    отдается сразу, устаревшая перепроверяется условным запросом (ETag / Last-Modified).
     Возвращает очищенный текст или None в случае ошибки.
     """
     if not url:
         return None
 
+    cached = await get_cached_page(url)
+    if cached and cached["fresh"]:
+        logging.debug(f"Текст статьи {url} взят из кэша страниц.")
+        return _format_article(url, cached.get("title"), cached.get("text"))
+
     # Важно! Притворяемся обычным браузером, чтобы нас не блокировали.
     headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+        **conditional_headers(cached),
     }
 
-    async with aiohttp.ClientSession() as session:
+    async with http_session() as session:
         # Устанавливаем таймаут, чтобы не ждать вечно "зависшие" сайты
         async with session.get(url, headers=headers, timeout=20) as response:
-            if response.status == 200:
-                # Получаем сырой HTML страницы
-                html_content = await response.text()
-                
-                # 1. Обрабатываем HTML с помощью readability
-                doc = Document(html_content)
-                
-                # Получаем заголовок и очищенный HTML основной статьи
-                title = doc.title()
-                clean_html = doc.summary()
-                
-                logging.debug(f"Readability clean HTML for {url}: {clean_html[:1000]}...") # Логируем первые 1000 символов
-                
-                # 2. Извлекаем из чистого HTML только текст с помощью BeautifulSoup
-                soup = BeautifulSoup(clean_html, 'lxml')
-                # .get_text() гениально извлекает весь текст из тегов
-                # separator='\n' вставляет переносы строк между блоками для лучшей читаемости
-                text_content = soup.get_text(separator='\n', strip=True)
-                
-                # Соединяем заголовок и текст для полного контекста
-                full_article_text = f"Заголовок: {title}\n\n{text_content}"
-                
-                # Проверяем, достаточно ли текста было извлечено
-                MIN_ARTICLE_LENGTH = 200 # Минимальная длина текста статьи для считания ее валидной
-                if len(text_content) < MIN_ARTICLE_LENGTH:
-                    logging.warning(f"Сценарий: Извлеченный текст для {url} слишком короткий ({len(text_content)} символов), считаем это неудачным скрапингом.")
+            status = response.status
+            if status == 200:
+                # Получаем сырой HTML страницы: потоково, не больше ARTICLE_MAX_BYTES и только HTML
+                page = await _read_html(response, url)
+                if page is None:
                     return None
-                
-                print(f"Успешно извлечен текст статьи с URL: {url}")
-                # Обрезаем текст на всякий случай, чтобы не выйти за лимиты токенов модели
-                return full_article_text[:15000]
-            else:
-                print(f"Ошибка при загрузке страницы: Статус {response.status} для URL: {url}")
-                return None
\ No newline at end of file
+                html_content, encoding = page
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+            elif status != 304 or not cached:
+                logging.warning(f"Ошибка при загрузке страницы: Статус {status} для URL: {url}")
+                return None
+
+    if status == 304:
+        # Страница не изменилась: используем сохраненный текст (или извлекаем его из сохраненного HTML)
+        logging.debug(f"Страница {url} не изменилась, используем кэш.")
+        title, text_content = cached.get("title"), cached.get("text")
+        if text_content is None:
+            html_content = await load_cached_html(cached)
+            extracted = await run_extraction(html_content, cached.get("encoding")) if html_content else None
+            if extracted is None:
+                # Таймаут или сбой пула — временная неудача: запись не освежаем, в следующий раз попробуем снова
+                return None
+            title, text_content = extracted
+        await store_page(url, None, None, None, title, text_content, entry=cached)
+        return _format_article(url, title, text_content)
+
+    # Разбор идет в пуле извлечения, не блокируя цикл событий
+    extracted = await run_extraction(html_content, encoding)
+    if extracted is None:
+        # Таймаут или сбой пула извлечения — временная неудача, ее не кэшируем
+        return None
+    title, text_content = extracted
+    # Сохраняем и слишком короткий текст: повторное извлечение той же страницы дало бы тот же результат
+    await store_page(url, html_content, etag, last_modified, title, text_content, encoding=encoding)
+    article = _format_article(url, title, text_content)
+    if article:
+        logging.debug(f"Успешно извлечен текст статьи с URL: {url}")
+    return article
+
+
+@retry(wait=wait_exponential(multiplier=1, min=4, max=10), stop=stop_after_attempt(5), before_sleep=before_sleep_log(logger, logging.WARNING), reraise=True, retry=(tenacity.retry_if_exception_type(ClientConnectorError)))
+async def get_article_text(url: str) -> str | None:
+    """fetch_article_text с повторами при ошибках соединения — для загрузки одной статьи."""
+    return await fetch_article_text(url)
@@ -0,0 +1,152 @@
+# bot/utils/circuit_breaker.py
+
+import time
+import logging
+from collections import deque
+
+from bot import config
+
+CIRCUIT_BREAKER_WINDOW_SECONDS = config.CIRCUIT_BREAKER_WINDOW_SECONDS
+CIRCUIT_BREAKER_MIN_CALLS = config.CIRCUIT_BREAKER_MIN_CALLS
+CIRCUIT_BREAKER_ERROR_RATE = config.CIRCUIT_BREAKER_ERROR_RATE
+CIRCUIT_BREAKER_SLOW_CALL_SECONDS = config.CIRCUIT_BREAKER_SLOW_CALL_SECONDS
+CIRCUIT_BREAKER_SLOW_CALL_RATE = config.CIRCUIT_BREAKER_SLOW_CALL_RATE
+CIRCUIT_BREAKER_OPEN_SECONDS = config.CIRCUIT_BREAKER_OPEN_SECONDS
+CIRCUIT_BREAKER_MAX_OPEN_SECONDS = config.CIRCUIT_BREAKER_MAX_OPEN_SECONDS
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для одного внешнего провайдера/эндпоинта.
+    Ведет скользящее окно исходов и длительностей запросов. Если доля ошибок или медленных
+    ответов превышает порог, цепь размыкается и запросы сразу отклоняются. По истечении
+    времени размыкания пропускается один пробный запрос (half-open): успех замыкает цепь,
+    ошибка размыкает ее снова на вдвое больший срок (но не дольше CIRCUIT_BREAKER_MAX_OPEN_SECONDS).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CLOSED
+        self._events: deque = deque()  # (время, успех, длительность)
+        self._opened_at = 0.0
+        self._open_seconds = CIRCUIT_BREAKER_OPEN_SECONDS
+        self._probe_in_flight = False
+        self._probe_ticket: object | None = None
+
+    def _trim(self, now: float):
+        while self._events and now - self._events[0][0] > CIRCUIT_BREAKER_WINDOW_SECONDS:
+            self._events.popleft()
+
+    def retry_after(self) -> float:
+        """Через сколько секунд цепь перейдет в half-open (0 — запросы уже разрешены)."""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self._open_seconds - time.monotonic())
+
+    def allow_request(self) -> object:
+        """
+        Можно ли сейчас выполнить запрос. В half-open пропускает только один пробный запрос.
+        Возвращает ложное значение, если запрос не разрешен, иначе — билет запроса для release().
+        """
+        if self.state == OPEN:
+            if self.retry_after() > 0:
+                return False
+            self.state = HALF_OPEN
+            logging.warning(f"Circuit breaker '{self.name}': пробный запрос после размыкания.")
+        if self.state == HALF_OPEN:
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            self._probe_ticket = object()
+            return self._probe_ticket
+        return True
+
+    def record_success(self, latency: float):
+        now = time.monotonic()
+        if self.state == HALF_OPEN:
+            self._probe_in_flight = False
+            self._probe_ticket = None
+            self.state = CLOSED
+            self._events.clear()
+            self._open_seconds = CIRCUIT_BREAKER_OPEN_SECONDS
+            logging.warning(f"Circuit breaker '{self.name}': провайдер снова доступен, цепь замкнута.")
+        self._events.append((now, True, latency))
+        self._trim(now)
+        self._evaluate(now)
+
+    def record_failure(self, latency: float):
+        now = time.monotonic()
+        if self.state == HALF_OPEN:
+            self._probe_in_flight = False
+            self._probe_ticket = None
+            self._open_seconds = min(self._open_seconds * 2, CIRCUIT_BREAKER_MAX_OPEN_SECONDS)
+            self._open(now)
+            return
+        self._events.append((now, False, latency))
+        self._trim(now)
+        self._evaluate(now)
+
+    def release(self, ticket: object):
+        """Освобождает пробный слот, если отменен, не дав исхода, именно пробный запрос (билет из allow_request)."""
+        if ticket is not None and ticket is self._probe_ticket:
+            self._probe_in_flight = False
+            self._probe_ticket = None
+
+    def _evaluate(self, now: float):
+        if self.state != CLOSED or len(self._events) < CIRCUIT_BREAKER_MIN_CALLS:
+            return
+        total = len(self._events)
+        error_rate = sum(1 for _, ok, _ in self._events if not ok) / total
+        slow_rate = sum(1 for _, _, latency in self._events if latency >= CIRCUIT_BREAKER_SLOW_CALL_SECONDS) / total
+        if error_rate >= CIRCUIT_BREAKER_ERROR_RATE or slow_rate >= CIRCUIT_BREAKER_SLOW_CALL_RATE:
+            self._open(now)
+            logging.error(
+                f"Circuit breaker '{self.name}': провайдер нездоров (ошибок {error_rate:.0%}, медленных {slow_rate:.0%} "
+                f"из {total} запросов), запросы отклоняются на {self._open_seconds:.0f} сек."
+            )
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self._opened_at = now
+        self._events.clear()
+
+    def health_score(self) -> float:
+        """Оценка здоровья от 0 до 1: доля успешных и не медленных запросов в окне."""
+        if self.state == OPEN:
+            return 0.0
+        self._trim(time.monotonic())
+        if not self._events:
+            return 1.0
+        good = sum(1 for _, ok, latency in self._events if ok and latency < CIRCUIT_BREAKER_SLOW_CALL_SECONDS)
+        return good / len(self._events)
+
+    def snapshot(self) -> dict:
+        latencies = [latency for _, ok, latency in self._events if ok]
+        return {
+            "name": self.name,
+            "state": self.state,
+            "health": self.health_score(),
+            "calls": len(self._events),
+            "avg_latency": sum(latencies) / len(latencies) if latencies else 0.0,
+            "retry_after": self.retry_after(),
+        }
+
+
+# Реестр предохранителей: "провайдер:эндпоинт" -> CircuitBreaker
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(provider: str, endpoint: str) -> CircuitBreaker:
+    name = f"{provider}:{endpoint}"
+    if name not in _breakers:
+        _breakers[name] = CircuitBreaker(name)
+    return _breakers[name]
+
+
+def breaker_states() -> list[dict]:
+    """Состояния всех предохранителей — для /health."""
+    return [breaker.snapshot() for _, breaker in sorted(_breakers.items())]
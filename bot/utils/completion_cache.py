@@ -0,0 +1,106 @@
+# bot/utils/completion_cache.py
+
+import re
+import json
+import time
+import hashlib
+import logging
+import unicodedata
+from redis import asyncio as aioredis
+
+from bot import config
+
+COMPLETION_CACHE_ENABLED = config.COMPLETION_CACHE_ENABLED
+COMPLETION_CACHE_TTL_SECONDS = config.COMPLETION_CACHE_TTL_SECONDS
+COMPLETION_CACHE_MAX_ENTRIES = config.COMPLETION_CACHE_MAX_ENTRIES
+# Ответы при температуре выше этой считаются недетерминированными и не кэшируются без force
+COMPLETION_CACHE_MAX_TEMPERATURE = config.COMPLETION_CACHE_MAX_TEMPERATURE
+
+KEY_PREFIX = "completion_cache:"
+INDEX_KEY = "completion_cache:index"  # ZSET: ключ записи -> время сохранения (для ограничения размера)
+STATS_KEY = "completion_cache:stats"  # HASH: hits, misses, tokens_saved
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_redis = None
+
+
+def _client():
+    global _redis
+    if _redis is None:
+        _redis = aioredis.from_url(config.REDIS_URL, decode_responses=True)
+    return _redis
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Нормализует промпт: Unicode NFC и схлопывание пробельных символов — такие промпты считаются одинаковыми."""
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFC", prompt or "")).strip()
+
+
+def cache_key(model: str, prompt: str, temperature: float) -> str:
+    digest = hashlib.sha256(normalize_prompt(prompt).encode()).hexdigest()
+    return f"{KEY_PREFIX}{model}:{temperature:.2f}:{digest}"
+
+
+def is_cacheable(temperature: float, force: bool = False) -> bool:
+    return COMPLETION_CACHE_ENABLED and (force or temperature <= COMPLETION_CACHE_MAX_TEMPERATURE)
+
+
+async def get_cached_completion(model: str, prompt: str, temperature: float) -> tuple[str, int] | None:
+    """Возвращает (текст, токены исходного запроса) из кэша или None. Ошибки Redis не мешают генерации."""
+    key = cache_key(model, prompt, temperature)
+    try:
+        redis = _client()
+        raw = await redis.get(key)
+        if raw is None:
+            await redis.hincrby(STATS_KEY, "misses", 1)
+            return None
+        entry = json.loads(raw)
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.hincrby(STATS_KEY, "hits", 1)
+            pipe.hincrby(STATS_KEY, "tokens_saved", entry.get("tokens", 0))
+            await pipe.execute()
+        logging.info(f"Кэш ответов ИИ: попадание ({model}), сэкономлено токенов: {entry.get('tokens', 0)}.")
+        return entry["content"], entry.get("tokens", 0)
+    except Exception as e:
+        logging.warning(f"Кэш ответов ИИ недоступен: {e}")
+        return None
+
+
+async def store_completion(model: str, prompt: str, temperature: float, content: str, tokens: int):
+    """Сохраняет успешный ответ с TTL; в кэше остается не больше COMPLETION_CACHE_MAX_ENTRIES записей."""
+    key = cache_key(model, prompt, temperature)
+    try:
+        redis = _client()
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.set(key, json.dumps({"content": content, "tokens": tokens}, ensure_ascii=False), ex=COMPLETION_CACHE_TTL_SECONDS)
+            pipe.zadd(INDEX_KEY, {key: time.time()})
+            # Индекс не должен хранить записи, срок которых уже истек
+            pipe.zremrangebyscore(INDEX_KEY, "-inf", time.time() - COMPLETION_CACHE_TTL_SECONDS)
+            pipe.zcard(INDEX_KEY)
+            size = (await pipe.execute())[-1]
+        if size > COMPLETION_CACHE_MAX_ENTRIES:
+            evicted = await redis.zpopmin(INDEX_KEY, size - COMPLETION_CACHE_MAX_ENTRIES)
+            if evicted:
+                await redis.delete(*[k for k, _ in evicted])
+    except Exception as e:
+        logging.warning(f"Не удалось сохранить ответ ИИ в кэш: {e}")
+
+
+async def completion_cache_stats() -> dict:
+    """Статистика кэша для /health: попадания, промахи, доля попаданий, сэкономленные токены, размер."""
+    try:
+        redis = _client()
+        stats = await redis.hgetall(STATS_KEY)
+        size = await redis.zcard(INDEX_KEY)
+    except Exception as e:
+        logging.warning(f"Кэш ответов ИИ недоступен: {e}")
+        return {}
+    hits = int(stats.get("hits", 0))
+    misses = int(stats.get("misses", 0))
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / (hits + misses) if hits + misses else 0.0,
+        "tokens_saved": int(stats.get("tokens_saved", 0)),
+        "size": size,
+    }
@@ -0,0 +1,151 @@
+# bot/utils/content_dedup.py
+
+import asyncio
+import logging
+import asyncpg
+
+from bot import config
+from bot.utils.fetch_cache import normalize_url
+from bot.utils.fetch_coordinator import fetch_first_articles
+from bot.utils.article_extract import FINGERPRINT_BITS
+from bot.utils.extraction_pool import run_fingerprint
+
+# Сколько дней опубликованные статьи участвуют в сравнении по содержимому
+CONTENT_DEDUP_DAYS = config.CONTENT_DEDUP_DAYS
+# Статьи считаются одной и той же, если их отпечатки различаются не больше чем в стольких битах
+CONTENT_DEDUP_MAX_DISTANCE = config.CONTENT_DEDUP_MAX_DISTANCE
+
+# Отпечаток делится на полосы: при расстоянии d различающиеся биты задевают не больше d полос,
+# поэтому из d + 1 полос хотя бы одна совпадает целиком. Не меньше 4 полос, чтобы полоса
+# умещалась в INTEGER и индекс оставался избирательным
+FINGERPRINT_BANDS = max(4, CONTENT_DEDUP_MAX_DISTANCE + 1)
+# Границы полос в битах: при некратном делении последние полосы на бит короче
+_BAND_BOUNDS = [band * FINGERPRINT_BITS // FINGERPRINT_BANDS for band in range(FINGERPRINT_BANDS + 1)]
+
+# Нормализованный URL -> отпечаток
+_fingerprints: dict[str, int] = {}
+_FINGERPRINTS_MEMORY_LIMIT = 5000
+
+
+def fingerprint_distance(a: int, b: int) -> int:
+    return bin((a ^ b) & ((1 << FINGERPRINT_BITS) - 1)).count("1")
+
+
+def fingerprint_bands(fingerprint: int) -> list[tuple[int, int]]:
+    """(номер полосы, значение полосы) — ключи индекса published_post_fingerprints."""
+    unsigned = fingerprint & ((1 << FINGERPRINT_BITS) - 1)
+    bands = []
+    for band in range(FINGERPRINT_BANDS):
+        start, end = _BAND_BOUNDS[band], _BAND_BOUNDS[band + 1]
+        # Значения полос (не длиннее 16 бит) сдвигаются в знаковый диапазон
+        bands.append((band, (unsigned >> start & ((1 << (end - start)) - 1)) - (1 << 15)))
+    return bands
+
+
+def _remember(url: str, fingerprint: int):
+    if len(_fingerprints) >= _FINGERPRINTS_MEMORY_LIMIT:
+        _fingerprints.pop(next(iter(_fingerprints)))
+    _fingerprints[normalize_url(url)] = fingerprint
+
+
+async def fingerprint_urls(urls: list[str]) -> dict[str, int]:
+    """
+    Отпечатки содержимого статей по URL. Неизвестные страницы загружаются одновременно
+    (страницы берутся из дискового кэша, отпечатки считаются в пуле извлечения и запоминаются
+    в памяти); URL, статью по которым извлечь не удалось, в результат не попадают.
+    """
+    missing = [u for u in urls if normalize_url(u) not in _fingerprints]
+    if missing:
+        # Не уложившиеся в срок страницы не запоминаем: в следующий раз они могут успеть
+        fetched = await fetch_first_articles(missing, needed=len(missing))
+        fingerprints = await asyncio.gather(*(run_fingerprint(text) for _, text in fetched))
+        for (url, _), fingerprint in zip(fetched, fingerprints):
+            # None — мало текста или сбой пула; страница в кэше, пересчет в следующий раз дешев
+            if fingerprint is not None:
+                _remember(url, fingerprint)
+    result = {}
+    for url in urls:
+        fingerprint = _fingerprints.get(normalize_url(url))
+        if fingerprint is not None:
+            result[url] = fingerprint
+    return result
+
+
+async def filter_duplicate_content(db_pool: asyncpg.Pool, channel_id: int, posts: list[dict]) -> list[dict]:
+    """
+    Убирает посты, статьи которых по содержимому совпадают с опубликованными в канале
+    за CONTENT_DEDUP_DAYS дней или с предыдущими постами списка (перепечатки одной новости).
+    Отпечаток сохраняется в пост (content_fingerprint) для записи при публикации.
+    Посты, статью которых загрузить не удалось, остаются: судить о них не по чему.
+    """
+    unknown = [p['source_url'] for p in posts if p.get('content_fingerprint') is None]
+    if unknown:
+        for url, fingerprint in (await fingerprint_urls(unknown)).items():
+            for post in posts:
+                if post['source_url'] == url:
+                    post['content_fingerprint'] = fingerprint
+    fingerprints = [p['content_fingerprint'] for p in posts if p.get('content_fingerprint') is not None]
+    if not fingerprints:
+        return posts
+
+    bands = [band for fingerprint in fingerprints for band in fingerprint_bands(fingerprint)]
+    rows = await db_pool.fetch(
+        """
+        SELECT DISTINCT fingerprint FROM published_post_fingerprints
+        WHERE channel_id = $1
+          AND bands = $5
+          AND (band, band_value) IN (SELECT * FROM unnest($2::smallint[], $3::integer[]))
+          AND published_at > NOW() - make_interval(days => $4)
+        """,
+        channel_id, [b for b, _ in bands], [v for _, v in bands], CONTENT_DEDUP_DAYS, FINGERPRINT_BANDS
+    )
+    seen = [r['fingerprint'] for r in rows]
+    result = []
+    for post in posts:
+        fingerprint = post.get('content_fingerprint')
+        if fingerprint is not None:
+            if any(fingerprint_distance(fingerprint, other) <= CONTENT_DEDUP_MAX_DISTANCE for other in seen):
+                logging.info(f"Канал {channel_id}: статья {post['source_url']} по содержимому повторяет уже опубликованную, пропускаем.")
+                continue
+            seen.append(fingerprint)
+        result.append(post)
+    return result
+
+
+async def record_content_fingerprint(conn: asyncpg.Pool | asyncpg.Connection, channel_id: int, fingerprint: int | None):
+    """Добавляет отпечаток опубликованной статьи в полосный индекс канала и удаляет устаревшие записи."""
+    if fingerprint is None:
+        return
+    await conn.executemany(
+        "INSERT INTO published_post_fingerprints (channel_id, bands, band, band_value, fingerprint) VALUES ($1, $2, $3, $4, $5)",
+        [(channel_id, FINGERPRINT_BANDS, band, value, fingerprint) for band, value in fingerprint_bands(fingerprint)]
+    )
+    await conn.execute(
+        "DELETE FROM published_post_fingerprints WHERE channel_id = $1 AND published_at <= NOW() - make_interval(days => $2)",
+        channel_id, CONTENT_DEDUP_DAYS
+    )
+
+
+async def reindex_content_fingerprints(conn: asyncpg.Connection):
+    """
+    Перестраивает полосный индекс по отпечаткам из published_posts, если он построен с другим
+    числом полос (изменился CONTENT_DEDUP_MAX_DISTANCE): полосы другой разметки не совпадут.
+    """
+    stale = await conn.fetchval("SELECT EXISTS (SELECT 1 FROM published_post_fingerprints WHERE bands <> $1)", FINGERPRINT_BANDS)
+    if not stale:
+        return
+    rows = await conn.fetch(
+        """
+        SELECT channel_id, content_fingerprint, published_at FROM published_posts
+        WHERE content_fingerprint IS NOT NULL AND published_at > NOW() - make_interval(days => $1)
+        """,
+        CONTENT_DEDUP_DAYS
+    )
+    async with conn.transaction():
+        await conn.execute("DELETE FROM published_post_fingerprints")
+        await conn.executemany(
+            "INSERT INTO published_post_fingerprints (channel_id, bands, band, band_value, fingerprint, published_at) VALUES ($1, $2, $3, $4, $5, $6)",
+            [(r['channel_id'], FINGERPRINT_BANDS, band, value, r['content_fingerprint'], r['published_at'])
+             for r in rows for band, value in fingerprint_bands(r['content_fingerprint'])]
+        )
+    logging.info(f"Индекс отпечатков статей перестроен на {FINGERPRINT_BANDS} полос(ы): {len(rows)} статей.")
@@ -0,0 +1,137 @@
+# bot/utils/extraction_pool.py
+
+import os
+import signal
+import weakref
+import asyncio
+import logging
+import functools
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from bot import config
+from bot.utils.article_extract import extract_article, article_fingerprint, report_worker_pid
+
+# "process" — отдельные процессы (не блокируют цикл событий и GIL), "thread" — потоки
+EXTRACTION_EXECUTOR = config.EXTRACTION_EXECUTOR
+EXTRACTION_WORKERS = config.EXTRACTION_WORKERS
+EXTRACTION_TASK_TIMEOUT_SECONDS = config.EXTRACTION_TASK_TIMEOUT_SECONDS
+# После стольких задач на процесс пул пересоздается: память lxml в долгоживущих процессах только растет
+EXTRACTION_MAX_TASKS_PER_CHILD = config.EXTRACTION_MAX_TASKS_PER_CHILD
+
+_executor: Executor | None = None
+_tasks_in_executor = 0
+_use_threads = EXTRACTION_EXECUTOR == "thread"
+# Пулы, рабочие процессы которых бот завершил сам: их BrokenProcessPool — не повод уходить на потоки
+_terminated_executors: weakref.WeakSet = weakref.WeakSet()
+# Пул процессов -> очередь, в которую его рабочие процессы сообщают свои PID (см. report_worker_pid)
+_worker_pids: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def _new_executor() -> Executor:
+    global _use_threads
+    if not _use_threads:
+        try:
+            # forkserver: рабочие процессы не наследуют потоки и сокеты бота
+            context = multiprocessing.get_context("forkserver")
+            pids = context.SimpleQueue()
+            executor = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, mp_context=context,
+                                           initializer=report_worker_pid, initargs=(pids,))
+            _worker_pids[executor] = pids
+            return executor
+        except (OSError, ValueError, NotImplementedError) as e:
+            logging.error(f"Пул процессов для извлечения статей недоступен ({e}), переходим на потоки.")
+            _use_threads = True
+    return ThreadPoolExecutor(max_workers=EXTRACTION_WORKERS, thread_name_prefix="extraction")
+
+
+def _retire_executor(terminate: bool = False):
+    """
+    Отпускает текущий пул: новые задачи пойдут в новый. Без terminate старые процессы
+    завершатся после своих задач; с terminate — убиваются сразу (зависшее извлечение
+    иначе продолжит занимать процесс и память, а прерывать отдельные задачи пул не умеет).
+    """
+    global _executor, _tasks_in_executor
+    if _executor is not None:
+        if terminate and isinstance(_executor, ProcessPoolExecutor):
+            # Соседние задачи этого пула тоже прервутся и вернут None
+            _terminated_executors.add(_executor)
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _terminate_workers(_executor)
+        else:
+            _executor.shutdown(wait=False, cancel_futures=False)
+    _executor = None
+    _tasks_in_executor = 0
+
+
+def _terminate_workers(executor: ProcessPoolExecutor):
+    pids = _worker_pids.pop(executor, None)
+    while pids is not None and not pids.empty():
+        try:
+            os.kill(pids.get(), signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+def _get_executor() -> Executor:
+    global _executor, _tasks_in_executor
+    if _executor is not None and not _use_threads and _tasks_in_executor >= EXTRACTION_MAX_TASKS_PER_CHILD * EXTRACTION_WORKERS:
+        logging.debug("Пул извлечения статей отработал свою квоту задач и пересоздается.")
+        _retire_executor()
+    if _executor is None:
+        _executor = _new_executor()
+    _tasks_in_executor += 1
+    return _executor
+
+
+async def _run(func, *args, timeout: float):
+    """
+    Выполняет func(*args) в пуле извлечения. Возвращает None, если задача не уложилась в timeout
+    (процессы пула при этом завершаются) или упала.
+    """
+    global _use_threads
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(executor, functools.partial(func, *args)), timeout)
+    except asyncio.TimeoutError:
+        logging.warning(f"Извлечение статьи не уложилось в {timeout} сек., процессы пула завершаются.")
+        if executor is _executor:
+            _retire_executor(terminate=True)
+        return None
+    except BrokenProcessPool as e:
+        if executor in _terminated_executors:
+            # Пул завершен нами из-за зависшей соседней задачи — это не поломка
+            return None
+        logging.error(f"Пул процессов извлечения статей сломан ({e}), дальше используем потоки.")
+        if executor is _executor:
+            _retire_executor()
+        _use_threads = True
+        return None
+    except Exception as e:
+        logging.warning(f"Не удалось извлечь текст статьи: {e}")
+        return None
+
+
+async def run_extraction(html: bytes, encoding: str | None = None,
+                         timeout: float = EXTRACTION_TASK_TIMEOUT_SECONDS) -> tuple[str, str] | None:
+    """
+    Извлекает (заголовок, текст) статьи из сырого HTML вне цикла событий.
+    В рабочий процесс передаются байты как есть, декодирование — там же.
+    Возвращает None, если извлечение не уложилось в timeout или упало.
+    """
+    return await _run(extract_article, html, encoding, timeout=timeout)
+
+
+async def run_fingerprint(article: str, timeout: float = EXTRACTION_TASK_TIMEOUT_SECONDS) -> int | None:
+    """simhash-отпечаток текста статьи вне цикла событий; None — текста мало или задача не удалась."""
+    return await _run(article_fingerprint, article, timeout=timeout)
+
+
+def shutdown_extraction_pool():
+    """Останавливает пул извлечения при завершении бота."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,200 @@
+# bot/utils/fetch_cache.py
+
+import os
+import json
+import gzip
+import time
+import asyncio
+import hashlib
+import logging
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from bot import config
+
+# Каталог кэша: meta/ — записи по нормализованному URL, blobs/ — сжатый HTML по хешу содержимого
+FETCH_CACHE_DIR = config.FETCH_CACHE_DIR
+FETCH_CACHE_MAX_BYTES = config.FETCH_CACHE_MAX_BYTES
+# Сколько секунд запись считается свежей без перепроверки на сервере
+FETCH_CACHE_FRESH_SECONDS = config.FETCH_CACHE_FRESH_SECONDS
+
+# Параметры ссылок, которые не меняют содержимое страницы
+TRACKING_PARAMS = {"fbclid", "gclid", "yclid", "ysclid", "_openstat", "ref", "from"}
+
+_total_bytes: int | None = None
+_evict_lock = asyncio.Lock()
+
+
+def normalize_url(url: str) -> str:
+    """URL без фрагмента, меток рекламных кампаний и порта по умолчанию; хост в нижнем регистре, параметры по алфавиту."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and not ((scheme == "http" and parts.port == 80) or (scheme == "https" and parts.port == 443)):
+        host = f"{host}:{parts.port}"
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.lower().startswith("utm_") and k.lower() not in TRACKING_PARAMS
+    )
+    return urlunsplit((scheme, host, parts.path or "/", urlencode(query), ""))
+
+
+def _meta_path(url: str) -> str:
+    return os.path.join(FETCH_CACHE_DIR, "meta", hashlib.sha256(normalize_url(url).encode()).hexdigest() + ".json")
+
+
+def _blob_path(content_hash: str) -> str:
+    return os.path.join(FETCH_CACHE_DIR, "blobs", content_hash + ".html.gz")
+
+
+def _read_meta(path: str) -> dict | None:
+    try:
+        with open(path, encoding="utf-8") as f:
+            entry = json.load(f)
+        os.utime(path)  # время доступа для LRU
+        return entry
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Поврежденная запись кэша страниц {path}: {e}")
+        return None
+
+
+def _write_entry(path: str, entry: dict, raw: bytes | None) -> int:
+    """Пишет запись и (если его еще нет) сжатый HTML. Возвращает число добавленных на диск байт."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    added = 0
+    if raw is not None:
+        blob = _blob_path(entry["content_hash"])
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            tmp = blob + ".tmp"
+            with gzip.open(tmp, "wb", compresslevel=6) as f:
+                f.write(raw)
+            os.replace(tmp, blob)
+            added += os.path.getsize(blob)
+    previous = os.path.getsize(path) if os.path.exists(path) else 0
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(entry, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    return added + os.path.getsize(path) - previous
+
+
+def _read_blob(content_hash: str) -> bytes | None:
+    try:
+        with gzip.open(_blob_path(content_hash), "rb") as f:
+            return f.read()
+    except (OSError, EOFError):
+        return None
+
+
+def _disk_usage() -> int:
+    total = 0
+    for sub in ("meta", "blobs"):
+        directory = os.path.join(FETCH_CACHE_DIR, sub)
+        if os.path.isdir(directory):
+            total += sum(e.stat().st_size for e in os.scandir(directory) if e.is_file())
+    return total
+
+
+def _meta_content_hash(path: str) -> str | None:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f).get("content_hash")
+    except (OSError, ValueError):
+        return None
+
+
+def _evict(target_bytes: int) -> int:
+    """
+    Удаляет давно не использованные записи (LRU по mtime) вместе со сжатым HTML, на который
+    больше не ссылается ни одна запись, пока кэш не станет меньше target_bytes; затем убирает
+    оставшийся HTML без ссылок (например, после сбоя записи). Возвращает новый объем.
+    """
+    started_at = time.time()
+    meta_dir = os.path.join(FETCH_CACHE_DIR, "meta")
+    entries = sorted((e for e in os.scandir(meta_dir) if e.is_file()), key=lambda e: e.stat().st_mtime) if os.path.isdir(meta_dir) else []
+    # Одинаковый HTML хранится один раз: blob удаляется вместе с последней ссылающейся на него записью
+    content_hashes = {entry.path: _meta_content_hash(entry.path) for entry in entries}
+    references: dict[str, int] = {}
+    for content_hash in content_hashes.values():
+        if content_hash:
+            references[content_hash] = references.get(content_hash, 0) + 1
+    total = _disk_usage()
+    for entry in entries:
+        if total <= target_bytes:
+            break
+        total -= entry.stat().st_size
+        os.remove(entry.path)
+        content_hash = content_hashes[entry.path]
+        if content_hash:
+            references[content_hash] -= 1
+            if references[content_hash] == 0:
+                try:
+                    total -= os.path.getsize(_blob_path(content_hash))
+                    os.remove(_blob_path(content_hash))
+                except FileNotFoundError:
+                    pass
+
+    blob_dir = os.path.join(FETCH_CACHE_DIR, "blobs")
+    for entry in os.scandir(blob_dir) if os.path.isdir(blob_dir) else []:
+        # HTML, записанный во время очистки, может принадлежать еще не учтенной записи
+        if not references.get(entry.name.split(".")[0]) and entry.stat().st_mtime < started_at:
+            os.remove(entry.path)
+    return _disk_usage()
+
+
+async def get_cached_page(url: str) -> dict | None:
+    """
+    Запись кэша для URL: {etag, last_modified, content_hash, encoding, fetched_at, title, text}.
+    fresh=True — запись можно использовать без перепроверки на сервере.
+    """
+    entry = await asyncio.to_thread(_read_meta, _meta_path(url))
+    if entry is not None:
+        entry["fresh"] = time.time() - entry.get("fetched_at", 0) < FETCH_CACHE_FRESH_SECONDS
+    return entry
+
+
+def conditional_headers(entry: dict | None) -> dict:
+    """Заголовки If-None-Match / If-Modified-Since для перепроверки записи на сервере."""
+    headers = {}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+async def load_cached_html(entry: dict) -> bytes | None:
+    return await asyncio.to_thread(_read_blob, entry["content_hash"])
+
+
+async def store_page(url: str, raw: bytes | None, etag: str | None, last_modified: str | None,
+                     title: str | None, text: str | None, entry: dict | None = None, encoding: str | None = None):
+    """
+    Сохраняет страницу: сжатый HTML (по хешу содержимого — одинаковые страницы хранятся один раз)
+    и извлеченный текст. raw=None — страница не изменилась (304), обновляются только метаданные.
+    """
+    global _total_bytes
+    new_entry = {
+        "url": normalize_url(url),
+        "etag": etag or (entry or {}).get("etag"),
+        "last_modified": last_modified or (entry or {}).get("last_modified"),
+        "content_hash": hashlib.sha256(raw).hexdigest() if raw is not None else entry["content_hash"],
+        "encoding": encoding if raw is not None else (entry or {}).get("encoding"),
+        "fetched_at": time.time(),
+        "title": title,
+        "text": text,
+    }
+    try:
+        added = await asyncio.to_thread(_write_entry, _meta_path(url), new_entry, raw)
+        async with _evict_lock:
+            if _total_bytes is None:
+                _total_bytes = await asyncio.to_thread(_disk_usage)
+            else:
+                _total_bytes += added
+            if _total_bytes > FETCH_CACHE_MAX_BYTES:
+                _total_bytes = await asyncio.to_thread(_evict, int(FETCH_CACHE_MAX_BYTES * 0.9))
+                logging.info(f"Кэш страниц очищен до {_total_bytes / 1024 / 1024:.1f} МБ.")
+    except OSError as e:
+        logging.warning(f"Не удалось сохранить страницу {url} в кэш: {e}")
@@ -0,0 +1,118 @@
+# bot/utils/fetch_coordinator.py
+
+import time
+import asyncio
+import logging
+from collections import deque
+from urllib.parse import urlsplit
+
+from bot import config
+from bot.utils.article_parser import fetch_article_text
+
+ARTICLE_FETCH_DEADLINE_SECONDS = config.ARTICLE_FETCH_DEADLINE_SECONDS
+# Домен считается блокирующим скрапинг, если после стольких попыток доля успехов ниже порога
+ARTICLE_DOMAIN_MIN_ATTEMPTS = config.ARTICLE_DOMAIN_MIN_ATTEMPTS
+ARTICLE_DOMAIN_MIN_SUCCESS_RATE = config.ARTICLE_DOMAIN_MIN_SUCCESS_RATE
+# Раз в столько секунд отложенный домен все равно пробуется, чтобы его доля успехов могла восстановиться
+ARTICLE_DOMAIN_RETRY_SECONDS = config.ARTICLE_DOMAIN_RETRY_SECONDS
+# Сколько последних исходов помнить по каждому домену и как долго (старые исходы забываются)
+DOMAIN_HISTORY_SIZE = 20
+DOMAIN_HISTORY_SECONDS = 6 * 3600
+
+# Домен -> последние исходы загрузки: (время, True — статья извлечена)
+_domain_history: dict[str, deque] = {}
+
+
+def _domain(url: str) -> str:
+    host = (urlsplit(url).hostname or "").lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+def _record(domain: str, success: bool):
+    _domain_history.setdefault(domain, deque(maxlen=DOMAIN_HISTORY_SIZE)).append((time.monotonic(), success))
+
+
+def _history(domain: str) -> deque | None:
+    history = _domain_history.get(domain)
+    now = time.monotonic()
+    while history and now - history[0][0] > DOMAIN_HISTORY_SECONDS:
+        history.popleft()
+    return history
+
+
+def domain_success_rate(url_or_domain: str) -> float | None:
+    """Доля успешных извлечений для домена; None — попыток пока слишком мало."""
+    domain = _domain(url_or_domain) if "://" in url_or_domain else url_or_domain
+    history = _history(domain)
+    if not history or len(history) < ARTICLE_DOMAIN_MIN_ATTEMPTS:
+        return None
+    return sum(ok for _, ok in history) / len(history)
+
+
+def _is_blocking(url: str) -> bool:
+    """Домен стабильно не отдает статьи и пробной попытки ему сейчас не положено."""
+    rate = domain_success_rate(url)
+    if rate is None or rate >= ARTICLE_DOMAIN_MIN_SUCCESS_RATE:
+        return False
+    # Раз в ARTICLE_DOMAIN_RETRY_SECONDS домен пропускается: иначе без новых исходов он остался бы отложенным навсегда
+    return time.monotonic() - _domain_history[_domain(url)][-1][0] < ARTICLE_DOMAIN_RETRY_SECONDS
+
+
+async def _fetch(url: str) -> tuple[str, str | None]:
+    try:
+        return url, await fetch_article_text(url)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.debug(f"Не удалось загрузить статью {url}: {e!r}")
+        return url, None
+
+
+async def fetch_first_articles(urls: list[str], needed: int = 1,
+                               deadline: float = ARTICLE_FETCH_DEADLINE_SECONDS) -> list[tuple[str, str]]:
+    """
+    Загружает статьи всех кандидатов одновременно под общим сроком deadline и возвращает первые
+    needed успешных (url, текст) в порядке завершения; остальные загрузки отменяются.
+    Домены, которые стабильно не отдают статьи, пробуются, только если без них кандидатов не хватает,
+    и раз в ARTICLE_DOMAIN_RETRY_SECONDS — пробной попыткой.
+    """
+    urls = list(dict.fromkeys(u for u in urls if u))
+    blocking = {u: _is_blocking(u) for u in urls}
+    preferred = [u for u in urls if not blocking[u]]
+    blocked = [u for u in urls if blocking[u]]
+    if blocked:
+        logging.info(f"Загрузка статей: домены с низкой долей успеха отложены: {', '.join(_domain(u) for u in blocked)}")
+    candidates = preferred if len(preferred) >= needed else preferred + blocked
+    if not candidates:
+        return []
+
+    tasks = {asyncio.create_task(_fetch(url)) for url in candidates}
+    results: list[tuple[str, str]] = []
+    loop = asyncio.get_running_loop()
+    ends_at = loop.time() + deadline
+    try:
+        while tasks and len(results) < needed:
+            remaining = ends_at - loop.time()
+            if remaining <= 0:
+                break
+            done, tasks = await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                url, text = task.result()
+                _record(_domain(url), text is not None)
+                if text is not None:
+                    results.append((url, text))
+    finally:
+        for task in tasks:
+            task.cancel()
+    if tasks:
+        logging.info(f"Загрузка статей: {len(results)} из {needed} получено, {len(tasks)} загрузок отменено.")
+    return results[:needed]
+
+
+def domain_stats(limit: int = 5) -> list[tuple[str, float, int]]:
+    """Домены с самой низкой долей успешных извлечений: (домен, доля, число попыток) — для /health."""
+    stats = [
+        (domain, sum(ok for _, ok in history) / len(history), len(history))
+        for domain, history in ((d, _history(d)) for d in list(_domain_history)) if len(history) >= ARTICLE_DOMAIN_MIN_ATTEMPTS
+    ]
+    return sorted(stats, key=lambda item: item[1])[:limit]
@@ -0,0 +1,485 @@
+# bot/utils/http_client.py
+
+import os
+import json
+import gzip
+import time
+import base64
+import asyncio
+import hashlib
+import logging
+from collections import deque
+from urllib.parse import urlsplit
+
+import aiohttp
+from multidict import CIMultiDict
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramNetworkError
+
+from bot import config
+
+# Режим кассет: "off" — обычная работа, "record" — живые запросы с записью пар запрос/ответ,
+# "replay" — ответы только из кассеты, без сети (для воспроизводимого профилирования)
+CASSETTE_MODE = config.CASSETTE_MODE
+CASSETTE_PATH = config.CASSETTE_PATH
+# При воспроизведении выдерживать записанные задержки ответов
+CASSETTE_REPLAY_LATENCY = config.CASSETTE_REPLAY_LATENCY
+
+# Пул соединений общей сессии: всего, на один хост, кэш DNS и время жизни простаивающих соединений
+HTTP_POOL_LIMIT = config.HTTP_POOL_LIMIT
+HTTP_POOL_LIMIT_PER_HOST = config.HTTP_POOL_LIMIT_PER_HOST
+HTTP_DNS_CACHE_SECONDS = config.HTTP_DNS_CACHE_SECONDS
+HTTP_KEEPALIVE_SECONDS = config.HTTP_KEEPALIVE_SECONDS
+# Основные внешние адреса: к ним заранее открываются соединения при старте
+WARMUP_URLS = [config.OPENROUTER_API_BASE, config.XMLRIVER_NEWS_URL, "https://api.telegram.org"]
+
+# Параметры запросов, которые содержат ключи доступа: не пишутся в кассету и не участвуют в ключе записи
+REDACTED_PARAMS = {"key", "user", "api_key", "token"}
+
+
+def _canonical_params(params) -> list:
+    if not params:
+        return []
+    items = params.items() if isinstance(params, dict) else params
+    return sorted((str(k), str(v)) for k, v in items if str(k) not in REDACTED_PARAMS)
+
+
+def _request_keys(method: str, url: str, params=None, json_body=None) -> tuple[str, str]:
+    """
+    Точный ключ (метод, адрес, параметры, тело) и свободный ключ (метод, адрес без query).
+    Свободный используется, если точной записи нет — например, промпт немного изменился.
+    """
+    parts = urlsplit(url)
+    base = f"{method.upper()} {parts.scheme}://{parts.netloc}{parts.path}"
+    query = [tuple(pair.split("=", 1)) if "=" in pair else (pair, "") for pair in parts.query.split("&") if pair]
+    body = json.dumps(json_body, sort_keys=True, ensure_ascii=False) if json_body is not None else ""
+    exact = hashlib.sha1(
+        json.dumps([base, _canonical_params(query) + _canonical_params(params), body], ensure_ascii=False).encode()
+    ).hexdigest()
+    return exact, base
+
+
+class Cassette:
+    """
+    Кассета — gzip-файл JSON Lines с парами запрос/ответ и длительностями.
+    При записи строки дописываются в конец; при воспроизведении одинаковые запросы
+    получают записи по порядку, а последняя запись повторяется.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._exact: dict[str, deque] = {}
+        self._loose: dict[str, deque] = {}
+        self._loaded = False
+        # Записи дописываются из потока по одной: параллельные gzip-члены в одном файле перемешались бы
+        self._write_lock = asyncio.Lock()
+
+    def _load(self):
+        self._loaded = True
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    self._exact.setdefault(record["key"], deque()).append(record)
+                    self._loose.setdefault(record["base"], deque()).append(record)
+        except FileNotFoundError:
+            logging.error(f"Кассета {self.path} не найдена: все внешние запросы завершатся ошибкой.")
+        logging.info(f"Кассета {self.path} загружена: {sum(len(q) for q in self._exact.values())} записей.")
+
+    @staticmethod
+    def _take_from(queue: deque | None) -> dict | None:
+        if not queue:
+            return None
+        return queue.popleft() if len(queue) > 1 else queue[0]
+
+    def take(self, key: str, base: str) -> dict | None:
+        if not self._loaded:
+            self._load()
+        record = self._take_from(self._exact.get(key))
+        if record is None:
+            record = self._take_from(self._loose.get(base))
+            if record is not None:
+                logging.debug(f"Кассета: точной записи для {base} нет, использована ближайшая.")
+        return record
+
+    def _write(self, record: dict):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Дописываем отдельным gzip-членом: такой файл читается gzip.open целиком
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    async def append(self, record: dict):
+        """Дописывает запись в файл вне цикла событий (сжатие и запись на диск — в потоке)."""
+        async with self._write_lock:
+            await asyncio.to_thread(self._write, record)
+
+
+_cassette = Cassette(CASSETTE_PATH)
+
+
+def _encode_body(body: bytes) -> dict:
+    try:
+        return {"text": body.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"base64": base64.b64encode(body).decode()}
+
+
+def _decode_body(record: dict) -> bytes:
+    if "base64" in record:
+        return base64.b64decode(record["base64"])
+    return (record.get("text") or "").encode("utf-8")
+
+
+class _BodyReader:
+    """Минимальная замена aiohttp.StreamReader поверх готового тела ответа."""
+
+    def __init__(self, body: bytes):
+        self._body = body
+        self._pos = 0
+
+    async def read(self, n: int = -1) -> bytes:
+        end = len(self._body) if n < 0 else min(len(self._body), self._pos + n)
+        chunk = self._body[self._pos:end]
+        self._pos = end
+        return chunk
+
+    async def readline(self) -> bytes:
+        end = self._body.find(b"\n", self._pos)
+        end = len(self._body) if end < 0 else end + 1
+        line = self._body[self._pos:end]
+        self._pos = end
+        return line
+
+    async def iter_chunked(self, n: int):
+        while self._pos < len(self._body):
+            yield await self.read(n)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        line = await self.readline()
+        if not line:
+            raise StopAsyncIteration
+        return line
+
+
+class CassetteResponse:
+    """Ответ из кассеты (или записанный в нее) с тем же интерфейсом, что используют вызывающие."""
+
+    def __init__(self, url: str, status: int, headers: dict, body: bytes):
+        self.url = url
+        self.status = status
+        # Старые записи хранят заголовки словарем, новые — списком пар (с повторами)
+        self.headers = CIMultiDict([tuple(h) for h in headers] if isinstance(headers, list) else headers)
+        self._body = body
+        self.content = _BodyReader(body)
+
+    @property
+    def charset(self) -> str | None:
+        content_type = self.headers.get("Content-Type", "")
+        if "charset=" in content_type:
+            return content_type.split("charset=", 1)[1].split(";")[0].strip()
+        return None
+
+    async def read(self) -> bytes:
+        return self._body
+
+    async def text(self, encoding: str | None = None, errors: str = "strict") -> str:
+        return self._body.decode(encoding or self.charset or "utf-8", errors)
+
+    async def json(self, content_type=None, loads=json.loads):
+        return loads(await self.text())
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(None, (), status=self.status, message=f"HTTP {self.status}")
+
+    def release(self):
+        pass
+
+
+_REPLAY_ERRORS = {
+    "TimeoutError": asyncio.TimeoutError,
+}
+
+
+async def _replay_delay(record: dict):
+    if CASSETTE_REPLAY_LATENCY and record.get("latency"):
+        await asyncio.sleep(record["latency"])
+
+
+class _RecordingReader:
+    """Обертка над response.content живого ответа: запоминает ровно то, что прочитал вызывающий."""
+
+    def __init__(self, content):
+        self._content = content
+        self.chunks: list[bytes] = []
+
+    def _keep(self, data: bytes) -> bytes:
+        self.chunks.append(data)
+        return data
+
+    async def read(self, n: int = -1) -> bytes:
+        return self._keep(await self._content.read(n))
+
+    async def readline(self) -> bytes:
+        return self._keep(await self._content.readline())
+
+    async def iter_chunked(self, n: int):
+        async for chunk in self._content.iter_chunked(n):
+            yield self._keep(chunk)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        line = await self.readline()
+        if not line:
+            raise StopAsyncIteration
+        return line
+
+
+class _RecordingResponse:
+    """
+    Живой ответ в режиме записи. Тело читается так же, как без кассеты (лимиты размера,
+    обрыв после заголовков Range-проб), а в кассету попадает только прочитанное.
+    """
+
+    def __init__(self, response: aiohttp.ClientResponse):
+        self._response = response
+        self.url = response.url
+        self.status = response.status
+        self.headers = response.headers
+        self.content = _RecordingReader(response.content)
+
+    @property
+    def charset(self) -> str | None:
+        return self._response.charset
+
+    @property
+    def body(self) -> bytes:
+        return b"".join(self.content.chunks)
+
+    async def read(self) -> bytes:
+        return self.content._keep(await self._response.read())
+
+    async def text(self, encoding: str | None = None, errors: str = "strict") -> str:
+        return (await self.read()).decode(encoding or self.charset or "utf-8", errors)
+
+    async def json(self, content_type=None, loads=json.loads):
+        return loads(await self.text())
+
+    def raise_for_status(self):
+        self._response.raise_for_status()
+
+    def release(self):
+        self._response.release()
+
+
+class _CassetteRequest:
+    def __init__(self, session: "CassetteSession", method: str, url: str, kwargs: dict):
+        self.session = session
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        # Режим записи: контекст живого запроса, его ответ и заготовка записи
+        self._live = None
+        self._recording: _RecordingResponse | None = None
+        self._record: dict | None = None
+        self._started_at = 0.0
+
+    async def __aenter__(self) -> CassetteResponse | _RecordingResponse:
+        key, base = _request_keys(self.method, self.url, self.kwargs.get("params"), self.kwargs.get("json"))
+        if CASSETTE_MODE == "replay":
+            record = _cassette.take(key, base)
+            if record is None:
+                raise aiohttp.ClientConnectionError(f"В кассете нет записи для {base}")
+            await _replay_delay(record)
+            if record.get("error"):
+                raise _REPLAY_ERRORS.get(record["error"], aiohttp.ClientConnectionError)(record.get("message", ""))
+            return CassetteResponse(self.url, record["status"], record.get("headers", {}), _decode_body(record))
+
+        self._record = {"key": key, "base": base, "params": _canonical_params(self.kwargs.get("params"))}
+        self._started_at = time.monotonic()
+        self._live = self.session.http.request(self.method, self.url, **self.kwargs)
+        try:
+            response = await self._live.__aenter__()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._record.update(latency=time.monotonic() - self._started_at, error=type(e).__name__, message=str(e))
+            await _cassette.append(self._record)
+            raise
+        self._recording = _RecordingResponse(response)
+        return self._recording
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._live is None:
+            return False
+        # Запись делается, когда вызывающий закончил с ответом: в ней все заголовки и прочитанная часть тела
+        record = self._record
+        record["latency"] = time.monotonic() - self._started_at
+        if exc_type is not None and issubclass(exc_type, (aiohttp.ClientError, asyncio.TimeoutError)):
+            record.update(error=exc_type.__name__, message=str(exc))
+        elif self._recording is not None:
+            record.update(status=self._recording.status, headers=[list(h) for h in self._recording.headers.items()],
+                          **_encode_body(self._recording.body))
+        try:
+            return await self._live.__aexit__(exc_type, exc, tb)
+        finally:
+            if "status" in record or "error" in record:
+                await _cassette.append(record)
+
+
+class CassetteSession:
+    """Замена aiohttp.ClientSession в режимах записи и воспроизведения кассет."""
+
+    def __init__(self):
+        self.http = _new_client_session() if CASSETTE_MODE == "record" else None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    @property
+    def closed(self) -> bool:
+        return self.http.closed if self.http else False
+
+    async def close(self):
+        if self.http:
+            await self.http.close()
+
+    def request(self, method: str, url: str, **kwargs) -> _CassetteRequest:
+        return _CassetteRequest(self, method, url, kwargs)
+
+    def get(self, url: str, **kwargs) -> _CassetteRequest:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> _CassetteRequest:
+        return self.request("POST", url, **kwargs)
+
+
+def _new_client_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        ttl_dns_cache=HTTP_DNS_CACHE_SECONDS,
+        keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+        enable_cleanup_closed=True,
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+_shared_session: aiohttp.ClientSession | CassetteSession | None = None
+
+
+def shared_http_session() -> aiohttp.ClientSession | CassetteSession:
+    """
+    Общая долгоживущая сессия процесса (с учетом режима кассет): один пул соединений
+    с keep-alive и кэшем DNS на все внешние запросы. Закрывается в close_http_sessions().
+    """
+    global _shared_session
+    if _shared_session is None or _shared_session.closed:
+        _shared_session = CassetteSession() if CASSETTE_MODE in ("record", "replay") else _new_client_session()
+    return _shared_session
+
+
+class _BorrowedSession:
+    """Контекст, который отдает общую сессию и не закрывает ее на выходе."""
+
+    async def __aenter__(self) -> aiohttp.ClientSession | CassetteSession:
+        return shared_http_session()
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def http_session() -> _BorrowedSession:
+    """
+    Сессия для внешних HTTP-запросов (OpenRouter, XMLRiver, сайты статей):
+    `async with http_session() as session` берет общую сессию, а не создает новую.
+    """
+    return _BorrowedSession()
+
+
+async def _warm_up_url(session, url: str):
+    try:
+        async with session.request("HEAD", url, timeout=aiohttp.ClientTimeout(total=5)) as response:
+            logging.debug(f"Прогрев соединения с {url}: HTTP {response.status}")
+    except Exception as e:
+        logging.debug(f"Прогрев соединения с {url} не удался: {e}")
+
+
+async def warm_up_http():
+    """При старте заранее разрешает DNS и открывает TLS-соединения с основными внешними сервисами."""
+    if CASSETTE_MODE == "replay":
+        return
+    session = shared_http_session()
+    await asyncio.gather(*[_warm_up_url(session, url) for url in WARMUP_URLS])
+    logging.info("Соединения с внешними сервисами прогреты.")
+
+
+async def close_http_sessions():
+    """Закрывает общие HTTP-сессии (внешние запросы и Bot API) при остановке бота."""
+    global _shared_session, _shared_bot_session
+    if _shared_session is not None:
+        await _shared_session.close()
+        _shared_session = None
+    if _shared_bot_session is not None:
+        await _shared_bot_session.close()
+        _shared_bot_session = None
+
+
+class CassetteBotSession(AiohttpSession):
+    """Сессия aiogram, которая пишет запросы к Bot API в кассету или отвечает из нее."""
+
+    async def make_request(self, bot, method, timeout=None):
+        api_method = method.__api_method__
+        # Токен бота в ключ не попадает: запросы различаются методом и чатом
+        base = f"POST telegram/{api_method}"
+        key = hashlib.sha1(f"{base} {getattr(method, 'chat_id', '')}".encode()).hexdigest()
+
+        if CASSETTE_MODE == "replay":
+            record = _cassette.take(key, base)
+            if record is None:
+                raise TelegramNetworkError(method=method, message=f"В кассете нет записи для {base}")
+            await _replay_delay(record)
+            if record.get("error"):
+                raise TelegramNetworkError(method=method, message=record.get("message", ""))
+            raw_result, status = record.get("text", ""), record["status"]
+        else:
+            session = await self.create_session()
+            url = self.api.api_url(token=bot.token, method=api_method)
+            form = self.build_form_data(bot=bot, method=method)
+            started_at = time.monotonic()
+            try:
+                async with session.post(url, data=form, timeout=self.timeout if timeout is None else timeout) as resp:
+                    raw_result, status = await resp.text(), resp.status
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                await _cassette.append({"key": key, "base": base, "latency": time.monotonic() - started_at,
+                                        "error": type(e).__name__, "message": str(e)})
+                raise TelegramNetworkError(method=method, message=f"{type(e).__name__}: {e}")
+            await _cassette.append({"key": key, "base": base, "latency": time.monotonic() - started_at,
+                                    "status": status, "text": raw_result})
+
+        response = self.check_response(bot=bot, method=method, status_code=status, content=raw_result)
+        return response.result
+
+
+_shared_bot_session: AiohttpSession | None = None
+
+
+def make_bot_session() -> AiohttpSession:
+    """
+    Общая сессия для всех Bot(...) процесса (в режимах кассет — CassetteBotSession).
+    Вызывающие не закрывают ее: это делает close_http_sessions() при остановке.
+    """
+    global _shared_bot_session
+    if _shared_bot_session is None:
+        session_class = CassetteBotSession if CASSETTE_MODE in ("record", "replay") else AiohttpSession
+        _shared_bot_session = session_class(limit=HTTP_POOL_LIMIT)
+    return _shared_bot_session
@@ -1,18 +1,76 @@
-import json
-import aiohttp
-import xml.etree.ElementTree as ET
+import logging
+
 from bot import config
+from bot.utils.xmlriver import fetch_xmlriver
+from bot.utils.xmlriver_parser import SearchResult
+from bot.utils.image_probe import ImageProbe, probe_images
+from bot.utils.ranking import tokenize
 
 XMLRIVER_API_KEY = config.XMLRIVER_API_KEY
-XMLRIVER_IMAGES_URL = config.XMLRIVER_NEWS_URL # XMLRiver uses the same base URL, just different setab
+# Сколько лучших по адресу кандидатов проверять Range-запросом и сколько времени на это отводить
+IMAGE_PROBE_TOP_K = config.IMAGE_PROBE_TOP_K
+IMAGE_PROBE_BUDGET_SECONDS = config.IMAGE_PROBE_BUDGET_SECONDS
+# Ограничения Telegram для фото, отправляемых по ссылке
+IMAGE_MAX_BYTES = config.IMAGE_MAX_BYTES
+IMAGE_MIN_SIDE = config.IMAGE_MIN_SIDE
+TELEGRAM_PHOTO_MIMES = {"image/jpeg", "image/png", "image/webp"}
+# Упреждающий поиск по теме сценария: сколько ключевых слов брать в запрос
+# и какое пересечение с запросом ИИ считать достаточным
+SPECULATIVE_IMAGE_KEYWORDS = 3
+SPECULATIVE_IMAGE_MIN_RELEVANCE = config.SPECULATIVE_IMAGE_MIN_RELEVANCE
 
-async def find_creative_commons_image_url(query: str, lang_code: str = 'ru') -> str | None:
+# Исходы упреждающего поиска: 'hit' — картинка использована, 'irrelevant' — запрос ИИ
+# оказался о другом, 'empty' — по теме ничего не нашлось
+_speculative_stats = {"hit": 0, "irrelevant": 0, "empty": 0}
+
+
+def _url_score(candidate: SearchResult) -> int:
+    u = candidate.url.lower()
+    score = 0
+    # Предпочитаем форматы фото
+    if any(u.endswith(ext) for ext in (".jpg", ".jpeg", ".png", ".webp")):
+        score += 5
+    if u.endswith(".svg"):
+        score -= 3
+    # Предпочитаем https
+    if u.startswith("https://"):
+        score += 1
+    # Наказание за миниатюры/иконки
+    if any(x in u for x in ("thumb", "thumbnail", "sprite", "icon", "logo-small")):
+        score -= 2
+    # Небольшой бонус за известные домены стоков (эвристика)
+    if any(x in u for x in ("wikimedia", "static", "cdn")):
+        score += 1
+    # Если XMLRiver сообщил размеры, мелкие картинки не годятся для поста
+    if candidate.width and candidate.height and min(candidate.width, candidate.height) < IMAGE_MIN_SIDE:
+        score -= 3
+    return score
+
+
+def _probe_score(probe: ImageProbe) -> float | None:
+    """Оценка по результату пробы; None — картинку нельзя отправить (битая ссылка, не тот формат, слишком большая/мелкая)."""
+    if not probe.ok or probe.mime not in TELEGRAM_PHOTO_MIMES:
+        return None
+    if probe.size and probe.size > IMAGE_MAX_BYTES:
+        return None
+    if not (probe.width and probe.height):
+        return 2.0
+    if min(probe.width, probe.height) < IMAGE_MIN_SIDE:
+        return None
+    # Telegram не принимает фото с суммой сторон больше 10000 или соотношением сторон больше 20
+    if probe.width + probe.height > 10000 or max(probe.width, probe.height) / min(probe.width, probe.height) > 20:
+        return None
+    # Чем больше картинка, тем лучше — до ~2 Мп, дальше разницы в ленте не видно
+    return min(probe.width * probe.height, 2_000_000) / 200_000
+
+async def search_image_candidates(query: str, lang_code: str = 'ru') -> tuple[list[SearchResult] | None, int]:
     """
-    Ищет в Google Images через xmlriver.com изображение с лицензией Creative Commons.
+    Кандидаты-изображения из Google Images через xmlriver.com (без проверки самих картинок).
+    Возвращает (кандидаты или None при ошибке, число оплаченных запросов — 0 для кэша и объединенных запросов).
     """
     if not XMLRIVER_API_KEY:
-        print("WARNING: XMLRIVER_API_KEY не найден. Поиск изображений отключен.")
-        return None
+        logging.warning("XMLRIVER_API_KEY не найден. Поиск изображений отключен.")
+        return None, 0
 
     # Определение lr кода для языка
     lr_code = '225' if lang_code == 'ru' else '93' # Россия для ru, США для en
@@ -21,58 +79,71 @@ async def find_creative_commons_image_url(query: str, lang_code: str = 'ru') ->
     # Согласно документации, setab=images, и необходимо указать query.
     # Для фильтрации по Creative Commons, ищем параметр. В примере OCR есть 'ic:cl', но это Serper параметр.
     # Для XMLRiver нужно проверить, как передается лицензия. Пока без явного параметра лицензии.
-    params = {
-        "setab": "images",
-        "key": XMLRIVER_API_KEY,
-        "query": query,
-        "lr": lr_code,
-        "groupby": "10" # запросим топ-10, чтобы выбрать лучшую
-    }
-
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(XMLRIVER_IMAGES_URL, params=params, timeout=20) as response:
-                if response.status == 200:
-                    xml_text = await response.text()
-                    root = ET.fromstring(xml_text)
-
-                    # Соберем кандидатов
-                    candidates = []
-                    for doc in root.findall(".//doc"):
-                        image_url = doc.findtext("url")
-                        if image_url:
-                            candidates.append(image_url)
-
-                    if not candidates:
-                        print(f"Изображения по запросу '{query}' не найдены.")
-                        return None
-
-                    def score(url: str) -> int:
-                        u = url.lower()
-                        score = 0
-                        # Предпочитаем форматы фото
-                        if any(u.endswith(ext) for ext in (".jpg", ".jpeg", ".png", ".webp")):
-                            score += 5
-                        if u.endswith(".svg"):
-                            score -= 3
-                        # Предпочитаем https
-                        if u.startswith("https://"):
-                            score += 1
-                        # Наказание за миниатюры/иконки
-                        if any(x in u for x in ("thumb", "thumbnail", "sprite", "icon", "logo-small")):
-                            score -= 2
-                        # Небольшой бонус за известные домены стоков (эвристика)
-                        if any(x in u for x in ("wikimedia", "static", "cdn")):
-                            score += 1
-                        return score
-
-                    best = sorted(candidates, key=score, reverse=True)[0]
-                    print(f"Выбрано изображение: {best}")
-                    return best
-                else:
-                    print(f"Ошибка XMLRiver Images API: Статус {response.status}, Тело ответа: {await response.text()}")
-                    return None
-    except Exception as e:
-        print(f"Исключение при поиске изображения: {e}")
-    
-    return None
\ No newline at end of file
+    # groupby=10: запросим топ-10, чтобы выбрать лучшую. Популярные запросы отдаются из кэша
+    return await fetch_xmlriver("images", [query], lr_code, groupby="10", limit=10)
+
+
+async def pick_image_url(query: str, candidates: list[SearchResult]) -> str | None:
+    """Выбирает лучшее изображение из кандидатов XMLRiver, проверяя лучших по адресу (ссылка жива, формат, размер)."""
+    # Лучшие по адресу кандидаты проверяем по-настоящему: жива ли ссылка, картинка ли это, какого она размера
+    ranked = sorted(candidates, key=_url_score, reverse=True)[:IMAGE_PROBE_TOP_K]
+    probes = await probe_images([c.url for c in ranked], IMAGE_PROBE_BUDGET_SECONDS)
+    scored = []
+    for candidate in ranked:
+        probe = probes.get(candidate.url)
+        if probe is None:
+            continue
+        probe_score = _probe_score(probe)
+        if probe_score is None:
+            logging.debug(f"Изображение отклонено: {candidate.url} ({probe.error or probe.mime}, {probe.width}x{probe.height}, {probe.size} байт)")
+            continue
+        scored.append((probe_score + _url_score(candidate), candidate))
+
+    if scored:
+        best = max(scored, key=lambda pair: pair[0])[1].url
+    else:
+        # Пробы не уложились в бюджет — берем лучший по адресу из непроверенных
+        unprobed = [c for c in ranked if c.url not in probes]
+        if not unprobed:
+            logging.info(f"Ни одно изображение по запросу '{query}' не прошло проверку.")
+            return None
+        best = unprobed[0].url
+    logging.info(f"Выбрано изображение: {best}")
+    return best
+
+
+async def find_creative_commons_image_url(query: str, lang_code: str = 'ru') -> str | None:
+    """
+    Ищет в Google Images через xmlriver.com изображение с лицензией Creative Commons.
+    """
+    candidates, _ = await search_image_candidates(query, lang_code)
+    if candidates is None:
+        return None
+    if not candidates:
+        logging.info(f"Изображения по запросу '{query}' не найдены.")
+        return None
+    return await pick_image_url(query, candidates)
+
+
+def build_speculative_image_query(theme: str, keywords: list[str]) -> str:
+    """Запрос для упреждающего поиска картинки по теме и первым ключевым словам сценария."""
+    return " ".join(part for part in [theme.strip()] + [k.strip() for k in keywords[:SPECULATIVE_IMAGE_KEYWORDS]] if part)
+
+
+def speculative_relevance(speculative_query: str, generated_text: str) -> float:
+    """Доля общих термов между упреждающим запросом и запросом/заголовком, которые сгенерировал ИИ."""
+    speculative_terms = set(tokenize(speculative_query))
+    generated_terms = set(tokenize(generated_text))
+    if not speculative_terms or not generated_terms:
+        return 0.0
+    return len(speculative_terms & generated_terms) / min(len(speculative_terms), len(generated_terms))
+
+
+def record_speculative_outcome(outcome: str):
+    _speculative_stats[outcome] += 1
+
+
+def speculative_image_stats() -> dict:
+    """Счетчики упреждающего поиска и доля запусков, где его картинка пригодилась."""
+    total = sum(_speculative_stats.values())
+    return {**_speculative_stats, "hit_rate": _speculative_stats["hit"] / total if total else 0.0}
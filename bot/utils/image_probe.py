@@ -0,0 +1,167 @@
+# bot/utils/image_probe.py
+
+import time
+import struct
+import asyncio
+import logging
+import aiohttp
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from bot import config
+from bot.utils.http_client import http_session
+
+# Сколько первых байт запрашивать: заголовка хватает почти всегда, кроме JPEG с большим EXIF
+IMAGE_PROBE_BYTES = config.IMAGE_PROBE_BYTES
+IMAGE_PROBE_CACHE_SECONDS = config.IMAGE_PROBE_CACHE_SECONDS
+IMAGE_PROBE_CACHE_SIZE = 2000
+
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+@dataclass
+class ImageProbe:
+    """Что удалось узнать о картинке по первым байтам: тип, реальные размеры, объем файла."""
+    url: str
+    ok: bool
+    mime: str | None = None
+    width: int | None = None
+    height: int | None = None
+    size: int | None = None
+    error: str | None = None
+    # Временная неудача (таймаут, сетевая ошибка, 5xx/429): о самой картинке ничего не говорит
+    transient: bool = False
+
+
+# Кэш проб: url -> (время пробы, результат)
+_probe_cache: OrderedDict[str, tuple[float, ImageProbe]] = OrderedDict()
+
+
+def _sniff_jpeg(data: bytes) -> tuple[int, int] | None:
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # байт-заполнитель
+            i += 1
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">HH", data[i + 5:i + 9])
+            return width, height
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            i += 2
+            continue
+        i += 2 + struct.unpack(">H", data[i + 2:i + 4])[0]
+    return None
+
+
+def _sniff_webp(data: bytes) -> tuple[int, int] | None:
+    chunk = data[12:16]
+    if chunk == b"VP8 " and len(data) >= 30:
+        width, height = struct.unpack("<HH", data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L" and len(data) >= 25:
+        b0, b1, b2, b3 = data[21:25]
+        return 1 + (((b1 & 0x3F) << 8) | b0), 1 + (((b3 & 0x0F) << 10) | (b2 << 2) | ((b1 & 0xC0) >> 6))
+    if chunk == b"VP8X" and len(data) >= 30:
+        return 1 + int.from_bytes(data[24:27], "little"), 1 + int.from_bytes(data[27:30], "little")
+    return None
+
+
+def sniff_image(data: bytes) -> tuple[str | None, int | None, int | None]:
+    """
+    Определяет формат и размеры картинки по заголовку (JPEG SOF, PNG IHDR, WebP VP8/VP8L/VP8X, GIF).
+    Возвращает (mime, ширина, высота); для не-картинок — (None, None, None).
+    """
+    if data.startswith(b"\x89PNG\r\n\x1a\n") and len(data) >= 24 and data[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", data[16:24])
+        return "image/png", width, height
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        width, height = struct.unpack("<HH", data[6:10])
+        return "image/gif", width, height
+    if data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+        dims = _sniff_webp(data)
+        return ("image/webp", *dims) if dims else ("image/webp", None, None)
+    if data.startswith(b"\xff\xd8"):
+        try:
+            dims = _sniff_jpeg(data)
+        except struct.error:
+            dims = None
+        return ("image/jpeg", *dims) if dims else ("image/jpeg", None, None)
+    return None, None, None
+
+
+def _total_size(response) -> int | None:
+    """Полный объем файла: из Content-Range при ответе 206, иначе из Content-Length."""
+    content_range = response.headers.get("Content-Range", "")
+    if "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get("Content-Length")
+    return int(length) if response.status == 200 and length and length.isdigit() else None
+
+
+async def _probe(url: str, timeout: float) -> ImageProbe:
+    headers = {"Range": f"bytes=0-{IMAGE_PROBE_BYTES - 1}", "User-Agent": "Mozilla/5.0"}
+    try:
+        async with http_session() as session:
+            async with session.get(url, headers=headers, timeout=timeout, allow_redirects=True) as response:
+                if response.status not in (200, 206):
+                    transient = response.status >= 500 or response.status in (408, 429)
+                    return ImageProbe(url, False, error=f"HTTP {response.status}", transient=transient)
+                content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+                if content_type and not content_type.startswith("image/") and content_type != "application/octet-stream":
+                    return ImageProbe(url, False, error=f"не картинка ({content_type})")
+                # Сервер может проигнорировать Range и отдавать весь файл: читаем только начало
+                data = b""
+                async for chunk in response.content.iter_chunked(8192):
+                    data += chunk
+                    if len(data) >= IMAGE_PROBE_BYTES:
+                        break
+                size = _total_size(response)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return ImageProbe(url, False, error=f"{type(e).__name__}: {e}", transient=True)
+    except ValueError as e:
+        return ImageProbe(url, False, error=f"{type(e).__name__}: {e}")
+
+    mime, width, height = sniff_image(data)
+    if mime is None:
+        return ImageProbe(url, False, size=size, error="неизвестный формат")
+    return ImageProbe(url, True, mime=mime, width=width, height=height, size=size)
+
+
+async def probe_image(url: str, timeout: float) -> ImageProbe:
+    """
+    Проба одной картинки с кэшем по URL (IMAGE_PROBE_CACHE_SECONDS). Временные неудачи
+    не кэшируются: иначе таймаут на час исключил бы исправную картинку.
+    """
+    cached = _probe_cache.get(url)
+    if cached and time.monotonic() - cached[0] < IMAGE_PROBE_CACHE_SECONDS:
+        _probe_cache.move_to_end(url)
+        return cached[1]
+    result = await _probe(url, timeout)
+    if result.transient:
+        _probe_cache.pop(url, None)
+        return result
+    _probe_cache[url] = (time.monotonic(), result)
+    _probe_cache.move_to_end(url)
+    while len(_probe_cache) > IMAGE_PROBE_CACHE_SIZE:
+        _probe_cache.popitem(last=False)
+    return result
+
+
+async def probe_images(urls: list[str], budget_seconds: float) -> dict[str, ImageProbe]:
+    """
+    Параллельно пробует картинки небольшими Range-запросами в пределах общего бюджета времени.
+    Не уложившиеся в бюджет пробы отменяются и в результат не попадают.
+    """
+    tasks = {asyncio.create_task(probe_image(url, budget_seconds)): url for url in dict.fromkeys(urls)}
+    if not tasks:
+        return {}
+    done, pending = await asyncio.wait(tasks, timeout=budget_seconds)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logging.debug(f"Пробы картинок: {len(pending)} из {len(tasks)} не уложились в {budget_seconds} сек.")
+    return {tasks[task]: task.result() for task in done if not task.cancelled() and task.exception() is None}
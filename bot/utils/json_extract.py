@@ -0,0 +1,177 @@
+# bot/utils/json_extract.py
+
+import re
+import json
+import logging
+
+# Ограждение ```json ... ``` (закрывающее может отсутствовать, если ответ обрезан)
+_FENCE_RE = re.compile(r"```(?:json|JSON)?\s*\n?(.*?)(?:```|$)", re.DOTALL)
+# Сноски Perplexity вида [1] или [1][2] сразу после значения
+_CITATION_RE = re.compile(r"\s*(?:\[\d{1,3}\])+")
+# Литералы JSON целиком (число может быть оборвано на середине, поэтому числа сюда не входят)
+_LITERAL_RE = re.compile(r"(?:true|false|null)\b")
+
+# Как был получен результат: 'direct' — ответ сразу валидный JSON, остальные — спасенные ответы
+_stats = {"direct": 0, "fenced": 0, "embedded": 0, "repaired": 0, "failed": 0}
+
+
+def _scan(text: str, start: int) -> tuple[str, bool]:
+    """
+    Проходит JSON-значение, начинающееся с text[start] ('{' или '['), учитывая строки.
+    Вне строк убирает сноски-цитаты после значений. Возвращает (очищенный текст значения, завершено ли оно).
+    Если значение оборвано, возвращает текст, дополненный до валидного по последней безопасной точке.
+    """
+    out = []
+    stack = []
+    in_string = False
+    escape = False
+    # Последний структурный символ вне строк: по нему понятно, ключ закрылся или значение
+    last_struct = ""
+    # Безопасные точки обрыва: (длина out, снимок стека) — после завершенного элемента контейнера
+    safe_points = []
+
+    def value_closed():
+        # Строка или литерал — целое значение элемента массива или поля объекта: обрыв после него безопасен
+        if stack and (last_struct == ":" if stack[-1] == "}" else last_struct in "[,"):
+            safe_points.append((len(out), list(stack)))
+
+    i = start
+    while i < len(text):
+        ch = text[i]
+        if in_string:
+            out.append(ch)
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+                value_closed()
+                m = _CITATION_RE.match(text, i + 1)
+                if m and m.end() > i + 1:
+                    i = m.end()
+                    continue
+            i += 1
+            continue
+
+        literal = _LITERAL_RE.match(text, i)
+        if literal:
+            out.append(literal.group())
+            value_closed()
+            i = literal.end()
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            last_struct = ch
+        elif ch in "}]":
+            if not stack or ch != stack[-1]:
+                break
+            stack.pop()
+            out.append(ch)
+            if not stack:
+                return "".join(out), True
+            safe_points.append((len(out), list(stack)))
+            m = _CITATION_RE.match(text, i + 1)
+            i = m.end() if m and m.end() > i + 1 else i + 1
+            continue
+        elif ch == ",":
+            safe_points.append((len(out), list(stack)))
+            last_struct = ch
+        elif ch == ":":
+            last_struct = ch
+        out.append(ch)
+        i += 1
+
+    # Значение оборвано: откатываемся к последнему завершенному элементу и закрываем контейнеры
+    if safe_points:
+        length, open_stack = safe_points[-1]
+        head = "".join(out[:length]).rstrip().rstrip(",")
+        return head + "".join(reversed(open_stack)), False
+    return "".join(out), False
+
+
+def _try_loads(text: str):
+    try:
+        return json.loads(text), True
+    except (json.JSONDecodeError, ValueError):
+        return None, False
+
+
+def extract_json(text: str, schema: dict | None = None):
+    """
+    Терпимо извлекает JSON из ответа модели: ограждения ```json, пояснения до и после,
+    сноски [1] после значений, оборванный на середине ответ. Если передана schema,
+    результат должен ей соответствовать (см. matches_schema), иначе ищется следующий кандидат.
+    Возвращает разобранное значение или None.
+    """
+    if not text:
+        _stats["failed"] += 1
+        return None
+    text = text.strip()
+
+    value, ok = _try_loads(text)
+    if ok and (schema is None or matches_schema(value, schema)):
+        _stats["direct"] += 1
+        return value
+
+    candidates = []
+    fence = _FENCE_RE.search(text)
+    if fence:
+        candidates.append(("fenced", fence.group(1).strip()))
+    candidates.append(("embedded", text))
+
+    for method, candidate in candidates:
+        value, ok = _try_loads(candidate)
+        if ok and (schema is None or matches_schema(value, schema)):
+            _stats[method] += 1
+            return value
+        # Перебираем начала JSON-значений: первое может оказаться скобкой в пояснении
+        for match in re.finditer(r"[{\[]", candidate):
+            body, complete = _scan(candidate, match.start())
+            value, ok = _try_loads(body)
+            if ok and (schema is None or matches_schema(value, schema)):
+                _stats[method if complete else "repaired"] += 1
+                return value
+
+    _stats["failed"] += 1
+    logging.warning(f"Не удалось извлечь JSON из ответа модели: {text[:300]}")
+    return None
+
+
+def matches_schema(value, schema: dict) -> bool:
+    """
+    Проверка значения по подмножеству JSON Schema: type (object/array/string/integer/number/boolean),
+    required, properties, items, minItems, anyOf. Этого достаточно для наших форматов ответов.
+    """
+    if "anyOf" in schema and not any(matches_schema(value, sub) for sub in schema["anyOf"]):
+        return False
+    expected = schema.get("type")
+    if expected == "object":
+        if not isinstance(value, dict):
+            return False
+        if any(key not in value for key in schema.get("required", [])):
+            return False
+        return all(matches_schema(value[key], sub) for key, sub in schema.get("properties", {}).items() if key in value)
+    if expected == "array":
+        if not isinstance(value, list) or len(value) < schema.get("minItems", 0):
+            return False
+        items = schema.get("items")
+        return items is None or all(matches_schema(item, items) for item in value)
+    if expected == "string":
+        return isinstance(value, str)
+    if expected == "integer":
+        return isinstance(value, int) and not isinstance(value, bool)
+    if expected == "number":
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if expected == "boolean":
+        return isinstance(value, bool)
+    return True
+
+
+def extraction_stats() -> dict:
+    """Счетчики извлечения и доля спасенных ответов среди тех, что не были валидным JSON сразу."""
+    salvaged = _stats["fenced"] + _stats["embedded"] + _stats["repaired"]
+    attempts = salvaged + _stats["failed"]
+    return {**_stats, "salvage_rate": salvaged / attempts if attempts else 0.0}
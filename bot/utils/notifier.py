@@ -0,0 +1,112 @@
+# bot/utils/notifier.py
+
+import asyncio
+import logging
+from aiogram import Bot
+
+from bot import config
+from bot.utils.localization import get_text
+from bot.utils.http_client import make_bot_session
+
+NOTIFICATION_DIGEST_WINDOW_SECONDS = config.NOTIFICATION_DIGEST_WINDOW_SECONDS
+
+# Причины, которые не зависят от конкретного сценария: в сводке достаточно одной строки
+USER_LEVEL_REASONS = {'limit_exceeded_error_job'}
+
+# Накопленные уведомления: user_id -> {"lang_code": str, "items": {(reason, scenario_name): count}}
+_pending: dict[int, dict] = {}
+# Отложенные задачи отправки сводки для каждого пользователя (пока ждут окончания окна)
+_flush_tasks: dict[int, asyncio.Task] = {}
+# Задачи, которые уже отправляют сводку: при остановке бота их дожидаются, а не отменяют
+_sending_tasks: set[asyncio.Task] = set()
+
+
+def _with_count(text: str, count: int) -> str:
+    return f"{text} (×{count})" if count > 1 else text
+
+
+def _format_item(lang_code: str, reason: str, scenario_name: str, count: int) -> str:
+    return _with_count(get_text(lang_code, reason, scenario_name=scenario_name, escape_html_chars=True), count)
+
+
+def _format_digest(lang_code: str, items: dict) -> str:
+    """Собирает одно сообщение из накопленных уведомлений."""
+    # Тексты, в которых нет названия сценария (например, generic_error_in_job), совпадают
+    # для разных сценариев: такие строки объединяются с общим счетчиком
+    lines_count: dict[str, int] = {}
+    for (reason, scenario_name), count in items.items():
+        text = get_text(lang_code, reason, scenario_name=scenario_name, escape_html_chars=True)
+        lines_count[text] = lines_count.get(text, 0) + count
+    if len(lines_count) == 1:
+        text, count = next(iter(lines_count.items()))
+        return _with_count(text, count)
+
+    minutes = max(1, NOTIFICATION_DIGEST_WINDOW_SECONDS // 60)
+    lines = [get_text(lang_code, 'job_failure_digest_header', minutes=minutes, escape_html_chars=True)]
+    lines.extend(_with_count(text, count) for text, count in lines_count.items())
+    return "\n\n".join(lines)
+
+
+async def _send(user_id: int, text: str):
+    # Импортируем здесь, чтобы избежать циклической зависимости со scheduler
+    from bot.utils.scheduler import send_message_with_retry
+
+    bot = Bot(token=config.BOT_TOKEN, parse_mode="HTML", session=make_bot_session())
+    try:
+        await send_message_with_retry(bot, user_id, text)
+    except Exception as e:
+        logging.error(f"Не удалось отправить сводку уведомлений пользователю {user_id}: {e}", exc_info=True)
+
+
+async def _flush_user(user_id: int):
+    entry = _pending.pop(user_id, None)
+    _flush_tasks.pop(user_id, None)
+    if not entry or not entry["items"]:
+        return
+    await _send(user_id, _format_digest(entry["lang_code"], entry["items"]))
+    logging.info(f"Отправлена сводка из {sum(entry['items'].values())} уведомлений пользователю {user_id}.")
+
+
+async def _flush_later(user_id: int):
+    await asyncio.sleep(NOTIFICATION_DIGEST_WINDOW_SECONDS)
+    task = _flush_tasks.pop(user_id, None)
+    if task is not None:
+        _sending_tasks.add(task)
+        task.add_done_callback(_sending_tasks.discard)
+    await _flush_user(user_id)
+
+
+async def notify_job_failure(user_id: int, lang_code: str, reason: str, scenario_name: str = ""):
+    """
+    Ставит уведомление о неудачном запуске сценария в сводку пользователя.
+    reason — ключ локализации (например, 'no_news_found_job_error').
+    Одинаковые уведомления (пользователь, причина, сценарий) за окно
+    NOTIFICATION_DIGEST_WINDOW_SECONDS схлопываются в одну строку со счетчиком.
+    """
+    if reason in USER_LEVEL_REASONS:
+        scenario_name = ""
+
+    if NOTIFICATION_DIGEST_WINDOW_SECONDS <= 0:
+        await _send(user_id, _format_item(lang_code, reason, scenario_name, 1))
+        return
+
+    entry = _pending.setdefault(user_id, {"lang_code": lang_code, "items": {}})
+    entry["lang_code"] = lang_code or entry["lang_code"]
+    key = (reason, scenario_name or "")
+    entry["items"][key] = entry["items"].get(key, 0) + 1
+
+    if user_id not in _flush_tasks:
+        _flush_tasks[user_id] = asyncio.create_task(_flush_later(user_id))
+        logging.debug(f"Запланирована сводка уведомлений для пользователя {user_id} через {NOTIFICATION_DIGEST_WINDOW_SECONDS} сек.")
+
+
+async def flush_all_digests():
+    """Немедленно отправляет все накопленные сводки (например, при остановке бота)."""
+    # Отменяются только ожидающие окна задачи; уже начатые отправки доводятся до конца
+    for task in list(_flush_tasks.values()):
+        task.cancel()
+    _flush_tasks.clear()
+    if _sending_tasks:
+        await asyncio.gather(*_sending_tasks, return_exceptions=True)
+    for user_id in list(_pending.keys()):
+        await _flush_user(user_id)
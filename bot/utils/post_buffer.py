@@ -0,0 +1,151 @@
+# bot/utils/post_buffer.py
+
+import json
+import hashlib
+import logging
+import asyncpg
+
+from bot import config
+from bot.utils.fetch_cache import normalize_url
+from bot.utils.content_dedup import record_content_fingerprint, filter_duplicate_content
+
+POST_BUFFER_TTL_HOURS = config.POST_BUFFER_TTL_HOURS
+POST_BUFFER_MAX_SIZE = config.POST_BUFFER_MAX_SIZE
+CONTENT_DEDUP = config.CONTENT_DEDUP
+
+
+def hash_source_url(url: str) -> str:
+    """Хеш URL источника в том же виде, в каком он хранится в published_posts."""
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+async def filter_unpublished_posts(db_pool: asyncpg.Pool, channel_id: int, posts: list[dict]) -> list[dict]:
+    """
+    Оставляет только посты, источники которых еще не публиковались в канале.
+    Источник сравнивается и как есть, и в нормализованном виде (без utm-меток, фрагмента и т.п.).
+    Сохраняет порядок и убирает повторы источников внутри самого списка.
+    """
+    hashes = [hash_source_url(p['source_url']) for p in posts]
+    normalized_hashes = [hash_source_url(normalize_url(p['source_url'])) for p in posts]
+    published = await db_pool.fetch(
+        """
+        SELECT source_url_hash, normalized_url_hash FROM published_posts
+        WHERE channel_id = $1
+          AND (source_url_hash = ANY($2::varchar[]) OR source_url_hash = ANY($3::varchar[]) OR normalized_url_hash = ANY($3::varchar[]))
+        """,
+        channel_id, hashes, normalized_hashes
+    )
+    seen = {r['source_url_hash'] for r in published} | {r['normalized_url_hash'] for r in published if r['normalized_url_hash']}
+    result = []
+    for post, link_hash, normalized_hash in zip(posts, hashes, normalized_hashes):
+        if link_hash in seen or normalized_hash in seen:
+            continue
+        seen.update((link_hash, normalized_hash))
+        result.append(post)
+    return result
+
+
+async def record_published_post(conn: asyncpg.Pool | asyncpg.Connection, channel_id: int, source_url: str,
+                                post_text: str | None, content_fingerprint: int | None = None):
+    """Запоминает опубликованный пост: хеши URL источника (как есть и нормализованного) и отпечаток содержимого статьи."""
+    await conn.execute(
+        """
+        INSERT INTO published_posts (channel_id, source_url_hash, normalized_url_hash, content_fingerprint, post_text)
+        VALUES ($1, $2, $3, $4, $5) ON CONFLICT DO NOTHING
+        """,
+        channel_id, hash_source_url(source_url), hash_source_url(normalize_url(source_url)), content_fingerprint, post_text
+    )
+    await record_content_fingerprint(conn, channel_id, content_fingerprint)
+
+
+async def _pop_oldest_buffered_post(db_pool: asyncpg.Pool, scenario_id: int, channel_id: int) -> dict | None:
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                """
+                DELETE FROM scenario_post_buffer
+                WHERE scenario_id = $1
+                  AND (expires_at <= NOW()
+                       OR source_url_hash IN (SELECT source_url_hash FROM published_posts WHERE channel_id = $2))
+                """,
+                scenario_id, channel_id
+            )
+            post_data = await conn.fetchval(
+                """
+                DELETE FROM scenario_post_buffer
+                WHERE id = (
+                    SELECT id FROM scenario_post_buffer
+                    WHERE scenario_id = $1
+                    ORDER BY created_at, id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING post_data
+                """,
+                scenario_id
+            )
+    return json.loads(post_data) if post_data else None
+
+
+async def pop_buffered_post(db_pool: asyncpg.Pool, scenario_id: int, channel_id: int) -> dict | None:
+    """
+    Забирает из буфера сценария самый старый свежий пост, источник которого еще не публиковался.
+    Просроченные и уже опубликованные записи попутно удаляются. Пост проходит те же проверки,
+    что и новые кандидаты: нормализованный URL и (при CONTENT_DEDUP) отпечаток содержимого.
+    """
+    while True:
+        post = await _pop_oldest_buffered_post(db_pool, scenario_id, channel_id)
+        if post is None:
+            return None
+        if not await filter_unpublished_posts(db_pool, channel_id, [post]):
+            logging.info(f"Сценарий #{scenario_id}: Источник поста из буфера уже публиковался под другим адресом: {post['source_url']}")
+            continue
+        # Отпечаток отложенного поста уже посчитан: проверка идет без загрузки страницы
+        if CONTENT_DEDUP and not await filter_duplicate_content(db_pool, channel_id, [post]):
+            continue
+        return post
+
+
+async def push_buffered_posts(db_pool: asyncpg.Pool, scenario_id: int, channel_id: int, posts: list[dict]):
+    """
+    Складывает запасные посты в буфер сценария со сроком годности POST_BUFFER_TTL_HOURS.
+    В буфере остаются только POST_BUFFER_MAX_SIZE самых свежих записей.
+    """
+    if not posts or POST_BUFFER_MAX_SIZE <= 0:
+        return
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany(
+                    """
+                    INSERT INTO scenario_post_buffer (scenario_id, channel_id, source_url_hash, post_data, expires_at)
+                    VALUES ($1, $2, $3, $4::jsonb, NOW() + make_interval(hours => $5))
+                    ON CONFLICT (scenario_id, source_url_hash) DO NOTHING
+                    """,
+                    [(scenario_id, channel_id, hash_source_url(p['source_url']), json.dumps(p, ensure_ascii=False), POST_BUFFER_TTL_HOURS) for p in posts]
+                )
+                await conn.execute(
+                    """
+                    DELETE FROM scenario_post_buffer
+                    WHERE scenario_id = $1 AND id NOT IN (
+                        SELECT id FROM scenario_post_buffer WHERE scenario_id = $1
+                        -- У постов одной пачки created_at одинаковый (NOW() транзакции): среди них
+                        -- оставляем первые по порядку Sonar, т.е. с меньшим id
+                        ORDER BY created_at DESC, id LIMIT $2
+                    )
+                    """,
+                    scenario_id, POST_BUFFER_MAX_SIZE
+                )
+        logging.info(f"Сценарий #{scenario_id}: В буфер отложено готовых постов: {len(posts)}.")
+    except Exception as e:
+        logging.error(f"Сценарий #{scenario_id}: Не удалось сохранить посты в буфер: {e}", exc_info=True)
+
+
+async def clear_channel_post_buffer(conn: asyncpg.Pool | asyncpg.Connection, channel_id: int):
+    """Очищает буферы всех сценариев канала (например, после смены паспорта стиля или языка)."""
+    await conn.execute("DELETE FROM scenario_post_buffer WHERE channel_id = $1", channel_id)
+
+
+async def clear_scenario_post_buffer(conn: asyncpg.Pool | asyncpg.Connection, scenario_id: int):
+    """Очищает буфер сценария (после смены темы или ключевых слов: отложенные посты о другом)."""
+    await conn.execute("DELETE FROM scenario_post_buffer WHERE scenario_id = $1", scenario_id)
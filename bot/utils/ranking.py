@@ -0,0 +1,92 @@
+# bot/utils/ranking.py
+
+import math
+import hashlib
+import datetime
+from collections import Counter
+from dataclasses import dataclass, field
+
+from bot import config
+from bot.utils.tokens import tokenize
+
+RANKING_RECENCY_HALF_LIFE_HOURS = config.RANKING_RECENCY_HALF_LIFE_HOURS
+
+# Параметры BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Заголовок весомее сниппета: его токены учитываются несколько раз
+TITLE_WEIGHT = 2
+# Ключевые слова сценария весомее слов из темы
+KEYWORD_WEIGHT = 1.5
+
+
+@dataclass
+class RankingQuery:
+    """Предрассчитанный запрос сценария: термы с весами."""
+    terms: dict[str, float] = field(default_factory=dict)
+
+
+def build_query(theme: str, keywords: list[str]) -> RankingQuery:
+    terms: dict[str, float] = {}
+    for term in tokenize(theme):
+        terms[term] = max(terms.get(term, 0.0), 1.0)
+    for keyword in keywords or []:
+        for term in tokenize(keyword):
+            terms[term] = max(terms.get(term, 0.0), KEYWORD_WEIGHT)
+    return RankingQuery(terms)
+
+
+# Запросы сценариев: scenario_id -> (отпечаток темы и ключевых слов, запрос)
+_scenario_queries: dict[int, tuple[str, RankingQuery]] = {}
+
+
+def get_scenario_query(scenario_id: int, theme: str, keywords: list[str]) -> RankingQuery:
+    """Запрос сценария строится один раз и пересобирается, только если изменились тема или ключевые слова."""
+    fingerprint = hashlib.sha1("\x00".join([theme or ""] + list(keywords or [])).encode()).hexdigest()
+    cached = _scenario_queries.get(scenario_id)
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+    query = build_query(theme, keywords)
+    _scenario_queries[scenario_id] = (fingerprint, query)
+    return query
+
+
+def _recency_factor(published_at: datetime.datetime | None, now: datetime.datetime) -> float:
+    """Множитель свежести: статья возрастом в период полураспада получает половину веса, но не меньше 0.25."""
+    if not published_at or RANKING_RECENCY_HALF_LIFE_HOURS <= 0:
+        return 1.0
+    age_hours = max(0.0, (now - published_at).total_seconds() / 3600)
+    return max(0.25, 0.5 ** (age_hours / RANKING_RECENCY_HALF_LIFE_HOURS))
+
+
+def rank_articles(articles: list[dict], query: RankingQuery, now: datetime.datetime | None = None) -> list[tuple[float, dict]]:
+    """
+    Ранжирует статьи ({url, title, passages[, published_at]}) по BM25 относительно запроса сценария.
+    Статистика IDF считается по самим кандидатам. Возвращает пары (оценка, статья) по убыванию оценки.
+    """
+    if not articles:
+        return []
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    documents = [
+        tokenize(a.get("title")) * TITLE_WEIGHT + tokenize(a.get("passages"))
+        for a in articles
+    ]
+    counts = [Counter(doc) for doc in documents]
+    avg_len = sum(len(doc) for doc in documents) / len(documents) or 1.0
+    total = len(documents)
+    idf = {
+        term: math.log(1 + (total - df + 0.5) / (df + 0.5))
+        for term in query.terms
+        for df in [sum(1 for c in counts if term in c)]
+    }
+
+    ranked = []
+    for article, doc, tf in zip(articles, documents, counts):
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * len(doc) / avg_len)
+        score = sum(
+            weight * idf[term] * tf[term] * (BM25_K1 + 1) / (tf[term] + norm)
+            for term, weight in query.terms.items() if tf[term]
+        )
+        ranked.append((score * _recency_factor(article.get("published_at"), now), article))
+    ranked.sort(key=lambda pair: pair[0], reverse=True)
+    return ranked
@@ -1,5 +1,5 @@
 import json
-import hashlib
+import asyncio
 import logging
 import asyncpg
 from aiogram import Bot
@@ -16,14 +16,26 @@ import re # Импортируем re для регулярных выражен
 
 from bot import config
 from bot.utils.subscription_check import has_generations, decrement_generation_limit
-from bot.utils.search_engine import search_news
-from bot.utils.image_handler import find_creative_commons_image_url
+from bot.utils.image_handler import (
+    search_image_candidates, pick_image_url,
+    build_speculative_image_query, speculative_relevance, record_speculative_outcome
+)
 from bot.utils.article_parser import get_article_text
-from bot.utils.ai_generator import generate_post_via_sonar
+from bot.utils.ai_generator import generate_posts_via_sonar, route_retry_after
+from bot.utils.post_buffer import pop_buffered_post, push_buffered_posts, filter_unpublished_posts, record_published_post
+from bot.utils.content_dedup import filter_duplicate_content
 from bot.keyboards.inline import get_moderation_keyboard
-from bot.utils.localization import get_text, escape_html
-from bot.config import SEARCH_QUERY_COST, AI_TOKEN_COST_PER_1000, BOT_TOKEN, SONAR_REQUEST_COST_RUB, AI_TOKEN_COST_PER_1M_RUB, MIN_SCENARIO_INTERVAL_MINUTES
-from bot.utils.ai_generator import generate_content_robust, select_best_articles_from_search_results
+from bot.utils.localization import escape_html
+from bot.utils.notifier import notify_job_failure
+from bot.utils.http_client import make_bot_session
+from bot.utils.accounting import record_usage, record_ai_usage
+from bot.utils.telegram_files import send_photo_cached
+from bot.utils.style_passport_jobs import add_style_passport_refresh_job
+from bot.config import SEARCH_QUERY_COST, AI_TOKEN_COST_PER_1000, BOT_TOKEN, SONAR_REQUEST_COST_RUB, AI_TOKEN_COST_PER_1M_RUB, MIN_SCENARIO_INTERVAL_MINUTES, SCENARIO_MAX_DEFER_SECONDS
+from bot.config import SPECULATIVE_IMAGE_SEARCH, SPECULATIVE_IMAGE_MIN_RELEVANCE, VERIFY_SONAR_SOURCES, CONTENT_DEDUP, SEARCH_FALLBACK
+from bot.utils.search_pipeline import find_post_via_search
+from bot.utils.fetch_coordinator import fetch_first_articles
+from bot.utils.ai_generator import generate_content_robust
 from decimal import Decimal
 
 logger = logging.getLogger(__name__)
@@ -50,13 +62,29 @@ async def generate_content_robust_with_logging(prompt: str, scenario_id: int, ta
     # и он уже передан в process_scenario_job
     success, result, token_count = await generate_content_robust(prompt) # generate_content_robust не принимает target_lang_code
     if success and token_count > 0:
-        try:
-            # db_pool должен быть доступен в контексте
-            await db_pool_global.execute("INSERT INTO ai_usage (scenario_id, tokens_used) VALUES ($1, $2)", scenario_id, token_count)
-        except Exception as e:
-            logging.error(f"Ошибка при сохранении данных об использовании AI: {e}", exc_info=True)
+        # Запись уходит в БД пачкой из буфера учета
+        record_ai_usage(scenario_id, token_count)
     return success, result, token_count
 
+async def _image_search_result(task: asyncio.Task, scenario_id: int) -> tuple[list | None, int]:
+    """(кандидаты, оплаченные запросы) фонового поиска картинок; его ошибка не должна проваливать готовый пост."""
+    try:
+        return await task
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.warning(f"Сценарий #{scenario_id}: Фоновый поиск изображения завершился ошибкой: {e}", exc_info=True)
+        return None, 0
+
+
+def _discard_image_search(task: asyncio.Task):
+    """Отменяет ненужный фоновый поиск картинок; ошибку уже завершенного забираем, чтобы она не попала в лог как необработанная."""
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled():
+        task.exception()
+
+
 async def process_scenario_job(scenario_id: int, user_id: int, channel_id: int):
     logging.info(f"--- ЗАПУСК ЗАДАЧИ ДЛЯ СЦЕНАРИЯ #{scenario_id} ---\n")
     
@@ -64,8 +92,13 @@ async def process_scenario_job(scenario_id: int, user_id: int, channel_id: int):
     total_search_queries = 0
     total_sonar_requests = 0
     total_image_queries = 0
+    # Поиски кандидатов-изображений, запущенные досрочно (пока Sonar еще генерирует): image_query -> Task
+    early_image_searches: dict[str, asyncio.Task] = {}
+    # Упреждающий поиск картинки по теме сценария, запущенный вместе с генерацией
+    speculative_image_task: asyncio.Task | None = None
+    speculative_image_query = ""
 
-    bot = Bot(token=config.BOT_TOKEN, parse_mode="HTML")
+    bot = Bot(token=config.BOT_TOKEN, parse_mode="HTML", session=make_bot_session())
     global db_pool_global # Объявляем, что будем использовать глобальную переменную
     db_pool_global = None
     user_lang_code = 'ru' # Default language
@@ -86,8 +119,7 @@ async def process_scenario_job(scenario_id: int, user_id: int, channel_id: int):
         
         can_generate = await has_generations(user_id, db_pool)
         if not can_generate:
-            msg = get_text(user_lang_code, 'limit_exceeded_error_job', escape_html_chars=True)
-            await send_message_with_retry(bot, user_id, msg)
+            await notify_job_failure(user_id, user_lang_code, 'limit_exceeded_error_job')
             logging.warning(f"Сценарий #{scenario_id}: Лимит генераций исчерпан. Задача не запущена.")
             return
 
@@ -101,86 +133,154 @@ async def process_scenario_job(scenario_id: int, user_id: int, channel_id: int):
         theme = scenario.get('theme', '')
         keywords = [k.strip() for k in (scenario.get('keywords') or '').split(',') if k.strip()]
 
-        success_sonar, sonar_data, tokens_used_sonar = await generate_post_via_sonar(
-            theme,
-            keywords,
-            user_lang_code,
-            style_passport=(channel.get('style_passport') or ''),
-            activity_description=(channel.get('activity_description') or ''),
-            generation_language=(channel.get('generation_language') or user_lang_code or 'ru')
-        )
-        total_ai_tokens += tokens_used_sonar
-        total_sonar_requests += 1
+        channel_generation_language = channel.get('generation_language') or 'ru' # Default to Russian
 
-        if not success_sonar:
-            logging.info(f"Сценарий #{scenario_id}: Sonar не нашел подходящую свежую новость или вернул ошибку: {sonar_data}")
-            await send_message_with_retry(bot, user_id, get_text(user_lang_code, 'no_news_found_job_error', scenario_name=scenario['scenario_name'], escape_html_chars=True))
-            return
+        def start_early_image_search(query: str):
+            if scenario['media_strategy'] == 'text_plus_media' and query and query not in early_image_searches:
+                logging.debug(f"Сценарий #{scenario_id}: Досрочный поиск изображения по запросу: {query}")
+                early_image_searches[query] = asyncio.create_task(search_image_candidates(query, channel_generation_language))
+
+        # Сначала пробуем готовый пост из буфера сценария — без обращения к провайдеру
+        sonar_data = await pop_buffered_post(db_pool, scenario_id, channel_id)
+        if sonar_data:
+            logging.info(f"Сценарий #{scenario_id}: Используем готовый пост из буфера: {sonar_data.get('source_url')}")
+        else:
+            # Причина неудачи пути через Sonar (ключ локализации); None — Sonar дал пост
+            sonar_failure = None
+            # Если провайдер заведомо нездоров, ждем восстановления или пропускаем его, не тратя деньги
+            retry_after = route_retry_after("discovery")
+            if 0 < retry_after <= SCENARIO_MAX_DEFER_SECONDS:
+                logging.info(f"Сценарий #{scenario_id}: Провайдер генерации недоступен, запуск отложен на {retry_after:.0f} сек.")
+                await asyncio.sleep(retry_after)
+                retry_after = route_retry_after("discovery")
+            if retry_after > 0:
+                logging.warning(f"Сценарий #{scenario_id}: Провайдер генерации недоступен.")
+                sonar_failure = 'provider_unavailable_job_error'
+            else:
+                if SPECULATIVE_IMAGE_SEARCH and scenario['media_strategy'] == 'text_plus_media':
+                    speculative_image_query = build_speculative_image_query(theme, keywords)
+                    if speculative_image_query:
+                        logging.debug(f"Сценарий #{scenario_id}: Упреждающий поиск изображения по теме: {speculative_image_query}")
+                        # Заранее запрашиваются только кандидаты XMLRiver; проверка картинок — после решения о релевантности
+                        speculative_image_task = asyncio.create_task(search_image_candidates(speculative_image_query, channel_generation_language))
+
+                success_sonar, sonar_result, tokens_used_sonar = await generate_posts_via_sonar(
+                    theme,
+                    keywords,
+                    user_lang_code,
+                    style_passport=(channel.get('style_passport') or ''),
+                    activity_description=(channel.get('activity_description') or ''),
+                    generation_language=(channel.get('generation_language') or user_lang_code or 'ru'),
+                    on_image_query=start_early_image_search,
+                    style_passport_tokens=channel.get('style_passport_tokens'),
+                    activity_description_tokens=channel.get('activity_description_tokens'),
+                    channel_id=channel_id
+                )
+                total_ai_tokens += tokens_used_sonar
+                total_sonar_requests += sonar_result.get('sonar_requests', 1)
+
+                candidates = [p for p in sonar_result['posts'] if p.get('source_url') and (p.get('title') or p.get('body'))] if success_sonar else []
+                # Проверка на дубликаты источников: дубликат не проваливает запуск, а уступает место следующему кандидату
+                fresh_candidates = await filter_unpublished_posts(db_pool, channel_id, candidates) if candidates else []
+                if CONTENT_DEDUP and fresh_candidates:
+                    # Та же новость в перепечатке другого издания или по ссылке с другими параметрами
+                    fresh_candidates = await filter_duplicate_content(db_pool, channel_id, fresh_candidates)
+
+                if not success_sonar:
+                    logging.info(f"Сценарий #{scenario_id}: Sonar не нашел подходящую свежую новость или вернул ошибку: {sonar_result}")
+                    sonar_failure = 'no_news_found_job_error'
+                elif not candidates:
+                    logging.warning(f"Сценарий #{scenario_id}: Sonar вернул неполные данные: {sonar_result}")
+                    sonar_failure = 'generic_error_in_job'
+                elif not fresh_candidates:
+                    logging.info(f"Сценарий #{scenario_id}: Все предложенные Sonar статьи уже были опубликованы.")
+                    sonar_failure = 'no_unique_news_found_job_error'
+                else:
+                    if VERIFY_SONAR_SOURCES and len(fresh_candidates) > 1:
+                        # Все источники загружаются одновременно; первый открывшийся со статьей идет в публикацию
+                        verified = await fetch_first_articles([p['source_url'] for p in fresh_candidates], needed=1)
+                        if verified:
+                            verified_url = verified[0][0]
+                            fresh_candidates.sort(key=lambda p: p['source_url'] != verified_url)
+                        else:
+                            logging.info(f"Сценарий #{scenario_id}: Ни один источник Sonar не удалось проверить, берем первый кандидат.")
+
+                    sonar_data = fresh_candidates[0]
+                    await push_buffered_posts(db_pool, scenario_id, channel_id, fresh_candidates[1:])
+
+            if sonar_failure and SEARCH_FALLBACK:
+                # Запасной путь: поиск XMLRiver с локальным выбором статей и постом по тексту статьи
+                logging.info(f"Сценарий #{scenario_id}: Пробуем подготовить пост через поиск.")
+                sonar_data, tokens_used_search, paid_search_queries = await find_post_via_search(
+                    db_pool, scenario_id, channel_id, theme, keywords, user_lang_code,
+                    style_passport=(channel.get('style_passport') or ''),
+                    activity_description=(channel.get('activity_description') or '')
+                )
+                total_ai_tokens += tokens_used_search
+                total_search_queries += paid_search_queries
+            if not sonar_data:
+                await notify_job_failure(user_id, user_lang_code, sonar_failure, scenario['scenario_name'])
+                return
 
         final_article_url = sonar_data.get('source_url') or ''
         post_title = sonar_data.get('title') or ''
         post_body = sonar_data.get('body') or ''
         image_query = sonar_data.get('image_query') or ''
 
-        if not final_article_url or not (post_title or post_body):
-            logging.warning(f"Сценарий #{scenario_id}: Sonar вернул неполные данные: {sonar_data}")
-            await send_message_with_retry(bot, user_id, get_text(user_lang_code, 'generic_error_in_job', escape_html_chars=True))
-            return
-
-        # Проверка на дубликаты источника
-        link_hash = hashlib.sha256(final_article_url.encode()).hexdigest()
-        query = "SELECT source_url_hash FROM published_posts WHERE channel_id = $1 AND source_url_hash = $2"
-        already_published = await db_pool.fetchval(query, channel_id, link_hash)
-        if already_published:
-            logging.info(f"Сценарий #{scenario_id}: Выбранная Sonar статья уже была опубликована: {final_article_url}.")
-            await send_message_with_retry(bot, user_id, get_text(user_lang_code, 'no_unique_news_found_job_error', scenario_name=scenario['scenario_name'], escape_html_chars=True))
-            return
-
-        # Проверка на дубликаты после выбора и парсинга
-        link_hash = hashlib.sha256(final_article_url.encode()).hexdigest()
-        query = "SELECT source_url_hash FROM published_posts WHERE channel_id = $1 AND source_url_hash = $2"
-        already_published = await db_pool.fetchval(query, channel_id, link_hash)
-
-        if already_published:
-            logging.info(f"Сценарий #{scenario_id}: Выбранная статья уже была опубликована: {final_article_url}.")
-            await send_message_with_retry(bot, user_id, get_text(user_lang_code, 'no_unique_news_found_job_error', scenario_name=scenario['scenario_name'], escape_html_chars=True))
-            return
-
         image_url = None
-        channel_generation_language = channel.get('generation_language') or 'ru' # Default to Russian
 
         # Теперь пост уже сгенерирован Sonar, только формируем финальный текст
         post_text = f"<b>{post_title}</b>\n\n{post_body}" if post_title else post_body
 
+        # Досрочные поиски обычно уже завершены: ждем их, чтобы учесть фактическую оплату
+        # (ответ из кэша и объединенный запрос бесплатны), даже если их результат не пригодится
+        early_image_results = {}
+        for query, task in list(early_image_searches.items()):
+            early_image_results[query] = await _image_search_result(task, scenario_id)
+            total_image_queries += early_image_results[query][1]
+        early_image_searches.clear()
+
+        # Упреждающая картинка годится, если запрос ИИ и заголовок о том же, что и тема сценария
+        if speculative_image_task and scenario['media_strategy'] == 'text_plus_media':
+            relevance = speculative_relevance(speculative_image_query, f"{image_query} {post_title}")
+            # Запрос ушел до генерации и обычно уже завершен; отменять его бессмысленно — ждем,
+            # чтобы учесть фактическую оплату (ответ из кэша и объединенный запрос бесплатны)
+            speculative_candidates, paid_image_queries = await _image_search_result(speculative_image_task, scenario_id)
+            total_image_queries += paid_image_queries
+            if relevance >= SPECULATIVE_IMAGE_MIN_RELEVANCE:
+                image_url = await pick_image_url(speculative_image_query, speculative_candidates) if speculative_candidates else None
+                record_speculative_outcome('hit' if image_url else 'empty')
+            else:
+                record_speculative_outcome('irrelevant')
+            logging.info(f"Сценарий #{scenario_id}: Упреждающий поиск изображения: релевантность {relevance:.2f}, {'использован' if image_url else 'не использован'}.")
+
         # Если стратегия "Текст + Медиа" и ИИ сгенерировал запрос изображения, ищем изображение
-        if scenario['media_strategy'] == 'text_plus_media' and image_query:
+        if scenario['media_strategy'] == 'text_plus_media' and image_query and not image_url:
             logging.debug(f"Сценарий #{scenario_id}: Сгенерированный запрос для изображения: {image_query}")
-            image_url = await find_creative_commons_image_url(image_query, channel_generation_language)
-            total_image_queries += 1 if image_url is not None else 1
+            if image_query in early_image_results:
+                image_candidates = early_image_results[image_query][0]
+            else:
+                image_candidates, paid_image_queries = await search_image_candidates(image_query, channel_generation_language)
+                total_image_queries += paid_image_queries
+            image_url = await pick_image_url(image_query, image_candidates) if image_candidates else None
             if not image_url:
                 logging.warning(f"Сценарий #{scenario_id}: Не удалось найти изображение для запроса: {image_query}")
-        elif scenario['media_strategy'] == 'text_plus_media' and not image_query:
+        elif scenario['media_strategy'] == 'text_plus_media' and not image_query and not image_url:
             logging.warning(f"Сценарий #{scenario_id}: Стратегия 'Текст + Медиа', но ИИ не сгенерировал запрос для изображения.")
 
         # Если все успешно, списываем генерацию
         await decrement_generation_limit(user_id, db_pool) # Переносим сюда
 
-        # Логируем расходы/доходы в ledger
-        try:
-            # Стоимость токенов: 1,000,000 токенов = 120 руб => 0.00012 руб/токен
-            cost_per_token = 120 / 1_000_000
-            cost_tokens_rub = total_ai_tokens * cost_per_token
-            # Стоимость запросов: SEARCH_QUERY_COST за каждый поисковый/картинковый запрос
-            cost_requests_rub = (total_search_queries + total_image_queries) * SEARCH_QUERY_COST
-            await db_pool.execute(
-                """
-                INSERT INTO usage_ledger (user_id, scenario_id, kind, is_free, tokens_used, sonar_requests, image_requests, cost_tokens, cost_requests, revenue)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
-                """,
-                user_id, scenario_id, 'post', True, total_ai_tokens, total_search_queries, total_image_queries, cost_tokens_rub, cost_requests_rub, 0
-            )
-        except Exception as e:
-            logging.error(f"Не удалось записать usage_ledger: {e}", exc_info=True)
+        # Логируем расходы/доходы в ledger (через буфер учета, без записи в БД на этом пути)
+        # Стоимость токенов: 1,000,000 токенов = 120 руб => 0.00012 руб/токен
+        cost_per_token = 120 / 1_000_000
+        cost_tokens_rub = total_ai_tokens * cost_per_token
+        # Стоимость запросов: SEARCH_QUERY_COST за каждый поисковый/картинковый запрос
+        cost_requests_rub = (total_search_queries + total_image_queries) * SEARCH_QUERY_COST
+        record_usage(
+            user_id, scenario_id, 'post', True, total_ai_tokens, total_search_queries, total_image_queries,
+            cost_tokens_rub, cost_requests_rub, 0
+        )
         logging.info(f"Сценарий #{scenario_id}: Генерация успешно списана с пользователя {user_id}.")
 
         # Экранируем текст поста для HTML перед отправкой
@@ -191,47 +291,53 @@ async def process_scenario_job(scenario_id: int, user_id: int, channel_id: int):
             # Генерируем уникальный ID для модерации
             moderation_id = str(uuid.uuid4())
             await db_pool.execute(
-                "INSERT INTO pending_moderation_posts (moderation_id, channel_id, article_url) VALUES ($1, $2, $3)",
-                moderation_id, channel_id, final_article_url
+                "INSERT INTO pending_moderation_posts (moderation_id, channel_id, article_url, content_fingerprint) VALUES ($1, $2, $3, $4)",
+                moderation_id, channel_id, final_article_url, sonar_data.get('content_fingerprint')
             )
 
             keyboard = get_moderation_keyboard(user_lang_code, channel_id, moderation_id) # Передаем moderation_id
             if image_url and scenario['media_strategy'] == 'text_plus_media':
-                await bot.send_photo(chat_id=user_id, photo=image_url, caption=escaped_post_text, reply_markup=keyboard)
+                await send_photo_cached(bot, db_pool, user_id, image_url, caption=escaped_post_text, reply_markup=keyboard)
             else:
                 await send_message_with_retry(bot, user_id, escaped_post_text, reply_markup=keyboard)
             logging.info(f"Сценарий #{scenario_id}: Пост отправлен на модерацию пользователю {user_id}. Moderation ID: {moderation_id}")
             
         else: # Режим прямой публикации
             if image_url and scenario['media_strategy'] == 'text_plus_media':
-                await bot.send_photo(chat_id=channel_id, photo=image_url, caption=escaped_post_text)
+                await send_photo_cached(bot, db_pool, channel_id, image_url, caption=escaped_post_text)
             else:
                 await send_message_with_retry(bot, channel_id, escaped_post_text)
             
             logging.info(f"Сценарий #{scenario_id}: ОПУБЛИКОВАН ПОСТ в канал {channel_id}. URL: {final_article_url}")
             
             # Сохраняем хеш опубликованной статьи
-            await db_pool.execute("INSERT INTO published_posts (channel_id, source_url_hash) VALUES ($1, $2)", channel_id, link_hash)
+            await record_published_post(db_pool, channel_id, final_article_url, post_text, sonar_data.get('content_fingerprint'))
 
     except ClientConnectorError as e:
         logging.error(f"Сценарий #{scenario_id}: Сетевая ошибка при выполнении фоновой задачи: {e}", exc_info=True)
-        await send_message_with_retry(bot, user_id, get_text(user_lang_code, 'generic_error_in_job', escape_html_chars=True))
+        await notify_job_failure(user_id, user_lang_code, 'generic_error_in_job')
     except TelegramNetworkError as e:
         logging.error(f"Сценарий #{scenario_id}: Ошибка Telegram API при выполнении фоновой задачи: {e}", exc_info=True)
-        await send_message_with_retry(bot, user_id, get_text(user_lang_code, 'generic_error_in_job', escape_html_chars=True))
+        await notify_job_failure(user_id, user_lang_code, 'generic_error_in_job')
     except Exception as e:
         logging.critical(f"Критическая ошибка в scheduled job #{scenario_id}: {e}", exc_info=True)
         try:
-            await send_message_with_retry(bot, user_id, get_text(user_lang_code, 'generic_error_in_job', escape_html_chars=True))
+            await notify_job_failure(user_id, user_lang_code, 'generic_error_in_job')
         except Exception as send_e:
             logging.error(f"Не удалось уведомить пользователя {user_id} об ошибке: {send_e}", exc_info=True)
             
     finally:
+        # Досрочные поиски изображений, результат которых уже не понадобится
+        # (при выходе до выбора картинки); отменяется только ожидание: сам запрос XMLRiver
+        # защищен shield в fetch_xmlriver, завершится и попадет в кэш
+        for task in early_image_searches.values():
+            _discard_image_search(task)
+        if speculative_image_task:
+            _discard_image_search(speculative_image_task)
         # Закрываем пул соединений, если он был создан в этой задаче
         if db_pool_global:
             await db_pool_global.close()
             db_pool_global = None # Сбрасываем глобальную переменную
-        await bot.session.close()
         total_cost = (total_ai_tokens / 1000) * AI_TOKEN_COST_PER_1000 \
             + (total_sonar_requests * SONAR_REQUEST_COST_RUB) \
             + ((total_search_queries + total_image_queries) * SEARCH_QUERY_COST)
@@ -303,6 +409,9 @@ async def setup_scheduler(db_pool: asyncpg.Pool) -> AsyncIOScheduler:
         active_scenarios = await conn.fetch("SELECT * FROM posting_scenarios WHERE is_active = TRUE")
         for scenario in active_scenarios:
             add_job_to_scheduler(scheduler, dict(scenario))
+
+    # Низкоприоритетное автообновление паспортов стиля по опубликованным постам
+    add_style_passport_refresh_job(scheduler)
     
     logging.info("Планировщик настроен и готов к работе.")
     return scheduler
\ No newline at end of file
@@ -0,0 +1,62 @@
+# bot/utils/search_pipeline.py
+
+import logging
+import asyncpg
+
+from bot import config
+from bot.utils.search_engine import search_news
+from bot.utils.ranking import get_scenario_query
+from bot.utils.ai_generator import select_best_articles_from_search_results, generate_post_from_article
+from bot.utils.fetch_coordinator import fetch_first_articles
+from bot.utils.post_buffer import filter_unpublished_posts
+from bot.utils.content_dedup import filter_duplicate_content
+
+CONTENT_DEDUP = config.CONTENT_DEDUP
+
+
+async def find_post_via_search(db_pool: asyncpg.Pool, scenario_id: int, channel_id: int, theme: str, keywords: list[str],
+                               lang_code: str, style_passport: str = "",
+                               activity_description: str = "") -> tuple[dict | None, int, int]:
+    """
+    Запасной путь, когда Sonar не дал поста: поиск XMLRiver -> локальный выбор статей BM25
+    по запросу сценария (ИИ решает только ничьи) -> одновременная загрузка выбранных статей
+    (первая успешная побеждает) -> пост по тексту статьи.
+    Возвращает (пост { title, body, image_query, source_url[, content_fingerprint] } или None,
+    токены ИИ, оплаченные поисковые запросы).
+    """
+    results, paid_requests = await search_news(theme, keywords, lang_code)
+    if not results:
+        return None, 0, paid_requests
+
+    query = get_scenario_query(scenario_id, theme, keywords)
+    success, urls, tokens = await select_best_articles_from_search_results([r.to_dict() for r in results], lang_code, query=query)
+    if not success or not urls:
+        logging.info(f"Сценарий #{scenario_id}: В выдаче поиска не нашлось подходящих статей.")
+        return None, tokens, paid_requests
+
+    candidates = await filter_unpublished_posts(db_pool, channel_id, [{'source_url': url} for url in urls])
+    if CONTENT_DEDUP and candidates:
+        candidates = await filter_duplicate_content(db_pool, channel_id, candidates)
+    if not candidates:
+        logging.info(f"Сценарий #{scenario_id}: Все найденные поиском статьи уже были опубликованы.")
+        return None, tokens, paid_requests
+
+    # Страницы, загруженные для отпечатков, уже лежат в кэше: повторная загрузка почти бесплатна
+    fetched = await fetch_first_articles([c['source_url'] for c in candidates], needed=1)
+    if not fetched:
+        logging.info(f"Сценарий #{scenario_id}: Не удалось загрузить ни одну из выбранных статей.")
+        return None, tokens, paid_requests
+    article_url, article_text = fetched[0]
+
+    success, post, post_tokens = await generate_post_from_article(
+        article_url, article_text, theme, keywords, lang_code,
+        style_passport=style_passport, activity_description=activity_description
+    )
+    tokens += post_tokens
+    if not success:
+        return None, tokens, paid_requests
+    fingerprint = next((c.get('content_fingerprint') for c in candidates if c['source_url'] == article_url), None)
+    if fingerprint is not None:
+        post['content_fingerprint'] = fingerprint
+    logging.info(f"Сценарий #{scenario_id}: Пост подготовлен по статье из поиска: {article_url}")
+    return post, tokens, paid_requests
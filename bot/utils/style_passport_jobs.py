@@ -0,0 +1,241 @@
+# bot/utils/style_passport_jobs.py
+
+import asyncio
+import logging
+import asyncpg
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardButton
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.jobstores.base import ConflictingIdError
+from apscheduler.triggers.interval import IntervalTrigger
+
+from bot import config
+from bot.utils.localization import get_text
+from bot.utils.http_client import make_bot_session
+from bot.utils.ai_generator import (
+    generate_style_passport_from_text, refine_style_passport, invalidate_channel_prompt, route_retry_after
+)
+from bot.utils.token_budget import estimate_tokens
+from bot.utils.post_buffer import clear_channel_post_buffer
+from bot.utils.accounting import record_usage
+
+# Если бот был перезапущен до выполнения задачи, она еще выполнится в течение этого времени
+STYLE_PASSPORT_JOB_GRACE_SECONDS = 3600
+PASSPORT_AUTO_REFRESH_INTERVAL_HOURS = config.PASSPORT_AUTO_REFRESH_INTERVAL_HOURS
+PASSPORT_AUTO_REFRESH_MIN_POSTS = config.PASSPORT_AUTO_REFRESH_MIN_POSTS
+PASSPORT_AUTO_REFRESH_MIN_AGE_DAYS = config.PASSPORT_AUTO_REFRESH_MIN_AGE_DAYS
+PASSPORT_AUTO_REFRESH_BATCH = config.PASSPORT_AUTO_REFRESH_BATCH
+PASSPORT_AUTO_REFRESH_MAX_POSTS = config.PASSPORT_AUTO_REFRESH_MAX_POSTS
+# Пауза между каналами при автообновлении, чтобы фоновая задача не конкурировала со сценариями
+PASSPORT_AUTO_REFRESH_PAUSE_SECONDS = 5
+
+# Каналы, для которых генерация уже выполняется. Планировщик удаляет задачу с триггером
+# 'date' из jobstore в момент запуска, поэтому одной проверки ID задачи недостаточно.
+_running_channels: set[int] = set()
+
+
+def style_passport_job_id(channel_id: int) -> str:
+    return f"style_passport_{channel_id}"
+
+
+def submit_style_passport_job(scheduler: AsyncIOScheduler, channel_id: int, user_id: int, lang_code: str,
+                              posts_text: str, chat_id: int, message_id: int, onboarding: bool = False,
+                              refine: bool = False) -> bool:
+    """
+    Ставит генерацию паспорта стиля в фоновую очередь планировщика.
+    refine=True — инкрементальное обновление существующего паспорта по новым постам.
+    ID задачи постоянный для канала и хранится в jobstore, поэтому повторная отправка
+    (двойное нажатие "Готово", повтор после перезапуска) не запускает вторую платную генерацию.
+    Возвращает False, если генерация для канала уже выполняется.
+    """
+    job_id = style_passport_job_id(channel_id)
+    if channel_id in _running_channels:
+        logging.info(f"Генерация паспорта стиля для канала {channel_id} уже выполняется, повтор пропущен.")
+        return False
+    try:
+        scheduler.add_job(
+            process_style_passport_job,
+            trigger='date',
+            id=job_id,
+            name=f"Style passport for {channel_id}",
+            replace_existing=False,
+            misfire_grace_time=STYLE_PASSPORT_JOB_GRACE_SECONDS,
+            kwargs={
+                "channel_id": channel_id, "user_id": user_id, "lang_code": lang_code, "posts_text": posts_text,
+                "chat_id": chat_id, "message_id": message_id, "onboarding": onboarding, "refine": refine
+            }
+        )
+    except ConflictingIdError:
+        logging.info(f"Генерация паспорта стиля для канала {channel_id} уже в очереди, повтор пропущен.")
+        return False
+    logging.info(f"Задача '{job_id}' поставлена в очередь.")
+    return True
+
+
+async def _edit_progress_message(bot: Bot, chat_id: int, message_id: int, text: str, reply_markup=None):
+    """Заменяет сообщение о прогрессе результатом; если это невозможно — отправляет новое."""
+    # Импортируем здесь, чтобы избежать циклической зависимости со scheduler
+    from bot.utils.scheduler import send_message_with_retry
+
+    try:
+        await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        logging.warning(f"Не удалось отредактировать сообщение {message_id} в чате {chat_id}: {e}. Отправляем новое.")
+        await send_message_with_retry(bot, chat_id, text, reply_markup=reply_markup)
+
+
+async def _save_style_passport(db_pool: asyncpg.Pool, channel_id: int, user_id: int, passport_text: str, token_count: int):
+    """Сохраняет новый паспорт стиля канала и записывает расход в usage_ledger."""
+    async with db_pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE channels SET style_passport = $1, style_passport_tokens = $2, style_passport_updated_at = NOW() WHERE channel_id = $3",
+            passport_text, estimate_tokens(passport_text), channel_id
+        )
+        # Отложенные посты написаны в старом стиле — больше не используем их
+        await clear_channel_post_buffer(conn, channel_id)
+        invalidate_channel_prompt(channel_id)
+    # Логируем в usage_ledger как расход на паспорт стиля (is_free=true — это наша внутренняя операция)
+    cost_per_token = config.AI_TOKEN_COST_PER_1M_RUB / 1_000_000
+    record_usage(user_id, None, 'style_passport', True, token_count, cost_tokens=token_count * cost_per_token)
+
+
+async def process_style_passport_job(channel_id: int, user_id: int, lang_code: str, posts_text: str,
+                                     chat_id: int, message_id: int, onboarding: bool = False, refine: bool = False):
+    """Фоновая генерация паспорта стиля: сохраняет результат и редактирует сообщение о прогрессе."""
+    logging.info(f"--- ЗАПУСК ГЕНЕРАЦИИ ПАСПОРТА СТИЛЯ ДЛЯ КАНАЛА {channel_id} ---")
+    _running_channels.add(channel_id)
+    bot = Bot(token=config.BOT_TOKEN, parse_mode="HTML", session=make_bot_session())
+    db_pool = None
+    try:
+        db_pool = await asyncpg.create_pool(
+            user=config.DB_USER, password=config.DB_PASSWORD,
+            database=config.DB_NAME, host=config.DB_HOST
+        )
+
+        current_passport = None
+        if refine:
+            current_passport = await db_pool.fetchval("SELECT style_passport FROM channels WHERE channel_id = $1", channel_id)
+        if current_passport:
+            success, passport_text, token_count = await refine_style_passport(current_passport, posts_text, lang_code)
+        else:
+            success, passport_text, token_count = await generate_style_passport_from_text(posts_text, lang_code)
+
+        reply_markup = None
+        if not onboarding:
+            builder = InlineKeyboardBuilder()
+            builder.row(InlineKeyboardButton(
+                text=get_text(lang_code, 'back_to_channels_button'),
+                callback_data=f"channel_manage_{channel_id}"
+            ))
+            reply_markup = builder.as_markup()
+
+        if not success:
+            logging.error(f"Не удалось сгенерировать паспорт стиля для канала {channel_id}: {passport_text}")
+            await _edit_progress_message(
+                bot, chat_id, message_id,
+                get_text(lang_code, 'style_passport_generation_failed', error=passport_text, escape_html_chars=True),
+                reply_markup
+            )
+            return
+
+        cost = (token_count / 1000) * config.AI_TOKEN_COST_PER_1000
+        logging.info(f"Сгенерирован паспорт стиля для канала {channel_id}. Токены: {token_count}, Стоимость: {cost:.2f} руб.")
+
+        await _save_style_passport(db_pool, channel_id, user_id, passport_text, token_count)
+
+        await _edit_progress_message(
+            bot, chat_id, message_id,
+            get_text(lang_code, 'style_passport_created_success', passport_text=passport_text),
+            reply_markup
+        )
+    except Exception as e:
+        logging.error(f"Критическая ошибка при генерации паспорта стиля для канала {channel_id}: {e}", exc_info=True)
+    finally:
+        _running_channels.discard(channel_id)
+        if db_pool:
+            await db_pool.close()
+        logging.info(f"--- ГЕНЕРАЦИЯ ПАСПОРТА СТИЛЯ ДЛЯ КАНАЛА {channel_id} ЗАВЕРШЕНА ---")
+
+
+async def refresh_style_passports_job():
+    """
+    Низкоприоритетное автообновление паспортов стиля по собственным опубликованным постам каналов.
+    Берет каналы, у которых с последнего обновления паспорта накопилось достаточно постов,
+    и по одному инкрементально обновляет их паспорта.
+    """
+    if route_retry_after("style_passport") > 0:
+        logging.info("Автообновление паспортов стиля пропущено: провайдер генерации недоступен.")
+        return
+
+    db_pool = None
+    try:
+        db_pool = await asyncpg.create_pool(
+            user=config.DB_USER, password=config.DB_PASSWORD,
+            database=config.DB_NAME, host=config.DB_HOST
+        )
+        channels = await db_pool.fetch(
+            """
+            SELECT c.channel_id, c.owner_id, c.style_passport, COALESCE(u.language_code, 'ru') AS lang_code,
+                   (array_agg(p.post_text ORDER BY p.published_at DESC))[1:$4] AS posts
+            FROM channels c
+            JOIN users u ON u.user_id = c.owner_id
+            JOIN published_posts p ON p.channel_id = c.channel_id
+            WHERE c.style_passport IS NOT NULL
+              AND p.post_text IS NOT NULL
+              AND p.published_at > COALESCE(c.style_passport_updated_at, 'epoch'::timestamptz)
+              AND (c.style_passport_updated_at IS NULL OR c.style_passport_updated_at < NOW() - make_interval(days => $1))
+            GROUP BY c.channel_id, c.owner_id, c.style_passport, u.language_code, c.style_passport_updated_at
+            HAVING COUNT(*) >= $2
+            ORDER BY c.style_passport_updated_at NULLS FIRST
+            LIMIT $3
+            """,
+            PASSPORT_AUTO_REFRESH_MIN_AGE_DAYS, PASSPORT_AUTO_REFRESH_MIN_POSTS, PASSPORT_AUTO_REFRESH_BATCH,
+            PASSPORT_AUTO_REFRESH_MAX_POSTS
+        )
+        if not channels:
+            return
+        logging.info(f"Автообновление паспортов стиля: каналов к обновлению: {len(channels)}.")
+
+        refreshed = 0
+        for channel in channels:
+            channel_id = channel['channel_id']
+            # Ручная генерация в процессе — ее результат свежее
+            if channel_id in _running_channels:
+                continue
+            _running_channels.add(channel_id)
+            try:
+                posts_text = "\n\n---\n\n".join(channel['posts'])
+                success, passport_text, token_count = await refine_style_passport(
+                    channel['style_passport'], posts_text, channel['lang_code']
+                )
+                if success:
+                    await _save_style_passport(db_pool, channel_id, channel['owner_id'], passport_text, token_count)
+                    refreshed += 1
+                else:
+                    logging.warning(f"Автообновление паспорта стиля канала {channel_id} не удалось: {passport_text}")
+            finally:
+                _running_channels.discard(channel_id)
+            await asyncio.sleep(PASSPORT_AUTO_REFRESH_PAUSE_SECONDS)
+        logging.info(f"Автообновление паспортов стиля: обновлено {refreshed} из {len(channels)}.")
+    except Exception as e:
+        logging.error(f"Ошибка автообновления паспортов стиля: {e}", exc_info=True)
+    finally:
+        if db_pool:
+            await db_pool.close()
+
+
+def add_style_passport_refresh_job(scheduler: AsyncIOScheduler):
+    """Регистрирует периодическое автообновление паспортов стиля (0 часов — выключено)."""
+    if PASSPORT_AUTO_REFRESH_INTERVAL_HOURS <= 0:
+        return
+    scheduler.add_job(
+        refresh_style_passports_job,
+        trigger=IntervalTrigger(hours=PASSPORT_AUTO_REFRESH_INTERVAL_HOURS, jitter=600),
+        id="style_passport_auto_refresh",
+        name="Style passport auto refresh",
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True
+    )
@@ -0,0 +1,90 @@
+# bot/utils/telegram_files.py
+
+import hashlib
+import logging
+import asyncpg
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message
+
+# Недавно использованные file_id в памяти процесса: хеш URL -> file_id
+_file_ids: dict[str, str] = {}
+_FILE_IDS_MEMORY_LIMIT = 5000
+
+
+def hash_image_url(url: str) -> str:
+    return hashlib.sha256(url.strip().encode()).hexdigest()
+
+
+def _remember_in_memory(url_hash: str, file_id: str):
+    if len(_file_ids) >= _FILE_IDS_MEMORY_LIMIT:
+        _file_ids.pop(next(iter(_file_ids)))
+    _file_ids[url_hash] = file_id
+
+
+async def get_cached_file_id(db_pool: asyncpg.Pool, image_url: str) -> str | None:
+    """file_id картинки, которую бот уже отправлял по этому URL, или None."""
+    url_hash = hash_image_url(image_url)
+    if url_hash in _file_ids:
+        return _file_ids[url_hash]
+    file_id = await db_pool.fetchval("SELECT file_id FROM telegram_file_ids WHERE url_hash = $1", url_hash)
+    if file_id:
+        _remember_in_memory(url_hash, file_id)
+    return file_id
+
+
+async def remember_file_id(db_pool: asyncpg.Pool, image_url: str, message: Message):
+    """Сохраняет file_id из ответа send_photo (самый крупный вариант фото)."""
+    if not message or not message.photo:
+        return
+    photo = message.photo[-1]
+    url_hash = hash_image_url(image_url)
+    _remember_in_memory(url_hash, photo.file_id)
+    try:
+        await db_pool.execute(
+            """
+            INSERT INTO telegram_file_ids (url_hash, image_url, file_id, file_unique_id)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (url_hash) DO UPDATE SET file_id = EXCLUDED.file_id, file_unique_id = EXCLUDED.file_unique_id, last_used_at = NOW()
+            """,
+            url_hash, image_url, photo.file_id, photo.file_unique_id
+        )
+    except Exception as e:
+        logging.warning(f"Не удалось сохранить file_id для {image_url}: {e}")
+
+
+async def _touch_file_id(db_pool: asyncpg.Pool, image_url: str):
+    try:
+        await db_pool.execute("UPDATE telegram_file_ids SET last_used_at = NOW() WHERE url_hash = $1", hash_image_url(image_url))
+    except Exception as e:
+        logging.warning(f"Не удалось обновить время использования file_id для {image_url}: {e}")
+
+
+async def _forget_file_id(db_pool: asyncpg.Pool, image_url: str):
+    url_hash = hash_image_url(image_url)
+    _file_ids.pop(url_hash, None)
+    await db_pool.execute("DELETE FROM telegram_file_ids WHERE url_hash = $1", url_hash)
+
+
+async def send_photo_cached(bot: Bot, db_pool: asyncpg.Pool, chat_id: int, image_url: str, **kwargs) -> Message:
+    """
+    send_photo, который переиспользует file_id уже отправленной по этому URL картинки:
+    Telegram не скачивает ее повторно. Если file_id больше не действителен, картинка
+    отправляется по URL, а новый file_id запоминается.
+    """
+    file_id = await get_cached_file_id(db_pool, image_url)
+    if file_id:
+        try:
+            message = await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except TelegramBadRequest as e:
+            # Прочие ошибки (подпись, чат) не связаны с file_id и повторятся при отправке по URL
+            if "file" not in str(e).lower():
+                raise
+            logging.warning(f"Сохраненный file_id для {image_url} не принят Telegram ({e}), отправляем по URL.")
+            await _forget_file_id(db_pool, image_url)
+        else:
+            await _touch_file_id(db_pool, image_url)
+            return message
+    message = await bot.send_photo(chat_id=chat_id, photo=image_url, **kwargs)
+    await remember_file_id(db_pool, image_url, message)
+    return message
@@ -2,11 +2,23 @@ import logging
 import asyncio
 from aiogram import Bot
 
+from bot.utils.http_client import make_bot_session
+
 class TelegramLogsHandler(logging.Handler):
     def __init__(self, bot_token: str, chat_id: int):
         super().__init__()
         self.chat_id = chat_id
-        self.bot = Bot(token=bot_token, parse_mode="HTML")
+        self.bot_token = bot_token
+        # Общая сессия бота: отдельный пул соединений ради логов не нужен
+        self.bot = Bot(token=bot_token, parse_mode="HTML", session=make_bot_session())
+
+    async def _send_without_loop(self, log_entry: str):
+        # Общая сессия привязана к основному циклу событий, поэтому здесь — временный бот
+        bot = Bot(token=self.bot_token, parse_mode="HTML")
+        try:
+            await bot.send_message(self.chat_id, log_entry)
+        finally:
+            await bot.session.close()
 
     def emit(self, record: logging.LogRecord):
         log_entry = self.format(record)
@@ -19,9 +31,9 @@ class TelegramLogsHandler(logging.Handler):
             else:
                 # Если нет (например, при падении на старте), отправляем синхронно
                 # (это блокирующая операция, но на этапе падения это не страшно)
-                asyncio.run(self.bot.send_message(self.chat_id, log_entry))
+                asyncio.run(self._send_without_loop(log_entry))
         except RuntimeError:
              # Если get_running_loop падает, потому что цикла нет вообще
-             asyncio.run(self.bot.send_message(self.chat_id, log_entry))
+             asyncio.run(self._send_without_loop(log_entry))
         except Exception as e:
             print(f"CRITICAL: Could not send log message to Telegram: {e}")
\ No newline at end of file
@@ -0,0 +1,91 @@
+# bot/utils/token_budget.py
+
+import re
+import logging
+
+from bot import config
+
+PROMPT_TOKEN_BUDGETS = config.PROMPT_TOKEN_BUDGETS
+
+# Сколько символов в среднем приходится на токен для разных классов символов
+# (типичные BPE-токенизаторы Llama/GPT: латиница ~4, кириллица ~2.7, цифры ~3).
+LATIN_CHARS_PER_TOKEN = 4.0
+CYRILLIC_CHARS_PER_TOKEN = 2.7
+DIGIT_CHARS_PER_TOKEN = 3.0
+
+_LATIN_RE = re.compile(r"[A-Za-z]")
+_CYRILLIC_RE = re.compile(r"[А-Яа-яЁё]")
+_DIGIT_RE = re.compile(r"[0-9]")
+_SPACE_RE = re.compile(r"\s")
+# Граница, по которой предпочтительно обрезать текст: конец абзаца или предложения
+_BOUNDARY_RE = re.compile(r"(\n\n|\n|[.!?…](?=\s))")
+
+# Поправочные коэффициенты по моделям: фактические prompt_tokens / локальная оценка.
+# Обновляются по ответам провайдера (скользящее среднее), поэтому оценка со временем уточняется.
+_model_calibration: dict[str, float] = {}
+CALIBRATION_SMOOTHING = 0.2
+
+
+def _raw_estimate(text: str) -> float:
+    if not text:
+        return 0.0
+    latin = len(_LATIN_RE.findall(text))
+    cyrillic = len(_CYRILLIC_RE.findall(text))
+    digits = len(_DIGIT_RE.findall(text))
+    spaces = len(_SPACE_RE.findall(text))
+    # Пунктуация, эмодзи и прочие символы обычно занимают отдельный токен
+    other = len(text) - latin - cyrillic - digits - spaces
+    return latin / LATIN_CHARS_PER_TOKEN + cyrillic / CYRILLIC_CHARS_PER_TOKEN + digits / DIGIT_CHARS_PER_TOKEN + other
+
+
+def estimate_tokens(text: str, model: str | None = None) -> int:
+    """Быстрая локальная оценка количества токенов текста для модели (без обращения к сети)."""
+    return int(_raw_estimate(text) * _model_calibration.get(model, 1.0)) + 1 if text else 0
+
+
+def estimate_messages_tokens(messages: list[dict], model: str | None = None) -> int:
+    """Оценка токенов промпта Chat Completions: содержимое сообщений плюс служебные токены ролей."""
+    return sum(estimate_tokens(m.get("content") or "", model) + 4 for m in messages)
+
+
+def calibrate(model: str, messages: list[dict], prompt_tokens: int):
+    """Уточняет коэффициент модели по фактическому usage.prompt_tokens из ответа провайдера."""
+    raw = sum(_raw_estimate(m.get("content") or "") + 4 for m in messages)
+    if not prompt_tokens or raw <= 0:
+        return
+    ratio = prompt_tokens / raw
+    current = _model_calibration.get(model)
+    _model_calibration[model] = ratio if current is None else current + CALIBRATION_SMOOTHING * (ratio - current)
+    logging.debug(f"Калибровка токенайзера {model}: {_model_calibration[model]:.3f}")
+
+
+def trim_to_token_budget(text: str, max_tokens: int, model: str | None = None, known_tokens: int | None = None) -> str:
+    """
+    Обрезает текст так, чтобы он укладывался в max_tokens, по возможности по границе абзаца
+    или предложения. known_tokens — заранее посчитанная без привязки к модели оценка
+    (например, из БД), позволяет не пересчитывать ее для неизменного текста.
+    """
+    if not text:
+        return ""
+    if known_tokens is not None:
+        tokens = int(known_tokens * _model_calibration.get(model, 1.0))
+    else:
+        tokens = estimate_tokens(text, model)
+    if tokens <= max_tokens:
+        return text
+
+    # Пропорционально сокращаем по символам, затем откатываемся к ближайшей границе
+    cut = int(len(text) * max_tokens / tokens)
+    while cut > 0 and estimate_tokens(text[:cut], model) > max_tokens:
+        cut = int(cut * 0.9)
+    head = text[:cut]
+    boundaries = [m.end() for m in _BOUNDARY_RE.finditer(head)]
+    # Не жертвуем больше трети текста ради красивой границы
+    if boundaries and boundaries[-1] >= cut * 2 // 3:
+        head = head[:boundaries[-1]]
+    return head.rstrip() + "…"
+
+
+def prompt_budget(task: str) -> int | None:
+    """Лимит токенов промпта для задачи (None — без лимита)."""
+    return PROMPT_TOKEN_BUDGETS.get(task)
@@ -0,0 +1,25 @@
+# bot/utils/tokens.py
+# Токенизация текста для ранжирования и отпечатков статей. Без конфигурации бота:
+# модуль импортируется и в рабочих процессах пула извлечения.
+
+import re
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+# Частые окончания: грубый стемминг, чтобы "выборы"/"выборах" и "election"/"elections" совпадали
+_ENDINGS = sorted([
+    "иями", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ией", "ия", "ие", "ий", "ый", "ой", "ая", "яя",
+    "ое", "ее", "ых", "их", "ов", "ев", "ам", "ям", "ах", "ях", "ом", "ем", "ую", "юю", "ы", "и", "а", "я", "о", "е", "у", "ю",
+    "ing", "ed", "es", "s",
+], key=len, reverse=True)
+_MIN_STEM = 4
+
+
+def _stem(word: str) -> str:
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text: str) -> list[str]:
+    return [_stem(t) for t in _TOKEN_RE.findall((text or "").lower()) if len(t) > 1 and not t.isdigit()]
@@ -0,0 +1,200 @@
+# bot/utils/xmlriver.py
+
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import aiohttp
+from redis import asyncio as aioredis
+
+from bot import config
+from bot.utils.circuit_breaker import get_breaker
+from bot.utils.http_client import http_session
+from bot.utils.xmlriver_parser import SearchResult, XmlRiverStreamParser
+
+XMLRIVER_API_KEY = config.XMLRIVER_API_KEY
+XMLRIVER_USER_ID = config.XMLRIVER_USER_ID
+XMLRIVER_URL = config.XMLRIVER_NEWS_URL  # Новости и изображения — один адрес, отличается setab
+# Сколько хранить ответы в кэше для каждого типа поиска (новости устаревают быстрее картинок)
+XMLRIVER_CACHE_TTL_SECONDS = config.XMLRIVER_CACHE_TTL_SECONDS
+
+KEY_PREFIX = "xmlriver_cache:"
+STATS_KEY = "xmlriver_cache:stats"  # HASH: hits, misses, coalesced
+# Размер куска, которыми тело ответа подается потоковому парсеру
+STREAM_CHUNK_SIZE = 16 * 1024
+# Код ошибки XMLRiver "ничего не найдено": это пустой результат, а не сбой
+NO_RESULTS_ERROR_CODE = "15"
+
+# Запросы, выполняющиеся прямо сейчас: ключ -> задача. Одинаковые запросы ждут одну задачу
+_in_flight: dict[str, asyncio.Task] = {}
+_redis = None
+
+
+def _client():
+    global _redis
+    if _redis is None:
+        _redis = aioredis.from_url(config.REDIS_URL, decode_responses=True)
+    return _redis
+
+
+def canonical_query(terms: list[str]) -> str:
+    """Каноническая строка запроса: термы без регистра и лишних пробелов, без повторов, по алфавиту."""
+    normalized = {" ".join(term.casefold().split()) for term in terms}
+    return " ".join(sorted(term for term in normalized if term))
+
+
+def cache_key(params: dict) -> str:
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    return f"{KEY_PREFIX}{params['setab']}:{digest}"
+
+
+async def _incr_stat(field: str):
+    try:
+        await _client().hincrby(STATS_KEY, field, 1)
+    except Exception:
+        pass
+
+
+async def _cache_get(key: str) -> list[SearchResult] | None:
+    try:
+        raw = await _client().get(key)
+        return [SearchResult.from_json(item) for item in json.loads(raw)] if raw is not None else None
+    except Exception as e:
+        logging.warning(f"Кэш XMLRiver недоступен: {e}")
+        return None
+
+
+async def _cache_set(key: str, setab: str, records: list[SearchResult]):
+    ttl = XMLRIVER_CACHE_TTL_SECONDS.get(setab, 0)
+    if ttl <= 0:
+        return
+    try:
+        await _client().set(key, json.dumps([r.to_json() for r in records], ensure_ascii=False), ex=ttl)
+    except Exception as e:
+        logging.warning(f"Не удалось сохранить ответ XMLRiver в кэш: {e}")
+
+
+async def _read_records(response, limit: int) -> tuple[list[SearchResult], str | None]:
+    """Разбирает тело ответа по мере получения; после limit результатов остаток не читается."""
+    parser = XmlRiverStreamParser(limit)
+    records = []
+    async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+        records.extend(parser.feed(chunk))
+        if parser.done:
+            break
+    records.extend(parser.close())
+    if parser.failed and not records:
+        return records, "ответ не является корректным XML"
+    if parser.error_code == NO_RESULTS_ERROR_CODE:
+        return records, None
+    return records, parser.error
+
+
+async def _request(params: dict, key: str, limit: int) -> list[SearchResult] | None:
+    """Платный запрос к XMLRiver с учетом предохранителя. Успешный ответ сохраняется в кэш."""
+    setab = params["setab"]
+    breaker = get_breaker("xmlriver", setab)
+    ticket = breaker.allow_request()
+    if not ticket:
+        logging.warning(f"XMLRiver ({setab}) временно недоступен, запрос пропущен (повтор через {breaker.retry_after():.0f} сек.).")
+        return None
+
+    request_params = {**params, "key": XMLRIVER_API_KEY, "user": XMLRIVER_USER_ID}
+    started_at = time.monotonic()
+    try:
+        async with http_session() as session:
+            # XMLRiver использует GET-запросы
+            async with session.get(XMLRIVER_URL, params=request_params, timeout=20) as response:
+                if response.status != 200:
+                    if response.status >= 500 or response.status == 429:
+                        breaker.record_failure(time.monotonic() - started_at)
+                    else:
+                        breaker.record_success(time.monotonic() - started_at)
+                    logging.error(f"Ошибка XMLRiver API ({setab}): Статус {response.status}, Тело ответа: {await response.text()}")
+                    return None
+                records, api_error = await _read_records(response, limit)
+    except asyncio.CancelledError:
+        breaker.release(ticket)
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        breaker.record_failure(time.monotonic() - started_at)
+        logging.error(f"Сетевая ошибка при вызове XMLRiver API ({setab}): {e!r}")
+        return None
+    except Exception as e:
+        breaker.record_failure(time.monotonic() - started_at)
+        logging.critical(f"Исключение при вызове XMLRiver API ({setab}): {e}", exc_info=True)
+        return None
+
+    # XMLRiver сообщает об исчерпанной квоте, неверном ключе и т.п. ошибкой в теле ответа со статусом 200;
+    # "ничего не найдено" (код 15) ошибкой провайдера не считается и сюда не попадает
+    if api_error:
+        breaker.record_failure(time.monotonic() - started_at)
+        logging.error(f"Ошибка XMLRiver API ({setab}): {api_error}")
+        return None
+    breaker.record_success(time.monotonic() - started_at)
+    await _cache_set(key, setab, records)
+    return records
+
+
+async def fetch_xmlriver(setab: str, terms: list[str], lr: str, tbs: str | None = None, groupby: str = "10",
+                         limit: int = 10) -> tuple[list[SearchResult] | None, int]:
+    """
+    Выполняет поиск XMLRiver (setab: news/images) по термам запроса и возвращает не больше limit
+    результатов: ответ разбирается потоково, и чтение прекращается после страницы из groupby результатов.
+    Результаты кэшируются в Redis по канонической форме запроса (термы, lr, setab, tbs, groupby)
+    с TTL для каждого setab — целиком, а limit применяется при чтении, поэтому тот же запрос с другим
+    limit не оплачивается повторно; одновременные одинаковые запросы ждут один платный запрос.
+    Возвращает (результаты или None при ошибке, число оплаченных запросов — 0 или 1).
+    """
+    query = canonical_query(terms)
+    if not query:
+        logging.warning(f"Попытка поиска XMLRiver ({setab}) с пустым запросом.")
+        return None, 0
+    params = {"setab": setab, "query": query, "lr": lr, "groupby": groupby}
+    if tbs:
+        params["tbs"] = tbs
+    key = cache_key(params)
+
+    cached = await _cache_get(key)
+    if cached is not None:
+        await _incr_stat("hits")
+        logging.info(f"XMLRiver ({setab}): ответ на запрос '{query}' взят из кэша.")
+        return cached[:limit], 0
+
+    task = _in_flight.get(key)
+    if task is not None:
+        await _incr_stat("coalesced")
+        logging.debug(f"XMLRiver ({setab}): запрос '{query}' уже выполняется, ждем его результат.")
+        # shield: отмена одного из ожидающих не должна отменять общий запрос
+        records = await asyncio.shield(task)
+        return (records[:limit] if records is not None else None), 0
+
+    await _incr_stat("misses")
+    logging.info(f"Выполняю поиск в XMLRiver ({setab}). Запрос: '{query}', Регион: {lr}")
+    # Разбирается вся страница ответа, а не только limit результатов: она целиком идет в кэш
+    page_size = max(limit, int(groupby)) if groupby.isdigit() else limit
+    task = asyncio.create_task(_request(params, key, page_size))
+    _in_flight[key] = task
+    task.add_done_callback(lambda _: _in_flight.pop(key, None))
+    records = await asyncio.shield(task)
+    return (records[:limit] if records is not None else None), 1 if records is not None else 0
+
+
+async def xmlriver_cache_stats() -> dict:
+    """Статистика кэша XMLRiver для /health: попадания, промахи, объединенные запросы."""
+    try:
+        stats = await _client().hgetall(STATS_KEY)
+    except Exception as e:
+        logging.warning(f"Кэш XMLRiver недоступен: {e}")
+        return {}
+    hits = int(stats.get("hits", 0))
+    misses = int(stats.get("misses", 0))
+    coalesced = int(stats.get("coalesced", 0))
+    total = hits + misses + coalesced
+    return {
+        "hits": hits,
+        "misses": misses,
+        "coalesced": coalesced,
+        "saved_ratio": (hits + coalesced) / total if total else 0.0,
+    }
@@ -0,0 +1,148 @@
+# bot/utils/xmlriver_parser.py
+
+import datetime
+import logging
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, asdict
+from email.utils import parsedate_to_datetime
+
+
+@dataclass
+class SearchResult:
+    """Один результат XMLRiver (новость или изображение) в компактном виде."""
+    url: str
+    title: str = ""
+    passages: str = ""
+    published_at: datetime.datetime | None = None
+    width: int | None = None
+    height: int | None = None
+
+    def to_dict(self) -> dict:
+        """Словарь в формате статей для ранжирования и выбора (url, title, passages, published_at)."""
+        return asdict(self)
+
+    def to_json(self) -> dict:
+        data = asdict(self)
+        data["published_at"] = self.published_at.isoformat() if self.published_at else None
+        return data
+
+    @classmethod
+    def from_json(cls, data: dict) -> "SearchResult":
+        published_at = data.get("published_at")
+        return cls(**{**data, "published_at": datetime.datetime.fromisoformat(published_at) if published_at else None})
+
+
+def _text(elem: ET.Element) -> str:
+    """Текст элемента вместе с вложенными тегами подсветки (<hlword>), с нормализованными пробелами."""
+    return " ".join("".join(elem.itertext()).split())
+
+
+def _parse_date(value: str | None) -> datetime.datetime | None:
+    """Дата публикации: unix-время, ISO 8601 или RFC 2822. Относительные даты ("2 часа назад") не разбираются."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        if value.isdigit():
+            return datetime.datetime.fromtimestamp(int(value), tz=datetime.timezone.utc)
+        parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        try:
+            parsed = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=datetime.timezone.utc)
+
+
+def _parse_int(value: str | None) -> int | None:
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+def _record_from_doc(doc: ET.Element) -> SearchResult | None:
+    url = (doc.findtext("url") or "").strip()
+    if not url:
+        return None
+    passages = doc.find("passages")
+    date = doc.findtext("pubDate") or doc.findtext("date") or doc.findtext("time")
+    return SearchResult(
+        url=url,
+        title=_text(doc.find("title")) if doc.find("title") is not None else "",
+        passages=" ".join(_text(p) for p in passages.findall("passage")) if passages is not None else "",
+        published_at=_parse_date(date),
+        width=_parse_int(doc.findtext("width") or doc.findtext("img_width")),
+        height=_parse_int(doc.findtext("height") or doc.findtext("img_height")),
+    )
+
+
+class XmlRiverStreamParser:
+    """
+    Потоковый разбор ответа XMLRiver (ET.XMLPullParser): feed() принимает очередной кусок
+    тела ответа и возвращает новые готовые результаты. Разобранные <doc> сразу освобождаются,
+    поэтому память не растет с размером ответа. После limit результатов done становится True —
+    остаток ответа можно не читать.
+    """
+
+    def __init__(self, limit: int = 10):
+        self.limit = limit
+        self.count = 0
+        self.error: str | None = None
+        self.error_code: str | None = None
+        self.failed = False
+        self._parser = ET.XMLPullParser(events=("end",))
+
+    @property
+    def done(self) -> bool:
+        return self.failed or self.error is not None or self.count >= self.limit
+
+    def feed(self, chunk: bytes) -> list[SearchResult]:
+        if self.done:
+            return []
+        try:
+            self._parser.feed(chunk)
+            return self._collect()
+        except ET.ParseError as e:
+            logging.warning(f"Ответ XMLRiver не удалось разобрать до конца: {e}")
+            self.failed = True
+            return []
+
+    def close(self) -> list[SearchResult]:
+        """Завершает разбор после последнего куска (если остановки по limit не было)."""
+        if self.done:
+            return []
+        try:
+            self._parser.close()
+            return self._collect()
+        except ET.ParseError as e:
+            logging.warning(f"Ответ XMLRiver оборван: {e}")
+            self.failed = True
+            return []
+
+    def _collect(self) -> list[SearchResult]:
+        records = []
+        for _, elem in self._parser.read_events():
+            if elem.tag == "error":
+                # XMLRiver сообщает об ошибках (лимиты, неверный ключ) телом с кодом 200
+                self.error_code = elem.get("code")
+                self.error = f"{self.error_code or ''} {_text(elem)}".strip()
+                break
+            if elem.tag != "doc":
+                continue
+            record = _record_from_doc(elem)
+            elem.clear()
+            if record is None:
+                continue
+            records.append(record)
+            self.count += 1
+            if self.count >= self.limit:
+                break
+        return records
+
+
+def parse_xmlriver(data: bytes | str, limit: int = 10) -> list[SearchResult]:
+    """Разбор уже полученного ответа целиком (например, записанного в кассету)."""
+    parser = XmlRiverStreamParser(limit)
+    records = parser.feed(data.encode("utf-8") if isinstance(data, str) else data)
+    return records + parser.close()
@@ -0,0 +1,98 @@
+"""
+Сравнение выбора статей: локальный BM25 (с ИИ только для ничьих) против выбора целиком моделью.
+
+Берет ответы XMLRiver из кассеты (CASSETTE_MODE=record, см. bot/utils/http_client.py),
+для каждого запроса выбирает тройку статей обоими способами и печатает время, токены
+и совпадение троек. Ответы модели тоже берутся из кассеты (режим replay), поэтому
+прогон воспроизводим и бесплатен; если записей OpenRouter в кассете нет, сравнивается
+только BM25. Для ИИ нужен любой OPENROUTER_API_KEY (в replay он никуда не отправляется)
+и кассета, записанная на тех же промптах: иначе кассета отдает ближайшую запись и
+совпадение троек теряет смысл.
+
+Запуск из корня репозитория:
+    python scripts/bench_article_selection.py [путь к кассете] [--lang ru]
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Модель отвечает только из кассеты: настоящие запросы в бенчмарке не нужны
+os.environ["CASSETTE_MODE"] = "replay"
+
+from bot import config  # noqa: E402
+from bot.utils.xmlriver_parser import parse_xmlriver  # noqa: E402
+from bot.utils.ranking import build_query  # noqa: E402
+from bot.utils.ai_generator import select_best_articles_from_search_results  # noqa: E402
+
+
+def load_search_responses(path: str) -> list[tuple[str, list[dict]]]:
+    """(запрос, статьи) для каждого успешного ответа XMLRiver news в кассете."""
+    responses = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if not record["base"].endswith(config.XMLRIVER_NEWS_URL.split("://", 1)[1]) or record.get("status") != 200:
+                continue
+            params = dict(record.get("params") or [])
+            if params.get("setab") != "news" or "text" not in record:
+                continue
+            articles = [r.to_dict() for r in parse_xmlriver(record["text"])]
+            if articles:
+                responses.append((params.get("query", ""), articles))
+    return responses
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cassette", nargs="?", default=config.CASSETTE_PATH)
+    parser.add_argument("--lang", default="ru")
+    args = parser.parse_args()
+
+    responses = load_search_responses(args.cassette)
+    if not responses:
+        print(f"В кассете {args.cassette} нет ответов XMLRiver news.")
+        return
+    print(f"Запросов: {len(responses)}, статей: {sum(len(a) for _, a in responses)}\n")
+
+    totals = {"bm25_seconds": 0.0, "bm25_tokens": 0, "tie_breaks": 0, "llm_seconds": 0.0, "llm_tokens": 0, "llm_runs": 0, "overlap": 0}
+    for query_text, articles in responses:
+        query = build_query(query_text, [])
+
+        started_at = time.perf_counter()
+        _, bm25_urls, bm25_tokens = await select_best_articles_from_search_results(articles, args.lang, query=query)
+        totals["bm25_seconds"] += time.perf_counter() - started_at
+        totals["bm25_tokens"] += bm25_tokens
+        totals["tie_breaks"] += 1 if bm25_tokens else 0
+
+        started_at = time.perf_counter()
+        llm_ok, llm_urls, llm_tokens = await select_best_articles_from_search_results(articles, args.lang)
+        llm_seconds = time.perf_counter() - started_at
+        overlap = len(set(bm25_urls) & set(llm_urls)) if llm_ok and llm_urls else None
+        if overlap is not None:
+            totals["llm_seconds"] += llm_seconds
+            totals["llm_tokens"] += llm_tokens
+            totals["llm_runs"] += 1
+            totals["overlap"] += overlap
+        print(f"'{query_text[:60]}': статей {len(articles)}, BM25 токенов {bm25_tokens}, "
+              f"ИИ токенов {llm_tokens if overlap is not None else '—'}, совпало {overlap if overlap is not None else '—'}/3")
+
+    runs = len(responses)
+    print(f"\nBM25: {totals['bm25_seconds'] / runs * 1000:.2f} мс на выбор, токенов {totals['bm25_tokens']}, "
+          f"ничьих, решенных ИИ: {totals['tie_breaks']} из {runs}")
+    if totals["llm_runs"]:
+        print(f"ИИ:   {totals['llm_seconds'] / totals['llm_runs'] * 1000:.2f} мс на выбор (без записанных задержек), "
+              f"токенов {totals['llm_tokens']}, совпадение с BM25: {totals['overlap'] / (3 * totals['llm_runs']):.0%}")
+    else:
+        print("ИИ:   ответов OpenRouter в кассете нет, сравнение только по BM25.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
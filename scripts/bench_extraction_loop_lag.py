@@ -0,0 +1,105 @@
+"""
+Задержка цикла событий при извлечении статей: прямо в цикле (как было до пула извлечения)
+против run_extraction (пул процессов или потоков, см. EXTRACTION_EXECUTOR).
+
+Пока идут извлечения, фоновая задача каждые --tick мс просыпается и замеряет, насколько
+позже запланированного она получила управление. Печатает среднюю, p99 и максимальную
+задержку и общее время для каждого режима.
+
+Запуск из корня репозитория:
+    python scripts/bench_extraction_loop_lag.py [page1.html page2.html ...] [--pages 40] [--concurrency 4]
+Без файлов используется синтетическая статья.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot.utils.article_extract import extract_article  # noqa: E402
+from bot.utils.extraction_pool import run_extraction, shutdown_extraction_pool  # noqa: E402
+
+
+def synthetic_page() -> bytes:
+    paragraphs = "".join(
+        f"<p>Абзац {i}: подробности события, цитаты участников и комментарии экспертов. " * 6 + "</p>"
+        for i in range(150)
+    )
+    navigation = "".join(f"<li><a href='/section/{i}'>Раздел {i}</a></li>" for i in range(300))
+    return (
+        "<html><head><meta charset='utf-8'><title>Синтетическая статья</title></head><body>"
+        f"<nav><ul>{navigation}</ul></nav><article><h1>Заголовок</h1>{paragraphs}</article>"
+        f"<footer>{navigation}</footer></body></html>"
+    ).encode("utf-8")
+
+
+async def measure_lag(stop: asyncio.Event, tick: float, lags: list[float]):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + tick
+        await asyncio.sleep(tick)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+async def run_mode(name: str, extract, pages: list[bytes], concurrency: int, tick: float):
+    stop = asyncio.Event()
+    lags: list[float] = []
+    ticker = asyncio.create_task(measure_lag(stop, tick, lags))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(page: bytes):
+        async with semaphore:
+            return await extract(page)
+
+    started_at = time.perf_counter()
+    results = await asyncio.gather(*(one(page) for page in pages))
+    elapsed = time.perf_counter() - started_at
+    stop.set()
+    await ticker
+
+    lags.sort()
+    p99 = lags[min(len(lags) - 1, int(len(lags) * 0.99))] if lags else 0.0
+    failed = sum(1 for r in results if r is None)
+    print(f"{name:<28} всего {elapsed:6.2f} сек.   задержка цикла: средняя {sum(lags) / max(len(lags), 1) * 1000:7.1f} мс, "
+          f"p99 {p99 * 1000:7.1f} мс, макс. {(lags[-1] if lags else 0) * 1000:7.1f} мс   ошибок {failed}")
+
+
+async def inline_extract(page: bytes):
+    # Прежнее поведение: readability и BeautifulSoup прямо в цикле событий
+    return extract_article(page)
+
+
+async def pooled_extract(page: bytes):
+    return await run_extraction(page)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="сохраненные HTML-страницы")
+    parser.add_argument("--pages", type=int, default=40, help="сколько извлечений выполнить")
+    parser.add_argument("--concurrency", type=int, default=4, help="одновременных извлечений")
+    parser.add_argument("--tick", type=float, default=10, help="период замера задержки, мс")
+    args = parser.parse_args()
+
+    sources = []
+    for path in args.files:
+        with open(path, "rb") as f:
+            sources.append(f.read())
+    sources = sources or [synthetic_page()]
+    pages = [sources[i % len(sources)] for i in range(args.pages)]
+    print(f"Страниц: {len(pages)}, средний размер {sum(map(len, pages)) / len(pages) / 1024:.0f} КБ, "
+          f"одновременно {args.concurrency}\n")
+
+    tick = args.tick / 1000
+    await run_mode("в цикле событий", inline_extract, pages, args.concurrency, tick)
+    # Прогрев пула: запуск рабочих процессов не относится к извлечению
+    await run_extraction(pages[0])
+    await run_mode("run_extraction (пул)", pooled_extract, pages, args.concurrency, tick)
+    shutdown_extraction_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
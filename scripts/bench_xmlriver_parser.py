@@ -0,0 +1,112 @@
+"""
+Микробенчмарк разбора ответов XMLRiver: потоковый XmlRiverStreamParser против прежнего
+пути ET.fromstring + findall(".//doc").
+
+Берет самый большой ответ XMLRiver из кассеты (CASSETTE_MODE=record, см. bot/utils/http_client.py)
+или XML-файл; если их нет — синтетический ответ на --synthetic результатов.
+Для каждого способа печатает время разбора и пиковую память (tracemalloc).
+
+Запуск из корня репозитория:
+    python scripts/bench_xmlriver_parser.py [--cassette путь | --xml файл] [--synthetic 2000] [--limit 10]
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import config  # noqa: E402
+from bot.utils.xmlriver import STREAM_CHUNK_SIZE  # noqa: E402
+from bot.utils.xmlriver_parser import XmlRiverStreamParser, parse_xmlriver, _record_from_doc  # noqa: E402
+
+
+def largest_recorded_response(path: str) -> bytes | None:
+    """Самое большое тело успешного ответа XMLRiver в кассете."""
+    host = config.XMLRIVER_NEWS_URL.split("://", 1)[1].split("/", 1)[0]
+    largest = None
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if host in record["base"] and record.get("status") == 200 and "text" in record:
+                body = record["text"].encode("utf-8")
+                if largest is None or len(body) > len(largest):
+                    largest = body
+    return largest
+
+
+def synthetic_response(results: int) -> bytes:
+    docs = "".join(
+        f"<doc><url>https://example{i % 50}.ru/news/2026/10/{i}.html</url>"
+        f"<title>Новость номер <hlword>{i}</hlword> о важном событии</title>"
+        f"<passages><passage>{'Подробности события и комментарии экспертов. ' * 8}</passage></passages>"
+        f"<pubDate>2026-10-19T{i % 24:02d}:00:00Z</pubDate></doc>"
+        for i in range(results)
+    )
+    return f"<?xml version='1.0' encoding='utf-8'?><yandexsearch><response><results><grouping>{docs}</grouping></results></response></yandexsearch>".encode("utf-8")
+
+
+def old_path(data: bytes, limit: int) -> list:
+    """Как было до потокового разбора: весь ответ строкой, дерево целиком, затем отбор."""
+    root = ET.fromstring(data.decode("utf-8"))
+    records = [r for r in (_record_from_doc(doc) for doc in root.findall(".//doc")) if r is not None]
+    return records[:limit]
+
+
+def streamed(data: bytes, limit: int) -> list:
+    """Как в _read_records: куски по STREAM_CHUNK_SIZE, остановка после limit результатов."""
+    parser = XmlRiverStreamParser(limit)
+    records = []
+    for start in range(0, len(data), STREAM_CHUNK_SIZE):
+        records.extend(parser.feed(data[start:start + STREAM_CHUNK_SIZE]))
+        if parser.done:
+            break
+    return records + parser.close()
+
+
+def measure(name: str, func, data: bytes, limit: int, repeats: int):
+    func(data, limit)  # прогрев
+    started_at = time.perf_counter()
+    for _ in range(repeats):
+        records = func(data, limit)
+    elapsed = (time.perf_counter() - started_at) / repeats
+    tracemalloc.start()
+    func(data, limit)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<42} {elapsed * 1000:9.2f} мс   пик памяти {peak / 1024:9.0f} КБ   результатов {len(records)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cassette", default=config.CASSETTE_PATH)
+    parser.add_argument("--xml", help="файл с сохраненным ответом XMLRiver")
+    parser.add_argument("--synthetic", type=int, default=2000, help="результатов в синтетическом ответе")
+    parser.add_argument("--limit", type=int, default=10, help="сколько результатов нужно вызывающему")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    data, source = None, ""
+    if args.xml:
+        with open(args.xml, "rb") as f:
+            data, source = f.read(), args.xml
+    elif os.path.exists(args.cassette):
+        data, source = largest_recorded_response(args.cassette), args.cassette
+    if not data:
+        data, source = synthetic_response(args.synthetic), f"синтетический ответ ({args.synthetic} результатов)"
+    print(f"Источник: {source}, размер {len(data) / 1024:.0f} КБ, limit={args.limit}\n")
+
+    measure("ET.fromstring + findall (прежний путь)", old_path, data, args.limit, args.repeats)
+    measure("parse_xmlriver, все результаты", lambda d, _: parse_xmlriver(d, limit=10 ** 9), data, args.limit, args.repeats)
+    measure(f"XmlRiverStreamParser, первые {args.limit}", streamed, data, args.limit, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
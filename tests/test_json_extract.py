@@ -0,0 +1,30 @@
+from bot.utils.json_extract import extract_json
+
+POSTS_SCHEMA = {
+    "anyOf": [
+        {"type": "object", "required": ["posts"], "properties": {"posts": {"type": "array", "items": {"type": "object"}, "minItems": 1}}},
+        {"type": "array", "items": {"type": "object"}, "minItems": 1},
+    ],
+}
+
+
+def test_schema_skips_citation_before_json():
+    text = 'Нашел свежую новость [1], вот пост:\n{"posts": [{"body": "Текст", "source_url": "https://a.ru/1"}]}'
+    assert extract_json(text) == [1]
+    assert extract_json(text, POSTS_SCHEMA) == {"posts": [{"body": "Текст", "source_url": "https://a.ru/1"}]}
+
+
+def test_truncated_array_keeps_last_complete_element():
+    assert extract_json('["https://a.ru/1", "https://a.ru/2"') == ["https://a.ru/1", "https://a.ru/2"]
+    assert extract_json('[{"a": 1}, {"b": true}, {"c": "об') == [{"a": 1}, {"b": True}]
+
+
+def test_truncated_object_without_trailing_comma_is_closed():
+    assert extract_json('{"title": "Заголовок", "body": "Текст"') == {"title": "Заголовок", "body": "Текст"}
+    assert extract_json('{"posts": [{"body": "Текст", "source_url": "https://a.ru/1"}') == {
+        "posts": [{"body": "Текст", "source_url": "https://a.ru/1"}]
+    }
+
+
+def test_truncated_key_is_dropped():
+    assert extract_json('{"body": "Текст", "source_') == {"body": "Текст"}